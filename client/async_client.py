@@ -0,0 +1,331 @@
+import asyncio
+import socket
+import struct
+import zlib
+from collections import deque
+from client.client import CODECS, decompress_batch, RECORD_COMPRESSED, RECORD_SKIP, RECORD_LENGTH_MASK, parse_stats
+
+# Protocol v2, mirrors src/PyLogStreams/protocol_v2.py
+MAGIC = b'PLS\x02'
+HEADER = struct.Struct('>IBBHII') # [4B length][1B opcode][1B flags][2B topic length][4B correlation id][4B crc32]
+OP_REGISTER, OP_LOGIN, OP_SUBSCRIBE, OP_SEEK, OP_PRODUCE, OP_PRODUCE_BATCH, OP_ACKS, OP_CONFIG, OP_FETCH, OP_CREDIT, OP_PING, OP_ACK, OP_RECORDS = range(1, 14)
+OP_STATS = 14
+FLAG_CRC = 0x01
+FLAG_KEYED = 0x02
+FLAG_TIME = 0x04
+FETCH_REQUEST = struct.Struct('>qIII')
+OFFSET = struct.Struct('>q')
+ACK_ENTRY = struct.Struct('>IBq') # correlation id, result code, offset of the first record
+
+class ProduceError(Exception):
+    """A produce request rejected by the broker, code is its result code"""
+    def __init__(self, code: int):
+        super().__init__(f"Produce failed with code {code}")
+        self.code = code
+
+class AsyncClient:
+    """asyncio client speaking protocol v2.
+    Messages are accumulated per topic and sent as one batch once batch_size bytes are waiting or
+    linger_ms after the first one, every request of a flush goes out in a single send.
+    produce() returns a future resolved with the offset of the message when the broker acks it."""
+    checksum_enabled:bool = True
+    ping_interval = 30 # in seconds
+    recv_buffer_size = 256*1024 # Initial size of the receive buffer, grown for bigger frames
+
+    def __init__(self, host:str, port:int, linger_ms:int=5, batch_size:int=64*1024, codec:str=None, acks:int=1):
+        self.host = host
+        self.port = port
+        self.linger_ms = linger_ms
+        self.batch_size = batch_size
+        self.codec = codec # 'zlib', 'bz2' or 'lzma' to send compressed batches
+        self.acks = acks
+        self.client_id = None
+        self.sock = None
+        self.loop = None
+        self.send_lock = None
+        self.next_correlation = 1 # 0 asks for no reply
+        self.requests = {} # (correlation id: future) register, config and fetch requests
+        self.produced = {} # (correlation id: [(future, position in the batch), ...])
+        self.batches = {} # (topic: (bytearray of records, [(future, position), ...]))
+        self.frames = [] # Frames ready to send in produce order: sealed batches and keyed messages
+        self.pending_bytes = 0
+        self.linger_handle = None
+        self.flushing = None # Task sending the accumulated batches
+        self.messages = deque() # (topic, message) received from subscriptions, not yet consumed
+        self.received = None # asyncio.Event, set when messages arrive or the connection ends
+        self.alive = False
+        self.tasks = []
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        await self.loop.sock_connect(self.sock, (self.host, self.port))
+        self.send_lock = asyncio.Lock()
+        self.received = asyncio.Event()
+        self.alive = True
+        await self._send(MAGIC)
+        self.tasks = [asyncio.create_task(self._reader_loop()), asyncio.create_task(self._ping_loop())]
+
+    async def register(self) -> str:
+        """Registers a new client, also logs it in, and returns its id"""
+        reply = await self._request(OP_REGISTER)
+        self.client_id = bytes(reply).decode()
+        await self._set_acks()
+        return self.client_id
+
+    async def login(self, client_id:str):
+        self.client_id = client_id
+        await self._send(self._frame(OP_LOGIN, payload=client_id.encode()))
+        await self._set_acks()
+
+    async def _set_acks(self):
+        await self._send(self._frame(OP_ACKS, payload=bytes([self.acks])))
+
+    async def subscribe(self, topic:str, group:str=None):
+        """Subscribes to the topic, members of a group share its partitions and offsets"""
+        await self._send(self._frame(OP_SUBSCRIBE, topic, (group or '').encode()))
+
+    async def seek(self, topic:str, offset:int):
+        """Sets the consumer offset, -1 for the latest"""
+        await self._send(self._frame(OP_SEEK, topic, OFFSET.pack(offset)))
+
+    async def seek_to_time(self, topic:str, timestamp_ms:int):
+        """Sets the consumer offset to the first message produced at or after timestamp_ms (epoch ms)"""
+        await self._send(self._frame(OP_SEEK, topic, OFFSET.pack(timestamp_ms), flags=FLAG_TIME))
+
+    async def configure_topic(self, topic:str, key:str, value) -> int:
+        """Changes a topic setting and returns the result code"""
+        code, _ = await self._request(OP_CONFIG, topic, f'{key}={value}'.encode())
+        return code
+
+    async def produce(self, topic:str, message, key:str=None) -> asyncio.Future:
+        """Queues a message (bytes or str), with a key it goes to the partition of the key, an empty message with
+        a key is a tombstone on a compacted topic.
+        The returned future resolves with the offset of the message, or raises ProduceError."""
+        if isinstance(message, str):
+            message = message.encode()
+        future = self.loop.create_future()
+        if key is not None:
+            # Stored as [key] [message] like KPB
+            payload = key.encode() + b' ' + message
+            correlation = self._correlation()
+            self.produced[correlation] = [(future, 0)]
+            # Messages of the topic produced before this one must reach the broker first
+            self._seal_batch(topic)
+            self.frames.append(self._frame(OP_PRODUCE, topic, payload, correlation, FLAG_KEYED, crc=self.checksum_enabled))
+            self.pending_bytes += len(payload)
+        else:
+            records, futures = self.batches.setdefault(topic, (bytearray(), []))
+            futures.append((future, len(records)))
+            records += self._frame_record(message)
+            self.pending_bytes += len(message) + 8
+        if self.pending_bytes >= self.batch_size:
+            await self._send_batches()
+        elif self.linger_handle is None:
+            self.linger_handle = self.loop.call_later(self.linger_ms/1000, self._linger_expired)
+        return future
+
+    def _linger_expired(self):
+        self.linger_handle = None
+        self.flushing = asyncio.create_task(self._send_batches())
+
+    def _seal_batch(self, topic: str):
+        """Moves the accumulated batch of the topic to the frames to send"""
+        batch = self.batches.pop(topic, None)
+        if batch is None:
+            return
+        records, futures = batch
+        if self.codec is not None:
+            codec_id, compress, _ = CODECS[self.codec]
+            records = self._frame_record(bytes([codec_id]) + compress(records), RECORD_COMPRESSED)
+            # Offsets point at whole records, the messages of a compressed batch share its offset
+            futures = [(future, 0) for future, _ in futures]
+        correlation = self._correlation()
+        self.produced[correlation] = futures
+        self.frames.append(self._frame(OP_PRODUCE_BATCH, topic, bytes(records), correlation))
+
+    async def _send_batches(self):
+        """Sends every accumulated batch and keyed message with one send"""
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        for topic in list(self.batches):
+            self._seal_batch(topic)
+        frames = self.frames
+        self.frames = []
+        self.pending_bytes = 0
+        if frames:
+            await self._send(b''.join(frames))
+
+    async def flush(self, timeout=None) -> bool:
+        """Sends the accumulated messages and waits until every produced message is acked,
+        returns False on timeout"""
+        await self._send_batches()
+        futures = [future for futures in self.produced.values() for future, _ in futures]
+        if not futures:
+            return True
+        done, pending = await asyncio.wait(futures, timeout=timeout)
+        return not pending
+
+    async def fetch(self, topic:str, offset:int, max_bytes:int=64*1024, min_bytes:int=1, max_wait_ms:int=500):
+        """Pulls messages from offset (-1 for the latest), waiting up to max_wait_ms for min_bytes.
+        Returns ([message bytes, ...], next offset)."""
+        payload = await self._request(OP_FETCH, topic, FETCH_REQUEST.pack(offset, max_bytes, min_bytes, max_wait_ms))
+        next_offset = OFFSET.unpack_from(payload)[0]
+        return list(self._split_records(payload[OFFSET.size:])), next_offset
+
+    async def stats(self) -> dict:
+        """Metrics of the broker worker serving the connection, see parse_stats()"""
+        return parse_stats((await self._request(OP_STATS)).decode())
+
+    async def consume(self):
+        """Waits for a message of the subscriptions and returns (topic, message bytes), None once closed"""
+        while not self.messages:
+            if not self.alive:
+                return None
+            self.received.clear()
+            await self.received.wait()
+        return self.messages.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.consume()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        if self.alive:
+            try:
+                await self.flush(5)
+            except Exception:
+                pass
+        self.alive = False
+        for task in self.tasks:
+            task.cancel()
+        self.sock.close()
+
+    def _correlation(self) -> int:
+        correlation = self.next_correlation
+        self.next_correlation = self.next_correlation % 0xFFFFFFFF + 1
+        return correlation
+
+    def _frame(self, opcode:int, topic:str='', payload:bytes=b'', correlation:int=0, flags:int=0, crc:bool=False) -> bytes:
+        topic = topic.encode()
+        crc32 = 0
+        if crc:
+            flags |= FLAG_CRC
+            crc32 = zlib.crc32(payload)
+        return HEADER.pack(HEADER.size - 4 + len(topic) + len(payload), opcode, flags, len(topic), correlation, crc32) + topic + payload
+
+    def _frame_record(self, msg_bytes: bytes, flags:int=0) -> bytes:
+        """Frames a record as stored on disk: [4B length][message][4B checksum]"""
+        if self.checksum_enabled:
+            msg_bytes += zlib.crc32(msg_bytes).to_bytes(4,'big')
+        return (len(msg_bytes) | flags).to_bytes(4,'big') + msg_bytes
+
+    async def _request(self, opcode:int, topic:str='', payload:bytes=b''):
+        """Sends a request and waits for the reply with its correlation id"""
+        correlation = self._correlation()
+        future = self.requests[correlation] = self.loop.create_future()
+        await self._send(self._frame(opcode, topic, payload, correlation))
+        return await future
+
+    async def _send(self, data: bytes):
+        # Frames of concurrent tasks must not interleave
+        async with self.send_lock:
+            await self.loop.sock_sendall(self.sock, data)
+
+    async def _ping_loop(self):
+        while self.alive:
+            await asyncio.sleep(self.ping_interval)
+            await self._send(self._frame(OP_PING))
+
+    async def _reader_loop(self):
+        """Receives into one reusable buffer and handles every complete frame in it"""
+        buffer = bytearray(self.recv_buffer_size)
+        start = end = 0 # Unhandled bytes are buffer[start:end]
+        try:
+            while True:
+                while end - start >= HEADER.size:
+                    length, opcode, flags, topic_len, correlation, crc = HEADER.unpack_from(buffer, start)
+                    frame_end = start + 4 + length
+                    if frame_end > end:
+                        break
+                    with memoryview(buffer) as view:
+                        body = view[start+HEADER.size:frame_end]
+                        self._handle_frame(opcode, correlation, body[:topic_len], body[topic_len:])
+                        body.release()
+                    start = frame_end
+                # Keep the partial frame at the start of the buffer, grow it for a frame bigger than the buffer
+                if start > 0:
+                    buffer[:end-start] = buffer[start:end]
+                    end -= start
+                    start = 0
+                if end >= HEADER.size:
+                    needed = HEADER.unpack_from(buffer)[0] + 4
+                    if needed > len(buffer):
+                        buffer.extend(bytes(needed - len(buffer)))
+                with memoryview(buffer) as view:
+                    received = await self.loop.sock_recv_into(self.sock, view[end:])
+                if received == 0:
+                    break
+                end += received
+        except (asyncio.CancelledError, OSError):
+            pass
+        finally:
+            self.alive = False
+            self.received.set()
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+            for futures in self.produced.values():
+                for future, _ in futures:
+                    if not future.done():
+                        future.set_exception(ConnectionError("Connection closed"))
+
+    def _handle_frame(self, opcode:int, correlation:int, topic: memoryview, payload: memoryview):
+        # The views are over the reusable buffer, everything kept is copied out
+        if opcode == OP_ACK:
+            for pos in range(0, len(payload), ACK_ENTRY.size):
+                correlation, code, offset = ACK_ENTRY.unpack_from(payload, pos)
+                if correlation in self.requests:
+                    self.requests.pop(correlation).set_result((code, offset))
+                    continue
+                for future, position in self.produced.pop(correlation, ()):
+                    if future.done():
+                        continue
+                    if code == 0:
+                        future.set_result(offset + position)
+                    else:
+                        future.set_exception(ProduceError(code))
+        elif opcode == OP_RECORDS:
+            topic = bytes(topic).decode()
+            self.messages.extend((topic, message) for message in self._split_records(payload))
+            self.received.set()
+        elif correlation in self.requests:
+            # Register and fetch replies
+            self.requests.pop(correlation).set_result(bytes(payload))
+
+    def _split_records(self, records):
+        """Yields the messages of the records framed as on disk, skipping corrupted and compacted ones"""
+        pos = 0
+        while pos + 4 <= len(records):
+            length = int.from_bytes(records[pos:pos+4], 'big')
+            msg_len = length & RECORD_LENGTH_MASK
+            msg_bytes = bytes(records[pos+4:pos+4+msg_len])
+            pos += 4 + msg_len
+            if length & RECORD_SKIP:
+                continue
+            if self.checksum_enabled:
+                msg_bytes, hash = msg_bytes[:-4], msg_bytes[-4:]
+                if zlib.crc32(msg_bytes) != int.from_bytes(hash, 'big'):
+                    print("Hash verification failed")
+                    continue
+            if length & RECORD_COMPRESSED:
+                yield from self._split_records(decompress_batch(msg_bytes))
+                continue
+            yield msg_bytes
@@ -4,11 +4,50 @@ import os
 import threading
 import queue
 import time
+import bz2
+import lzma
+from collections import deque
+
+# Compression codecs of record batches: name: (id stored in the record, compress, decompress)
+CODECS = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+    'lzma': (3, lzma.compress, lzma.decompress),
+}
+
+RECORD_COMPRESSED = 0x80000000 # Flag in the record length of a compressed batch
+
+RECORD_SKIP = 0x40000000 # Flag in the record length of a run of records removed by compaction
+
+RECORD_KEYED = 0x20000000 # Flag in the record length of a message produced with a key
+
+RECORD_LENGTH_MASK = 0x1FFFFFFF
+
+def decompress_batch(msg_bytes) -> bytes:
+    """Returns the records of a compressed batch [1B codec][compressed records],
+    raises ValueError if its codec is unknown or it can't be decoded"""
+    decompress = {codec[0]: codec[2] for codec in CODECS.values()}.get(msg_bytes[0])
+    if decompress is None:
+        raise ValueError(f"Unknown compression codec {msg_bytes[0]}")
+    try:
+        return decompress(msg_bytes[1:])
+    except Exception as e:
+        raise ValueError(f"Compressed batch can't be decoded: {e}") from e
+
+def parse_stats(text: str) -> dict:
+    """Parses the Prometheus text returned by the broker into {'name{labels}': value}"""
+    stats = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            stats[name] = float(value)
+    return stats
 
 class Client:
     checksum_enabled:bool = True
     outgoing_buffer_capacity = 1000
     ping_interval = 30 # in seconds
+    recv_buffer_size = 1024*1024 # Initial size of the buffer consume_views() receives into
     def __init__(self, HOST:str, PORT: int):
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.HOST = HOST
@@ -16,6 +55,22 @@ class Client:
         self.conn.connect((HOST, PORT))
         self.send_queue = queue.Queue(self.outgoing_buffer_capacity) # Using queue so message won't get mixed between threads
         self.alive = True
+        self.batch_enabled = False
+        self.pending = deque() # Messages already received in a batch frame, not yet consumed
+        self.seq = None # Next produce sequence number, None until acks are enabled
+        self.in_flight = 0 # Sequenced produce requests not yet acked
+        self.window = 0
+        self.window_cond = threading.Condition()
+        self.ack_callback = None
+        self.failed = deque() # (seq, code) of rejected produce requests when there is no callback
+        self.receiver_thread = None
+        self.incoming = queue.Queue() # Frames read by the receiver thread for consume()
+        self.credit_window = None # Bytes the broker may send ahead of consume(), None without flow control
+        self.consumed_bytes = 0 # Consumed since credit was last granted
+        self.backlog = deque() # Frames read by fetch() that belong to consume()
+        self.recv_buffer = None # Reused by consume_views(), allocated on first use
+        self.recv_start = 0 # Start of the bytes of recv_buffer not parsed yet
+        self.recv_end = 0 # End of the bytes received in recv_buffer
         # Start threads
         self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
         self.writer_thread.start()
@@ -69,24 +124,154 @@ class Client:
         framed = self._frame_message('SET '+topic, '-1')
         self.send_queue.put(framed)
 
+    def reset_offset_to_time(self, topic, timestamp_ms:int):
+        """Sets client topic offset to the first message produced at or after timestamp_ms (epoch ms)"""
+        framed = self._frame_message('SET '+topic, f'@{timestamp_ms}')
+        self.send_queue.put(framed)
+
     
-    def subscribe(self, topic:str):
-        """Subscribes to the topic"""
-        framed = self._frame_message('SUB',topic)
+    def set_acks(self, level:int):
+        """Sets the acks level of the following produce requests: 0 none, 1 written, 2 fsynced"""
+        framed = self._frame_message('ACK', str(level))
+        self.send_queue.put(framed)
+
+    def enable_acks(self, level:int=1, window:int=1000, callback=None):
+        """Pipelines produce requests with acks, at most `window` of them stay unacknowledged.
+        callback(seq, code, offset) runs on the receiver thread for every ack.
+        Call after register()/login(), the socket is then read by the receiver thread."""
+        self.set_acks(level)
+        self.window = window
+        self.ack_callback = callback
+        self.seq = 0
+        self.receiver_thread = threading.Thread(target=self._receiver_loop, daemon=True)
+        self.receiver_thread.start()
+
+    def flush(self, timeout=None) -> bool:
+        """Blocks until every produced message is acked, returns False on timeout"""
+        with self.window_cond:
+            return self.window_cond.wait_for(lambda: self.in_flight == 0 or not self.alive, timeout)
+
+    def _next_seq(self):
+        """Waits for a free slot in the in-flight window and returns the request's sequence number"""
+        with self.window_cond:
+            self.window_cond.wait_for(lambda: self.in_flight < self.window or not self.alive)
+            self.in_flight += 1
+            seq = self.seq
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return seq
+
+    def _receiver_loop(self):
+        """Reads frames from the socket, handles acks and queues everything else for consume()"""
+        while self.alive:
+            msg_bytes = self._recv_frame()
+            if msg_bytes is None:
+                break
+            if msg_bytes.startswith(b'ACK '):
+                self._handle_acks(msg_bytes)
+            else:
+                self.incoming.put(msg_bytes)
+        self.alive = False
+        self.incoming.put(None)
+        with self.window_cond:
+            self.window_cond.notify_all()
+
+    def _handle_acks(self, frame: bytes):
+        """Frame: ACK [4B seq][1B code][8B offset]..."""
+        acks = [(int.from_bytes(frame[pos:pos+4], 'big'), frame[pos+4],
+                int.from_bytes(frame[pos+5:pos+13], 'big', signed=True)) for pos in range(4, len(frame), 13)]
+        with self.window_cond:
+            self.in_flight -= len(acks)
+            self.window_cond.notify_all()
+        for seq, code, offset in acks:
+            if self.ack_callback:
+                self.ack_callback(seq, code, offset)
+            elif code != 0:
+                self.failed.append((seq, code))
+
+    def enable_flow_control(self, window:int=1024*1024):
+        """Lets the broker send at most about `window` bytes that consume() hasn't returned yet,
+        credit is granted again as messages are consumed"""
+        self.credit_window = window
+        self.grant_credit(window)
+
+    def grant_credit(self, size:int):
+        """Allows the broker to send size more bytes"""
+        framed = self._frame_message('CRD', str(size))
+        self.send_queue.put(framed)
+
+    def enable_batch(self):
+        """Asks the broker to deliver messages in batch frames, consume() still returns one message"""
+        framed = self._frame_message('BAT','')
+        self.send_queue.put(framed)
+        self.batch_enabled = True
+
+    def subscribe(self, topic:str, group:str=None):
+        """Subscribes to the topic, members of a group share its partitions and offsets"""
+        framed = self._frame_message('SUB',topic if group is None else f'{topic} {group}')
         self.send_queue.put(framed)
     
+    def configure_topic(self, topic:str, key:str, value):
+        """Changes a topic setting, e.g. configure_topic('orders', 'partitions', 8)"""
+        seq, cmd = self._sequenced('CFG '+topic)
+        framed = self._frame_message(cmd, f'{key}={value}')
+        self.send_queue.put(framed)
+        return seq
+
     def produce(self, topic:str, message:str):
-        """Produces a message in the topic channel"""
-        framed = self._frame_message('PUB '+topic, message, add_checksum=True)
+        """Produces a message in the topic channel, returns the sequence number when acks are enabled"""
+        seq, cmd = self._sequenced('PUB '+topic)
+        framed = self._frame_message(cmd, message, add_checksum=self.checksum_enabled)
         self.send_queue.put(framed)
-    
+        return seq
+
+    def produce_keyed(self, topic:str, key:str, message:str):
+        """Produces a message with a key, messages with the same key go to the same partition in order.
+        On a compacted topic an empty message is a tombstone, it deletes the key."""
+        seq, cmd = self._sequenced('KPB '+topic)
+        framed = self._frame_message(cmd, f'{key} {message}', add_checksum=self.checksum_enabled)
+        self.send_queue.put(framed)
+        return seq
+
+    def _sequenced(self, cmd:str):
+        """Prefixes the command with its sequence number when acks are enabled"""
+        if self.seq is None:
+            return None, cmd
+        seq = self._next_seq()
+        return seq, f'SEQ {seq} {cmd}'
+
+    def produce_batch(self, topic:str, messages:list, codec:str=None):
+        """Produces many messages in the topic channel with a single frame, acked as one request.
+        With a codec ('zlib', 'bz2', 'lzma') the batch is stored and delivered compressed."""
+        records = [self._frame_record(message.encode()) for message in messages]
+        if codec is not None:
+            codec_id, compress, _ = CODECS[codec]
+            records = [self._frame_record(bytes([codec_id]) + compress(b''.join(records)), RECORD_COMPRESSED)]
+        seq, cmd = self._sequenced(f'MPB {topic} ')
+        msg_bytes = cmd.encode() + b''.join(records)
+        self.send_queue.put(len(msg_bytes).to_bytes(4,'big') + msg_bytes)
+        return seq
+
+    def _frame_record(self, msg_bytes: bytes, flags:int=0) -> bytes:
+        """Frames a record as stored on disk: [4B length][message][4B checksum]"""
+        if self.checksum_enabled:
+            msg_bytes += zlib.crc32(msg_bytes).to_bytes(4,'big')
+        return (len(msg_bytes) | flags).to_bytes(4,'big') + msg_bytes
+
     def recvall(self, size: int)->bytes:
-        data = b''
-        while len(data) < size:
-            packet = self.conn.recv(size - len(data))
-            if not packet or packet==b'':
+        # Received in place, appending packets to bytes copies everything received so far each time
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        if self.recv_start < self.recv_end:
+            # Received ahead by consume_views()
+            received = min(size, self.recv_end - self.recv_start)
+            view[:received] = self.recv_buffer[self.recv_start:self.recv_start+received]
+            self.recv_start += received
+        while received < size:
+            count = self.conn.recv_into(view[received:])
+            if count == 0:
                 return None
-            data += packet
+            received += count
         return data
 
     def sendall(self, data:bytes):
@@ -110,14 +295,162 @@ class Client:
         return len(msg_bytes).to_bytes(4,'big')+msg_bytes+hash
 
 
-    def consume(self) -> str:
-        """Blocks until a message arrives and returns it."""
+    def _recv_frame(self) -> bytes:
         len_bytes = self.recvall(4)
         if not len_bytes or len_bytes==b'':
             #Connection closed return
             return None
-        msg_bytes = self.recvall(int.from_bytes(len_bytes, 'big'))
-        if not msg_bytes:
-            return None
-        return msg_bytes.decode()
+        return self.recvall(int.from_bytes(len_bytes, 'big'))
+
+    def _next_frame(self) -> bytes:
+        if self.receiver_thread:
+            return self.incoming.get()
+        return self._recv_frame()
+
+    def fetch(self, topic:str, offset:int, max_bytes:int=64*1024, min_bytes:int=1, max_wait_ms:int=500):
+        """Pulls messages from offset (-1 for the latest), waiting up to max_wait_ms for min_bytes.
+        Returns ([message, ...], next offset). Partitioned topics are fetched per partition."""
+        framed = self._frame_message('FET', f'{topic} {offset} {max_bytes} {min_bytes} {max_wait_ms}')
+        self.send_queue.put(framed)
+        while True:
+            msg_bytes = self._next_frame()
+            if not msg_bytes:
+                return None, offset
+            if msg_bytes.startswith(b'FET '):
+                break
+            self.backlog.append(msg_bytes)
+        # FET [topic] [8B next offset][4B length][message][4B checksum]...
+        topic_end = msg_bytes.index(b' ', 4)
+        next_offset = int.from_bytes(msg_bytes[topic_end+1:topic_end+9], 'big')
+        messages = [msg.decode() for msg in self._split_records(msg_bytes, topic_end+9)]
+        return messages, next_offset
+
+    def stats(self) -> dict:
+        """Metrics of the broker worker serving the connection, see parse_stats()"""
+        self.send_queue.put(self._frame_message('STA', ''))
+        while True:
+            msg_bytes = self._next_frame()
+            if not msg_bytes:
+                return None
+            if msg_bytes.startswith(b'STA '):
+                return parse_stats(msg_bytes[4:].decode())
+            self.backlog.append(msg_bytes)
+
+    def consume(self) -> str:
+        """Blocks until a message arrives and returns it."""
+        while not self.pending:
+            if self.backlog:
+                msg_bytes = self.backlog.popleft()
+            else:
+                msg_bytes = self._next_frame()
+            if not msg_bytes:
+                return None
+            if self.credit_window:
+                # Replenish in chunks, not one CRD per message
+                self.consumed_bytes += 4 + len(msg_bytes)
+                if self.consumed_bytes >= self.credit_window//2:
+                    self.grant_credit(self.consumed_bytes)
+                    self.consumed_bytes = 0
+            if not self.batch_enabled or not msg_bytes.startswith(b'BAT '):
+                return msg_bytes.decode()
+            self._unpack_batch(msg_bytes)
+        return self.pending.popleft()
+
+    def consume_views(self) -> list:
+        """Blocks until messages arrive and returns [(topic, payload memoryview), ...] of every complete frame
+        received by one recv_into, batch frames are split into their messages.
+        The payloads aren't copied, they point into a reused buffer and are only valid until the next call."""
+        if self.receiver_thread or self.backlog or self.pending:
+            return self._queued_views()
+        if self.recv_buffer is None:
+            self.recv_buffer = bytearray(self.recv_buffer_size)
+        buf = self.recv_buffer
+        while True:
+            views = []
+            start, end = self.recv_start, self.recv_end
+            while end - start >= 4:
+                frame_end = start + 4 + int.from_bytes(buf[start:start+4], 'big')
+                if frame_end > end:
+                    break
+                views.extend(self._frame_views(buf, start + 4, frame_end))
+                start = frame_end
+            self.recv_start = start
+            if views:
+                return views
+            # Only a partial frame is left, move it to the front and receive behind it
+            end -= start
+            if start:
+                buf[:end] = buf[start:end+start]
+            needed = 4 + int.from_bytes(buf[:4], 'big') if end >= 4 else 4
+            if needed > len(buf):
+                # Views returned before may still be held, they keep the old buffer alive
+                grown = bytearray(max(needed, 2*len(buf)))
+                grown[:end] = buf[:end]
+                self.recv_buffer = buf = grown
+            self.recv_start, self.recv_end = 0, end
+            count = self.conn.recv_into(memoryview(buf)[end:])
+            if count == 0:
+                return None
+            self.recv_end += count
+
+    def _queued_views(self) -> list:
+        """consume_views() of the messages and frames another reader already received"""
+        if self.pending:
+            views = [(topic, memoryview(msg.encode())) for topic, msg in (m.split(' ', 1) for m in self.pending)]
+            self.pending.clear()
+            return views
+        frames = [self.backlog.popleft() if self.backlog else self._next_frame()]
+        while self.receiver_thread and not self.incoming.empty():
+            frames.append(self.incoming.get_nowait())
+        views = []
+        for frame in frames:
+            if not frame:
+                return views or None
+            views.extend(self._frame_views(frame, 0, len(frame)))
+        return views
+
+    def _frame_views(self, buf, start: int, end: int) -> list:
+        """[(topic, payload view), ...] of the message or batch frame buf[start:end]"""
+        if self.credit_window:
+            self.consumed_bytes += 4 + end - start
+            if self.consumed_bytes >= self.credit_window//2:
+                self.grant_credit(self.consumed_bytes)
+                self.consumed_bytes = 0
+        view = memoryview(buf)
+        batch = self.batch_enabled and buf.startswith(b'BAT ', start, end)
+        if batch:
+            start += 4
+        topic_end = buf.find(b' ', start, end)
+        if topic_end == -1:
+            topic_end = end
+        topic = bytes(view[start:topic_end]).decode()
+        if not batch:
+            return [(topic, view[topic_end+1:end])]
+        return [(topic, msg) for msg in self._split_records(view[topic_end+1:end], 0)]
+
+    def _unpack_batch(self, frame: bytes):
+        """Splits a batch frame BAT [topic] [4B length][message][4B checksum]... into pending messages"""
+        topic_end = frame.index(b' ', 4)
+        topic = frame[4:topic_end].decode()
+        for msg_bytes in self._split_records(frame, topic_end + 1):
+            self.pending.append(f'{topic} {msg_bytes.decode()}')
+
+    def _split_records(self, frame: bytes, pos: int):
+        """Yields the messages of the records framed as on disk, skipping corrupted and compacted ones"""
+        while pos + 4 <= len(frame):
+            length = int.from_bytes(frame[pos:pos+4], 'big')
+            msg_len = length & RECORD_LENGTH_MASK
+            msg_bytes = frame[pos+4:pos+4+msg_len]
+            pos += 4 + msg_len
+            if length & RECORD_SKIP:
+                continue
+            if self.checksum_enabled:
+                msg_bytes, hash = msg_bytes[:-4], msg_bytes[-4:]
+                if zlib.crc32(msg_bytes) != int.from_bytes(hash, 'big'):
+                    print("Hash verification failed")
+                    continue
+            if length & RECORD_COMPRESSED:
+                yield from self._split_records(decompress_batch(msg_bytes), 0)
+                continue
+            yield msg_bytes
 
@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+import zlib
+import metrics
+from log_manager import check_message, append_record, append_batch, sync_topic, get_latest_offset, frame_record
+
+APPEND_SHARDS = 4 # Writer threads, a topic is always appended by the same shard
+
+GROUP_MAX_REQUESTS = 1024 # Max appends collected into one group commit
+
+MAX_QUEUED_APPENDS = 10_000 # Producers with acks=0 wait for the writer past this backlog
+
+# Acks levels of a produce request
+ACKS_NONE = 0 # Don't wait for the append
+ACKS_WRITTEN = 1 # Wait until the record is in the page cache
+ACKS_FSYNC = 2 # Wait until the record is fsynced
+
+shard_queues = []
+
+shard_threads = []
+
+event_loop = None
+
+on_appended = None # Called on the event loop with each topic that got new records and its [(offset, records), ...]
+
+def shard_of(topic: str) -> queue.Queue:
+    # crc32 is stable across processes, unlike hash()
+    return shard_queues[zlib.crc32(topic.encode()) % len(shard_queues)]
+
+def submit(topic, payload, hash=None, batch=False, acks=ACKS_WRITTEN, keyed=False):
+    """Queues an append for the topic's writer shard, returns a future resolved with
+    (result code, offset of the first record) once the request reaches its acks level"""
+    future = event_loop.create_future()
+    shard_of(topic).put((topic, payload, hash, batch, keyed, acks, future))
+    return future
+
+def queued_appends(topic) -> int:
+    return shard_of(topic).qsize()
+
+def shard_writer(requests: queue.Queue):
+    """Runs in background, appends requests in groups and fsyncs once per group"""
+    while True:
+        group = [requests.get()]
+        while len(group) < GROUP_MAX_REQUESTS:
+            try:
+                group.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        stop = group[-1] is None
+        if stop:
+            group.pop()
+        written = [] # (future, (code, offset)) completed once in the page cache
+        synced = [] # (future, (code, offset)) completed after the fsync
+        appended = {} # (topic: [(offset, records framed as on disk), ...])
+        sync_topics = set()
+        for topic, payload, hash, batch, keyed, acks, future in group:
+            # The shard is the only writer of the topic, so the current end is the record's offset
+            offset = get_latest_offset(topic)
+            start = time.perf_counter_ns()
+            try:
+                if batch:
+                    code = append_batch(topic, payload, hash)
+                else:
+                    code = check_message(payload, hash)
+                    if code == 0:
+                        # Framed once, the same bytes go to the log and to the tail ring
+                        payload = frame_record(payload, hash, keyed)
+                        append_record(topic, payload)
+            except Exception as e:
+                print(f"Append error on {topic}: {e}")
+                code = 4 # Broker error
+            metrics.append_latency.record_since(start)
+            if code == 0:
+                appended.setdefault(topic, []).append((offset, payload))
+            if acks == ACKS_FSYNC and code == 0:
+                sync_topics.add(topic)
+                synced.append((future, (code, offset)))
+            else:
+                written.append((future, (code, offset)))
+        if written or appended:
+            deliver(written, appended)
+        if synced:
+            start = time.perf_counter_ns()
+            for topic in sync_topics:
+                try:
+                    sync_topic(topic)
+                except Exception as e:
+                    print(f"Group commit fsync error on {topic}: {e}")
+            metrics.fsync_latency.record_since(start)
+            deliver(synced, {})
+        if stop:
+            return
+
+def deliver(results, appended):
+    try:
+        event_loop.call_soon_threadsafe(complete_group, results, appended)
+    except RuntimeError:
+        # Event loop already closed on shutdown, nobody is waiting
+        pass
+
+def complete_group(results, appended):
+    # Runs on the event loop
+    for future, result in results:
+        if not future.done():
+            future.set_result(result)
+    for topic, records in appended.items():
+        on_appended(topic, records)
+
+def start_append_writers(loop, appended_callback):
+    global event_loop, on_appended
+    event_loop = loop
+    on_appended = appended_callback
+    for _ in range(APPEND_SHARDS):
+        requests = queue.Queue()
+        t = threading.Thread(target=shard_writer, args=(requests,), daemon=True)
+        shard_queues.append(requests)
+        shard_threads.append(t)
+        t.start()
+
+def stop_append_writers() -> bool:
+    """Lets the writers finish the queued appends, then stops them.
+    Returns False if a writer is still appending after the timeout."""
+    for requests in shard_queues:
+        requests.put(None)
+    for t in shard_threads:
+        t.join(timeout=5)
+    return not any(t.is_alive() for t in shard_threads)
@@ -1,11 +1,26 @@
 import uuid
 import asyncio
 import time
-from log_manager import read_message, append_message, start_threads,load_topics_log, check_message_available, get_latest_offset
-from offsets_manager import update_client_offset, get_client_offsets, load_client_offsets
+from log_manager import segmentCache, close_all_segments, read_messages, read_segment_range, get_active_segment_offset, start_threads,load_topics_log, check_message_available, get_latest_offset, find_record_offset, find_time_offset
+from append_writer import submit, queued_appends, start_append_writers, stop_append_writers, ACKS_NONE, ACKS_FSYNC, MAX_QUEUED_APPENDS
+from offsets_manager import update_client_offset, get_client_offsets, load_client_offsets, start_offsets_flusher, stop_offsets_flusher, flush_client_offsets, set_worker
+from topic_config import load_topic_configs, set_topic_config, get_topic_config, apply_topic_config, topic_logs, partition_log
+from compactor import start_compactor, stop_compactor
+from fanout import get_shared_batch, frame_messages, append_tail, drop_dispatcher, dispatchers
+from group_coordinator import join_group, leave_groups, assigned_logs, is_assigned
+import metrics
+import offsets_manager
+import protocol_v2
+import workers
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import os
+import argparse
+import multiprocessing
+import select
+import signal
+import struct
+import zlib
 
 if os.name == "posix":
     import uvloop
@@ -15,35 +30,116 @@ else:
     print("Using default asyncio loop")
 
 
+HOST = 'localhost'
+PORT = 1234
+
+WORKERS = 1 # Broker processes, each owning a share of the topics
+
 BATCH_SIZE = 50       # drain after 50 messages
 MAX_BUFFERED = 32_000 # or when >64KB of data queued
 LINGER_MS = 50    # only wait 50ms before draining
 BEAT_MAX_DELAY = 120  # seconds
 
+SEND_BUFFER_MAX = 256*1024 # Bytes queued in a consumer's transport before the writer waits for it
+
+DRAIN_TIMEOUT = 5 # Seconds, a stuck consumer is checked for liveness this often while draining
+
 MESSAGE_CHECKSUM_ENABLE = True # Enables the message integrity checks
 
+ACKS_DEFAULT = ACKS_NONE # Acks level of produce requests until the client sends ACK
+
+SENDFILE_ENABLE = hasattr(os, 'sendfile') # Stream sealed segments to batch clients with sendfile
+
+METRICS_PORT = None # Serves the metrics in the Prometheus text format on localhost, worker i on METRICS_PORT+i
+
 pool = ThreadPoolExecutor(max_workers=50)
 
 
 # client last beat
 client_heartbeats = {}
 
-topic_events = {}
+topic_waiters = {} # (topic: {asyncio.Event, ...}) writers and fetches waiting for new records
 
 clients_task = {}
 
+# Clients receiving whole record batches instead of one frame per message
+batch_clients = set()
+
+binary_clients = set() # writers of the connections speaking protocol v2, always sent batches
+
+pending_acks = {} # (writer: [packed ack, ...]) acks waiting to be flushed
+
+file_sends = set() # writers with a sendfile in progress
+
+deferred_frames = {} # (writer: [frame, ...]) forwarded frames that arrived during a sendfile
+
+next_partition = {} # (topic: counter) round-robin of the records produced without a key
+
+client_credits = {} # (client_id: bytes) consumers using flow control, bytes they allow the broker to send
+
+credit_events = {} # (client_id: asyncio.Event) set when a consumer grants credit
+
+throttle_stats = {} # (client_id: {'credit': n, 'buffer': n}) how often the writer waited for the consumer
+
+ACK_ENTRY = struct.Struct('>IBq') # seq, result code, offset of the first record
+
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # v2 clients open with the magic bytes, v1 clients with the length of their first frame
+    try:
+        first_bytes = await reader.readexactly(4)
+    except Exception:
+        return
+    if first_bytes == protocol_v2.MAGIC:
+        binary_clients.add(writer)
+        # Upstream connections speak v2 too, so the frames they pipe back are v2 already
+        upstreams = workers.Upstreams(None, protocol_v2.MAGIC)
+        serve = serve_client_v2(reader, writer, upstreams)
+    else:
+        upstreams = workers.Upstreams(None)
+        serve = serve_client(reader, writer, upstreams, first_bytes)
+    upstreams.on_frame = partial(write_piped_frame, writer, upstreams)
+    try:
+        await serve
+    finally:
+        binary_clients.discard(writer)
+        upstreams.close()
+
+async def serve_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, upstreams: workers.Upstreams, len_bytes: bytes):
     client_id = None
+    acks = ACKS_DEFAULT
     while True:
         try:
-            len_bytes = await reader.readexactly(4)
+            if len_bytes is None:
+                len_bytes = await reader.readexactly(4)
             if not len_bytes or len_bytes == b'\x00\x00\x00\x00':
                 break
             msg_length = int.from_bytes(len_bytes, 'big')
             msg_bytes = await reader.readexactly(msg_length)
+            frame = len_bytes + msg_bytes
+            len_bytes = None
             command = msg_bytes[:3].decode()
+            # Sequenced produce request: SEQ [seq] [PUB|MPB ...], acked with the sequence number
+            seq = None
+            if command == 'SEQ':
+                seq_end = msg_bytes.index(b' ', 4)
+                seq = int(msg_bytes[4:seq_end])
+                msg_bytes = msg_bytes[seq_end+1:]
+                command = msg_bytes[:3].decode()
         except Exception as e:
             return
+        if client_id is not None and command in workers.ROUTED_COMMANDS:
+            topic = workers.frame_topic(msg_bytes)
+            if not is_local_topic(topic):
+                # Topic owned by another worker, forward the frame as is
+                try:
+                    if command in ('PUB', 'KPB') and MESSAGE_CHECKSUM_ENABLE:
+                        # The checksum follows the frame
+                        frame += await reader.readexactly(4)
+                    await upstreams.send(workers.owner_of(topic), frame)
+                except Exception as e:
+                    print(f"Forwarding to worker {workers.owner_of(topic)} failed: {e}")
+                    return
+                continue
         if command == 'REG':
             client_id = str(uuid.uuid4())
             id_bytes = client_id.encode()
@@ -55,64 +151,494 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
         elif command == 'CID':
             msg = msg_bytes.decode()
             client_id = msg.split(' ', 1)[1]
-            if client_id in clients_task:
-                # Writer from previous connection still active, close this one
-                task = clients_task[client_id]
-                task.cancel()
-                clients_task.pop(client_id,None)
-            client_heartbeats[client_id] = time.time()
+            login(client_id)
+            upstreams.client_id = client_id
+            upstreams.broadcast(command, frame)
+        # Metrics of the worker serving the connection: STA, replied STA [Prometheus text]. No login needed.
+        elif command == 'STA':
+            stats = b'STA ' + render_stats().encode()
+            try:
+                await write_frame(writer, len(stats).to_bytes(4,'big') + stats)
+            except Exception:
+                return
         elif client_id is None:
             # Client must register first
             return
         elif command == 'SUB':
             msg = msg_bytes.decode()
             parts = msg.split(' ')
-            topic = parts[1]
-            if topic not in get_client_offsets(client_id):
-                update_client_offset(client_id, topic, 0)
-            if topic not in topic_events:
-                topic_events[topic] = asyncio.Event()
-            # Start client writer task
-            if not clients_task.get(client_id) :
-                task = asyncio.create_task(client_writer(writer, client_id))
-                task.add_done_callback(lambda t,cid=client_id:
-                    clients_task.pop(cid,None))
-                clients_task[client_id] = task
+            # SUB [topic] [group] shares the topic with the other members of the group
+            subscribe(writer, client_id, parts[1], parts[2] if len(parts) > 2 else None)
         # For setting offsets from clients side
         elif command == 'SET':
             msg = msg_bytes.decode()
             parts = msg.split(' ')
-            topic = parts[1]
-            offset = int(parts[2])
-            # If offset -1 set it to latest_offset
-            if offset==-1:
-                offset = get_latest_offset(topic)
-            update_client_offset(client_id, topic, offset)
+            if parts[2].startswith('@'):
+                # SET [topic] @[epoch_ms], first record appended at or after that time
+                seek(client_id, parts[1], int(parts[2][1:]), by_time=True)
+            else:
+                seek(client_id, parts[1], int(parts[2]))
+        # Message: PUB [topic] [message], followed by its checksum
         elif command == 'PUB':
-            msg = msg_bytes.decode()
-            parts = msg.split(' ', 2)
-            topic = parts[1]
-            conv = parts[2]
+            topic_end = msg_bytes.index(b' ', 4)
+            topic = msg_bytes[4:topic_end].decode()
             if MESSAGE_CHECKSUM_ENABLE:
                 hash = await reader.readexactly(4) # Reads the 4 byte for checksum
             else:
                 hash = None
-            # loop = asyncio.get_running_loop()
-            # await loop.run_in_executor(pool, partial(append_message, topic, conv))
-            code = append_message(topic, conv.encode(), hash)
-            if code==0:
-                if topic in topic_events:
-                    topic_events[topic].set()
-                    topic_events[topic].clear()
-            # Add the ack logic here
-            pass
+            # The message stays bytes, it is never decoded
+            await produce(writer, topic, msg_bytes[topic_end+1:], hash, acks, seq)
+        # Keyed message: KPB [topic] [key] [message], stored as [key] [message]
+        elif command == 'KPB':
+            topic_end = msg_bytes.index(b' ', 4)
+            topic = msg_bytes[4:topic_end].decode()
+            key_end = msg_bytes.find(b' ', topic_end+1)
+            if MESSAGE_CHECKSUM_ENABLE:
+                hash = await reader.readexactly(4) # Checksum of [key] [message]
+            else:
+                hash = None
+            if key_end == -1:
+                reject_append(writer, seq)
+                continue
+            # Records of a key always land in the same partition, in order
+            await produce(writer, topic, msg_bytes[topic_end+1:], hash, acks, seq, key=msg_bytes[topic_end+1:key_end])
+        # Batch of records for one topic: MPB [topic] [4B length][message][4B checksum]...
+        elif command == 'MPB':
+            topic_end = msg_bytes.index(b' ', 4)
+            topic = msg_bytes[4:topic_end].decode()
+            # Records are already framed as on disk, no decoding or splitting per message
+            await produce(writer, topic, memoryview(msg_bytes)[topic_end+1:], MESSAGE_CHECKSUM_ENABLE, acks, seq, batch=True)
+        # Acks level of the following produce requests: ACK [0 none|1 written|2 fsynced]
+        elif command == 'ACK':
+            acks = min(max(int(msg_bytes[4:]), ACKS_NONE), ACKS_FSYNC)
+            upstreams.broadcast(command, frame)
 
+        # Topic settings: CFG [topic] [key]=[value]
+        elif command == 'CFG':
+            parts = msg_bytes.decode().split(' ')
+            code = configure(parts[1], parts[2]) if len(parts) == 3 else 1
+            if seq is not None:
+                queue_ack(writer, seq, code, -1)
+        # Switch delivery to batch frames: BAT [topic] [4B length][message][4B checksum]...
+        elif command == 'BAT':
+            batch_clients.add(client_id)
+            upstreams.broadcast(command, frame)
+        # Pull: FET [topic] [offset] [max_bytes] [min_bytes] [max_wait_ms], replied to when data or the deadline arrives
+        elif command == 'FET':
+            parts = msg_bytes.decode().split(' ')
+            if len(parts) != 6:
+                continue
+            topic = parts[1]
+            offset, max_bytes, min_bytes, max_wait_ms = (int(part) for part in parts[2:])
+            # Parked apart, the connection keeps serving other requests meanwhile
+            asyncio.create_task(handle_fetch(writer, topic, offset, max_bytes, min_bytes, max_wait_ms))
+        # Flow control: CRD [bytes] allows the broker to send that many more bytes to this consumer
+        elif command == 'CRD':
+            # Kept by this worker, the other workers' frames are charged when piped back
+            grant_credit(client_id, int(msg_bytes[4:]))
         # Heart beat from client
         elif command=='PNG':
-            client_heartbeats[client_id] = time.time()
-            print(f"Client {client_id} heartbeat at {time.time()}")
+            heartbeat(client_id)
+            upstreams.broadcast(command, frame)
+
+async def serve_client_v2(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, upstreams: workers.Upstreams):
+    """Serves a client speaking protocol v2: fixed binary headers, payloads kept as bytes"""
+    client_id = None
+    acks = ACKS_DEFAULT
+    while True:
+        try:
+            header = await reader.readexactly(protocol_v2.HEADER.size)
+            length, opcode, flags, topic_len, correlation, crc = protocol_v2.HEADER.unpack(header)
+            body = await reader.readexactly(length + 4 - protocol_v2.HEADER.size)
+        except Exception:
+            return
+        # The payload is a view over the received bytes, only the topic is decoded
+        topic = body[:topic_len].decode()
+        payload = memoryview(body)[topic_len:]
+        # Requests with a correlation id are acked with it
+        seq = correlation or None
+        if client_id is not None and opcode in protocol_v2.ROUTED_OPCODES and not is_local_topic(topic):
+            try:
+                await upstreams.send(workers.owner_of(topic), header + body)
+            except Exception as e:
+                print(f"Forwarding to worker {workers.owner_of(topic)} failed: {e}")
+                return
+            continue
+        if opcode == protocol_v2.OP_REGISTER:
+            client_id = str(uuid.uuid4())
+            try:
+                writer.write(protocol_v2.encode_frame(protocol_v2.OP_REGISTER, payload=client_id.encode(), correlation=correlation))
+                await writer.drain()
+            except Exception:
+                return
+            login(client_id)
+            batch_clients.add(client_id)
+            upstreams.client_id = client_id
+            # Upstreams only learn the client id from a login
+            upstreams.broadcast('CID', protocol_v2.encode_frame(protocol_v2.OP_LOGIN, payload=client_id.encode()))
+        elif opcode == protocol_v2.OP_LOGIN:
+            client_id = bytes(payload).decode()
+            login(client_id)
+            batch_clients.add(client_id)
+            upstreams.client_id = client_id
+            upstreams.broadcast('CID', header + body)
+        elif opcode == protocol_v2.OP_STATS:
+            try:
+                await write_frame(writer, protocol_v2.encode_frame(protocol_v2.OP_STATS, payload=render_stats().encode(), correlation=correlation))
+            except Exception:
+                return
+        elif client_id is None:
+            # Client must register first
+            return
+        elif opcode == protocol_v2.OP_SUBSCRIBE:
+            subscribe(writer, client_id, topic, bytes(payload).decode() or None)
+        elif opcode == protocol_v2.OP_SEEK:
+            seek(client_id, topic, protocol_v2.OFFSET.unpack(payload)[0], by_time=bool(flags & protocol_v2.FLAG_TIME))
+        elif opcode == protocol_v2.OP_PRODUCE:
+            if MESSAGE_CHECKSUM_ENABLE and not flags & protocol_v2.FLAG_CRC:
+                if seq is not None:
+                    queue_ack(writer, seq, 3, -1) # Missing hash
+                continue
+            hash = crc.to_bytes(4, 'big') if MESSAGE_CHECKSUM_ENABLE else None
+            key = None
+            if flags & protocol_v2.FLAG_KEYED:
+                # Stored as [key] [message] like KPB
+                key = bytes(payload).split(b' ', 1)[0]
+            await produce(writer, topic, bytes(payload), hash, acks, seq, key=key)
+        elif opcode == protocol_v2.OP_PRODUCE_BATCH:
+            await produce(writer, topic, payload, MESSAGE_CHECKSUM_ENABLE, acks, seq, batch=True)
+        elif opcode == protocol_v2.OP_ACKS:
+            acks = min(max(payload[0], ACKS_NONE), ACKS_FSYNC)
+            upstreams.broadcast('ACK', header + body)
+        elif opcode == protocol_v2.OP_CONFIG:
+            code = configure(topic, bytes(payload).decode())
+            if seq is not None:
+                queue_ack(writer, seq, code, -1)
+        elif opcode == protocol_v2.OP_FETCH:
+            offset, max_bytes, min_bytes, max_wait_ms = protocol_v2.FETCH_REQUEST.unpack(payload)
+            asyncio.create_task(handle_fetch(writer, topic, offset, max_bytes, min_bytes, max_wait_ms, correlation))
+        elif opcode == protocol_v2.OP_CREDIT:
+            grant_credit(client_id, protocol_v2.OFFSET.unpack(payload)[0])
+        elif opcode == protocol_v2.OP_PING:
+            heartbeat(client_id)
+            upstreams.broadcast('PNG', header + body)
+
+def login(client_id):
+    """Starts the session of a client on this connection"""
+    if client_id in clients_task:
+        # Writer from previous connection still active, close this one
+        task = clients_task[client_id]
+        task.cancel()
+        clients_task.pop(client_id,None)
+    client_heartbeats[client_id] = time.time()
+    # Delivery mode and flow control are per connection
+    batch_clients.discard(client_id)
+    client_credits.pop(client_id, None)
+
+def subscribe(writer, client_id, topic, group=None):
+    offsets_id = client_id
+    if group:
+        offsets_id = join_group(group, client_id, topic, writer).offsets_id
+    # A partitioned topic subscribes to all of its partitions, [topic]/partition-[n] to one
+    for log in topic_logs(topic):
+        if log not in get_client_offsets(offsets_id):
+            update_client_offset(offsets_id, log, 0)
+    # Start client writer task
+    if not clients_task.get(client_id) :
+        task = asyncio.create_task(client_writer(writer, client_id))
+        task.add_done_callback(lambda t,cid=client_id:
+            clients_task.pop(cid,None))
+        # Dead or disconnected members leave their groups
+        task.add_done_callback(lambda t,cid=client_id,conn=writer:
+            leave_groups(cid, conn))
+        clients_task[client_id] = task
+
+def seek(client_id, topic, offset, by_time=False):
+    for log in topic_logs(topic):
+        if by_time:
+            log_offset = find_time_offset(log, offset)
+        # If offset -1 set it to latest_offset
+        elif offset==-1:
+            log_offset = get_latest_offset(log)
+        else:
+            # Snap arbitrary offsets to a record boundary
+            log_offset = find_record_offset(log, offset)
+        update_client_offset(client_id, log, log_offset)
+
+async def produce(writer, topic, payload, hash, acks, seq, key=None, batch=False):
+    if not is_producible_topic(topic):
+        reject_append(writer, seq)
+        return
+    topic = route_record(topic, key)
+    # Appends run on the writer shards, off the event loop
+    future = submit(topic, payload, hash, batch=batch, acks=acks, keyed=key is not None)
+    await wait_append(writer, future, topic, acks, seq)
+
+def configure(topic, setting) -> int: # Result code
+    setting = setting.split('=')
+    if len(setting) != 2 or not is_producible_topic(topic):
+        code = 1
+    else:
+        code = set_topic_config(topic, setting[0], setting[1])
+    if code != 0:
+        print(f"Invalid config for {topic}: {'='.join(setting)}")
+    return code
+
+def grant_credit(client_id, credit):
+    client_credits[client_id] = client_credits.get(client_id, 0) + credit
+    if client_id in credit_events:
+        credit_events[client_id].set()
+
+def heartbeat(client_id):
+    client_heartbeats[client_id] = time.time()
+
+def is_internal_topic(topic):
+    # Internal topics like __consumer_offset are only written by the broker
+    return topic.startswith('__')
+
+def is_producible_topic(topic):
+    # Partitions are only written through their topic
+    return not is_internal_topic(topic) and '/' not in topic
+
+def route_record(topic, key=None):
+    """Returns the log a record of the topic is appended to, the partition of the key or the next one"""
+    partitions = get_topic_config(topic, 'partitions')
+    if partitions == 1:
+        return topic
+    if key is None:
+        partition = next_partition.get(topic, 0)
+        next_partition[topic] = partition + 1
+    else:
+        partition = zlib.crc32(key)
+    return partition_log(topic, partition % partitions)
+
+def is_local_topic(topic):
+    # Internal topics are per worker, never forwarded
+    return workers.worker_count == 1 or is_internal_topic(topic) or workers.owner_of(topic) == workers.worker_id
+
+def owns_topic(topic):
+    """Topics loaded by this worker: its own topics and its own offsets log"""
+    if is_internal_topic(topic):
+        return workers.worker_count == 1 or topic == offsets_manager.INTERNAL_CONSUMER_LOG
+    return is_local_topic(topic)
+
+async def wait_append(writer, future, topic, acks, seq=None):
+    """Waits for the append according to the acks level. Sequenced requests aren't waited for,
+    they are acked to the client when the append completes"""
+    if seq is not None:
+        future.add_done_callback(lambda f: queue_ack(writer, seq, *f.result()))
+    elif acks != ACKS_NONE:
+        await future
+        return
+    # Stop reading from this producer while the writer is far behind
+    if queued_appends(topic) > MAX_QUEUED_APPENDS:
+        await future
+
+def reject_append(writer, seq):
+    if seq is not None:
+        queue_ack(writer, seq, 1, -1) # Invalid message
+
+def queue_ack(writer, seq, code, offset):
+    """Acks are coalesced per connection and sent once per event loop iteration"""
+    acks = pending_acks.get(writer)
+    if acks is None:
+        acks = pending_acks[writer] = []
+        asyncio.get_running_loop().call_soon(flush_acks, writer)
+    acks.append(ACK_ENTRY.pack(seq, code, offset))
+
+def flush_acks(writer):
+    # ACK [4B seq][1B code][8B offset]...
+    if writer in file_sends:
+        # Writing now would land inside the file range, send_file_range flushes after it
+        return
+    acks = pending_acks.pop(writer, None)
+    if not acks or writer.transport.is_closing():
+        return
+    if writer in binary_clients:
+        writer.write(protocol_v2.encode_frame(protocol_v2.OP_ACK, payload=b''.join(acks)))
+        return
+    frame = b'ACK ' + b''.join(acks)
+    writer.write(len(frame).to_bytes(4,'big') + frame)
+
+def batch_header(writer, topic, length) -> bytes:
+    """Header of a frame carrying length bytes of records of the topic, in the protocol of the connection"""
+    if writer in binary_clients:
+        return protocol_v2.frame_header(protocol_v2.OP_RECORDS, topic.encode(), length)
+    # [4B length]BAT [topic] [records]
+    header = f'BAT {topic} '.encode()
+    return (len(header)+length).to_bytes(4,'big') + header
+
+async def write_frame(writer: asyncio.StreamWriter, frame: bytes):
+    """Writes a frame forwarded from another worker to the client"""
+    if writer in file_sends:
+        deferred_frames.setdefault(writer, []).append(frame)
+        return
+    writer.write(frame)
+    await writer.drain()
+
+async def write_piped_frame(writer: asyncio.StreamWriter, upstreams: workers.Upstreams, frame: bytes):
+    """Writes a frame piped back from another worker. The credit of a consumer stays with the worker it's connected to,
+    a grant sent to every worker would multiply its window. The piped frames are charged against it instead, waiting for
+    more credit once it's used up, and the other workers are held back by their send buffer meanwhile."""
+    client_id = upstreams.client_id
+    if client_id in client_credits:
+        while client_credits.get(client_id, 1) <= 0:
+            event = credit_events.get(client_id)
+            owned = event is None
+            if owned:
+                # No local writer for the client, grants wake an event of our own
+                event = credit_events[client_id] = asyncio.Event()
+            event.clear()
+            try:
+                await wait_event(event, 1)
+            finally:
+                if owned and credit_events.get(client_id) is event:
+                    del credit_events[client_id]
+        if client_id in client_credits:
+            # A frame is sent while some credit is left, it can overdraw the credit once like the local writer
+            client_credits[client_id] -= len(frame)
+    await write_frame(writer, frame)
+
+def records_appended(topic, appends):
+    """Keeps the new records in the topic's tail ring, then wakes up its consumers"""
+    # Only topics someone waits on get a ring, the others are read from the log
+    if topic in topic_waiters:
+        append_tail(topic, appends, MESSAGE_CHECKSUM_ENABLE)
+    notify_topic(topic)
+
+def notify_topic(topic):
+    """Wakes up the consumers waiting for new messages in the topic"""
+    for waiter in topic_waiters.get(topic, ()):
+        waiter.set()
+
+def watch_topics(waiter: asyncio.Event, old_topics: set, topics: set):
+    """Moves the waiter from the old topics to the new ones"""
+    for topic in old_topics - topics:
+        waiters = topic_waiters.get(topic)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del topic_waiters[topic]
+                drop_dispatcher(topic)
+    for topic in topics - old_topics:
+        topic_waiters.setdefault(topic, set()).add(waiter)
+
+async def wait_event(event: asyncio.Event, timeout):
+    # call_later instead of wait_for, no task per wait
+    handle = asyncio.get_running_loop().call_later(timeout, event.set)
+    try:
+        await event.wait()
+    finally:
+        handle.cancel()
+
+async def handle_fetch(writer: asyncio.StreamWriter, topic: str, offset: int, max_bytes: int, min_bytes: int, max_wait_ms: int, correlation: int = 0):
+    """Parks the fetch until min_bytes are available or max_wait_ms passed, then replies
+    FET [topic] [8B next offset][records], or OP_FETCH with the correlation id of a v2 request"""
+    start = time.perf_counter_ns()
+    records = None
+    next_offset = offset
+    waiter = asyncio.Event()
+    deadline = time.time() + max_wait_ms/1000
+    try:
+        if len(topic_logs(topic)) > 1:
+            # Partitioned topics are fetched one partition at a time
+            raise ValueError(f"fetch of partitioned topic {topic}")
+        # Offsets are global byte positions, so the available bytes are a subtraction
+        offset = get_latest_offset(topic) if offset == -1 else find_record_offset(topic, offset)
+        next_offset = offset
+        watch_topics(waiter, set(), {topic})
+        while get_latest_offset(topic) - offset < max(min_bytes, 1) and time.time() < deadline:
+            waiter.clear()
+            await wait_event(waiter, deadline - time.time())
+        if check_message_available(topic, offset):
+            records, next_offset = read_messages(topic, offset, max_bytes)
+    except Exception as e:
+        print(f"Fetch error on {topic}: {e}")
+    finally:
+        watch_topics(waiter, {topic}, set())
+    records_len = len(records) if records is not None else 0
+    if writer in binary_clients:
+        header = protocol_v2.frame_header(protocol_v2.OP_FETCH, topic.encode(), protocol_v2.OFFSET.size + records_len, correlation)
+        header += protocol_v2.OFFSET.pack(next_offset)
+    else:
+        header = f'FET {topic} '.encode() + next_offset.to_bytes(8, 'big')
+        header = (len(header) + records_len).to_bytes(4,'big') + header
+    try:
+        frame = header
+        if records is not None:
+            frame += records
+            records.release()
+        await write_frame(writer, frame)
+        metrics.fetch_latency.record_since(start)
+        metrics.count_out(topic, len(frame))
+    except Exception:
+        pass
+
+async def send_file_range(writer: asyncio.StreamWriter, path: str, file_pos: int, count: int):
+    """Streams count bytes of a segment file to the client with sendfile"""
+    file_sends.add(writer)
+    try:
+        await sendfile_range(writer, path, file_pos, count)
+    finally:
+        file_sends.discard(writer)
+        for frame in deferred_frames.pop(writer, ()):
+            writer.write(frame)
+        if writer in pending_acks:
+            flush_acks(writer)
+
+async def sendfile_range(writer: asyncio.StreamWriter, path: str, file_pos: int, count: int):
+    loop = asyncio.get_running_loop()
+    transport = writer.transport
+    with open(path, 'rb') as f:
+        try:
+            await loop.sendfile(transport, f, file_pos, count)
+            return
+        except NotImplementedError:
+            # uvloop has no loop.sendfile, send from a worker thread once the transport buffer is empty
+            pass
+        low, high = transport.get_write_buffer_limits()
+        transport.set_write_buffer_limits(high=0)
+        try:
+            await writer.drain()
+        finally:
+            transport.set_write_buffer_limits(high=high, low=low)
+        sock_fd = transport.get_extra_info('socket').fileno()
+        await loop.run_in_executor(pool, blocking_sendfile, sock_fd, f.fileno(), file_pos, count)
+
+def blocking_sendfile(sock_fd, file_fd, file_pos, count):
+    # The socket is non-blocking, wait for it to be writable when the send buffer is full
+    while count > 0:
+        try:
+            sent = os.sendfile(sock_fd, file_fd, file_pos, count)
+        except BlockingIOError:
+            select.select([], [sock_fd], [], 1)
+            continue
+        if sent == 0:
+            raise ConnectionError("socket connection broken")
+        file_pos += sent
+        count -= sent
 
 async def client_writer(writer: asyncio.StreamWriter, client_id: str):
+    transport = writer.transport
+    # Bounds the bytes buffered for a slow consumer, drain() waits above the high water mark
+    transport.set_write_buffer_limits(high=SEND_BUFFER_MAX)
+    event = credit_events[client_id] = asyncio.Event()
+    stats = throttle_stats[client_id] = {'credit': 0, 'buffer': 0}
+    # One waiter per consumer, registered on its topics while it is idle
+    waiter = asyncio.Event()
+    watched = set()
+    try:
+        await deliver_messages(writer, client_id, waiter, watched)
+    finally:
+        watch_topics(waiter, watched, set())
+        # A writer of a newer connection may already have replaced them
+        if credit_events.get(client_id) is event:
+            credit_events.pop(client_id)
+            throttle_stats.pop(client_id)
+        if stats['credit'] or stats['buffer']:
+            print(f"Client {client_id} throttled {stats['credit']} times waiting for credit, {stats['buffer']} times on a full send buffer")
+
+async def deliver_messages(writer: asyncio.StreamWriter, client_id: str, waiter: asyncio.Event, watched: set):
     count = 0
     buffered = 0
     timestamp = time.time()
@@ -126,23 +652,97 @@ async def client_writer(writer: asyncio.StreamWriter, client_id: str):
             return
         if count == 0:
             timestamp = time.time()
-        # Get current offsets
-        client_offsets = get_client_offsets(client_id)
-        for topic in client_offsets.keys():
-            offset = client_offsets[topic]
-            if topic in updated_offsets:
-                offset = updated_offsets[topic]
+        # Cleared before reading, records appended during the pass wake the next wait at once
+        waiter.clear()
+        credit = client_credits.get(client_id)
+        out_of_credit = False
+        # Get current offsets: own subscriptions, then the logs assigned to the client in its groups
+        sources = [(topic, client_id) for topic in list(get_client_offsets(client_id))] + assigned_logs(client_id)
+        for source in sources:
+            topic, offsets_id = source
+            # A frame is sent while some credit is left, it can overdraw the credit once
+            if credit is not None and credit - buffered <= 0:
+                out_of_credit = True
+                break
+            offset = updated_offsets.get(source)
+            if offset is None:
+                offset = get_client_offsets(offsets_id).get(topic, 0)
             if(not check_message_available(topic, offset)):
                 continue
-            # loop = asyncio.get_running_loop()
-            msg, new_offset = read_message(topic, offset, MESSAGE_CHECKSUM_ENABLE)
-            if msg is not None:
-                ansbytes = f'{topic} {msg}'.encode()
+            # Tailing subscribers are served from the topic's tail ring and share one encoding of every batch
+            shared = get_shared_batch(topic, offset, MESSAGE_CHECKSUM_ENABLE)
+            if shared is not None:
+                if writer in binary_clients:
+                    frames, messages = shared.binary_frame(), 1
+                elif client_id in batch_clients:
+                    frames, messages = shared.batch_frame(), 1
+                else:
+                    frames = shared.message_frames()
+                    messages = shared.count
                 try:
-                    writer.write(len(ansbytes).to_bytes(4,'big') + ansbytes)
-                    buffered += len(ansbytes) + 4
+                    # Immutable bytes shared by every subscriber, written without a copy per client
+                    writer.write(frames)
+                except Exception:
+                    print(f"Exception sending to client {client_id}")
+                    return
+                buffered += len(frames)
+                count += messages
+                metrics.count_out(topic, len(frames), messages)
+                updated_offsets[source] = shared.next_offset
+                if (count >= BATCH_SIZE or buffered >= MAX_BUFFERED or (time.time()-timestamp)*1000 >= LINGER_MS):
+                    break
+                continue
+            if client_id in batch_clients:
+                # Catch-up reads from sealed segments go from the file to the socket without touching Python
+                if SENDFILE_ENABLE and offset < get_active_segment_offset(topic):
+                    path, file_pos, length, new_offset = read_segment_range(topic, offset)
+                    if path is None:
+                        if new_offset != offset:
+                            updated_offsets[source] = new_offset
+                        continue
+                    header = batch_header(writer, topic, length)
+                    try:
+                        writer.write(header)
+                        await send_file_range(writer, path, file_pos, length)
+                    except Exception as e:
+                        print(f"Exception sending file to client {client_id}: {e}")
+                        return
+                    buffered += len(header) + length
                     count += 1
-                    updated_offsets[topic] = new_offset
+                    metrics.count_out(topic, len(header) + length)
+                    updated_offsets[source] = new_offset
+                    break
+                records, new_offset = read_messages(topic, offset, MAX_BUFFERED)
+                if records is not None:
+                    header = batch_header(writer, topic, len(records))
+                    try:
+                        # Single copy of the whole range, the view over the mmap never reaches the transport
+                        writer.write(header + records)
+                        buffered += len(header) + len(records)
+                        count += 1
+                        metrics.count_out(topic, len(header) + len(records))
+                        updated_offsets[source] = new_offset
+                    except Exception:
+                        print(f"Exception sending to client {client_id}")
+                        return
+                    finally:
+                        records.release()
+                    if (count >= BATCH_SIZE or buffered >= MAX_BUFFERED or (time.time()-timestamp)*1000 >= LINGER_MS):
+                        break
+                elif new_offset != offset:
+                    updated_offsets[source] = new_offset
+                continue
+            # One record per pass, a compressed batch is expanded to all of its messages
+            records, new_offset = read_messages(topic, offset, 1)
+            if records is not None:
+                frames, messages = frame_messages(topic, records, MESSAGE_CHECKSUM_ENABLE)
+                records.release()
+                try:
+                    writer.write(frames)
+                    buffered += len(frames)
+                    count += messages
+                    metrics.count_out(topic, len(frames), messages)
+                    updated_offsets[source] = new_offset
                     if (count >= BATCH_SIZE or buffered >= MAX_BUFFERED or (count>0 and (time.time()-timestamp)*1000 >= LINGER_MS)):
                         break
                 except Exception:
@@ -152,43 +752,177 @@ async def client_writer(writer: asyncio.StreamWriter, client_id: str):
                 # No new message, update offset anyway
                 # This can happen if message was expired
                 if new_offset != offset:
-                    updated_offsets[topic] = new_offset
-        if buffered > 0 and (count >= BATCH_SIZE or buffered >= MAX_BUFFERED or (time.time()-timestamp)*1000 >= LINGER_MS):
-            try:
-                await writer.drain()
-            except Exception:
-                print(f"Exception draining to client {client_id}")
+                    updated_offsets[source] = new_offset
+        if buffered > 0 and (out_of_credit or count >= BATCH_SIZE or buffered >= MAX_BUFFERED or (time.time()-timestamp)*1000 >= LINGER_MS):
+            if client_id in client_credits:
+                client_credits[client_id] -= buffered
+            metrics.delivery_bytes.record(buffered)
+            if not await drain_client(writer, client_id):
                 return
-            for topic, new_offset in updated_offsets.items():
-                update_client_offset(client_id, topic, new_offset)
+            for (topic, offsets_id), new_offset in updated_offsets.items():
+                # A log moved to another group member by a rebalance is committed by that member now
+                if offsets_id == client_id or is_assigned(client_id, offsets_id, topic):
+                    update_client_offset(offsets_id, topic, new_offset)
             updated_offsets = {}
             count = 0
             buffered = 0
             timestamp = time.time()
         # Nothing was sent, wait for new messages
+        elif out_of_credit:
+            # Wait for the consumer to grant more bytes
+            throttle_stats[client_id]['credit'] += 1
+            credit_events[client_id].clear()
+            await wait_event(credit_events[client_id], 1)
         elif count==0 and updated_offsets=={}:
-            # Subscribe to all topic events
-            tasks = [
-                asyncio.create_task(topic_events[tp].wait())
-                for tp in client_offsets.keys()
-                if tp in topic_events
-            ]
-            done,pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED,timeout=1)
-            for t in pending:
-                t.cancel()
-
-
-async def start_server():
-    load_topics_log()
+            # Subscriptions and group assignments change, keep the waiter on the current topics
+            topics = {topic for topic, _ in sources}
+            if topics != watched:
+                watch_topics(waiter, watched, topics)
+                watched.clear()
+                watched.update(topics)
+            # Woken by new records, the timeout rechecks heartbeats and the connection
+            await wait_event(waiter, 1)
+
+
+async def drain_client(writer: asyncio.StreamWriter, client_id: str) -> bool:
+    """Waits until the consumer's send buffer is below the low water mark, False if the consumer is gone"""
+    transport = writer.transport
+    if transport.get_write_buffer_size() > SEND_BUFFER_MAX:
+        throttle_stats[client_id]['buffer'] += 1
+    while True:
+        try:
+            # A stuck socket only suspends this writer, the timeout keeps checking its heartbeats
+            await asyncio.wait_for(writer.drain(), DRAIN_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            if transport.is_closing() or client_heartbeats.get(client_id,0)+BEAT_MAX_DELAY < time.time():
+                print(f"Client {client_id} stopped reading, closing")
+                transport.abort()
+                return False
+        except Exception:
+            print(f"Exception draining to client {client_id}")
+            return False
+
+def render_stats() -> str:
+    """Metrics of this worker, adds the broker state to the counters and histograms of metrics.py"""
+    now = time.time()
+    lag = []
+    for offsets_id, offsets in list(offsets_manager.client_offsets.items()):
+        for topic, offset in list(offsets.items()):
+            if owns_topic(topic) and not is_internal_topic(topic):
+                lag.append(({'client': offsets_id, 'topic': topic}, max(get_latest_offset(topic) - offset, 0)))
+    families = [
+        ('consumer_lag_bytes', 'gauge', "Latest offset minus the committed offset, per client or group:[name]", lag),
+        ('consumer_throttled_total', 'counter', "Waits of a consumer writer for credit or on a full send buffer",
+            [({'client': client_id, 'reason': reason}, n) for client_id, stats in list(throttle_stats.items()) for reason, n in stats.items()]),
+        ('heartbeat_age_seconds', 'gauge', "Seconds since the last heartbeat of a consumer with a writer",
+            [({'client': client_id}, round(now - client_heartbeats.get(client_id, 0), 3)) for client_id in list(clients_task)]),
+        ('segment_cache_hits_total', 'counter', "Sealed segment lookups served by the cache", [({}, segmentCache.hits)]),
+        ('segment_cache_misses_total', 'counter', "Sealed segment lookups that mapped the file", [({}, segmentCache.misses)]),
+        ('segment_cache_hit_ratio', 'gauge', "Share of sealed segment lookups served by the cache", [({}, round(segmentCache.hit_ratio(), 4))]),
+        ('segment_cache_evictions_total', 'counter', "Segments closed to stay within OLD_SEGMENT_CACHE_SIZE and OLD_SEGMENT_CACHE_BYTES", [({}, segmentCache.evictions)]),
+        ('segment_cache_promotions_total', 'counter', "Segments mapped again after leaving probation, admitted to the main queue", [({}, segmentCache.promotions)]),
+        ('segment_cache_segments', 'gauge', "Sealed segments mapped", [({'queue': 'probation'}, len(segmentCache.probation)), ({'queue': 'main'}, len(segmentCache.main))]),
+        ('segment_cache_bytes', 'gauge', "Bytes of sealed segments mapped", [({}, segmentCache.size)]),
+        ('tail_ring_bytes', 'gauge', "Bytes of recent records kept in memory, see TAIL_RING_BYTES",
+            [({'topic': topic}, d.ring.size) for topic, d in list(dispatchers.items())]),
+        ('tail_ring_reads_total', 'counter', "Consumer reads served from the tail ring (hit) or from the log (miss)",
+            [({'topic': topic, 'result': result}, n) for topic, d in list(dispatchers.items()) for result, n in (('hit', d.hits), ('miss', d.misses))]),
+        ('setting', 'gauge', "Delivery settings of the broker",
+            [({'name': name}, value) for name, value in (('BATCH_SIZE', BATCH_SIZE), ('MAX_BUFFERED', MAX_BUFFERED), ('LINGER_MS', LINGER_MS), ('SEND_BUFFER_MAX', SEND_BUFFER_MAX))]),
+    ]
+    return metrics.render(families, {'worker': workers.worker_id} if workers.worker_count > 1 else None)
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answers any HTTP request with the metrics, for Prometheus scrapes"""
+    try:
+        # Request line and headers until the blank line, the path isn't looked at
+        while (await reader.readline()).strip():
+            pass
+        body = render_stats().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_server(host=HOST, port=PORT, metrics_port=METRICS_PORT):
+    load_topic_configs(owns_topic)
+    load_topics_log(owns_topic)
     start_threads()
+    start_compactor(MESSAGE_CHECKSUM_ENABLE)
+    apply_topic_config(offsets_manager.INTERNAL_CONSUMER_LOG)
     load_client_offsets()
+    start_offsets_flusher()
+    start_append_writers(asyncio.get_running_loop(), records_appended)
 
-    server = await asyncio.start_server(handle_client, 'localhost', 1234)
+    # Workers share the port, the kernel spreads the connections between them
+    server = await asyncio.start_server(handle_client, host, port, reuse_port=workers.worker_count > 1)
     addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
     print(f'Serving on {addrs}')
+    servers = [server]
+    if metrics_port is not None:
+        servers.append(await asyncio.start_server(serve_metrics, 'localhost', metrics_port + workers.worker_id))
+    if workers.worker_count > 1:
+        # Frames for our topics forwarded by the other workers
+        path = workers.worker_socket_path(workers.worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+        servers.append(await asyncio.start_unix_server(handle_client, path))
+
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+def run_worker(worker_id, worker_count, host, port, metrics_port=METRICS_PORT):
+    workers.worker_id = worker_id
+    workers.worker_count = worker_count
+    if worker_count > 1:
+        set_worker(worker_id)
+        # The parent stops the workers with SIGTERM, Ctrl+C reaches it alone
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Treat SIGTERM like Ctrl+C so deploys shut down cleanly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(start_server(host, port, metrics_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Nothing may append after the manifests, a record past a clean shutdown's write offset would be overwritten
+        stopped = stop_append_writers()
+        stopped = stop_offsets_flusher() and stopped
+        flush_client_offsets()
+        stopped = stop_compactor() and stopped
+        if not stopped:
+            print("Background threads still running, the next start will scan the active segments")
+        close_all_segments(clean=stopped)
+        if worker_count > 1:
+            os.remove(workers.worker_socket_path(worker_id))
+        print("Broker stopped" if worker_count == 1 else f"Worker {worker_id} stopped")
 
-    async with server:
-        await server.serve_forever()
+def run_workers(worker_count, host, port, metrics_port=METRICS_PORT):
+    """Starts one broker process per worker and stops them all on Ctrl+C or SIGTERM"""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    processes = [multiprocessing.Process(target=run_worker, args=(i, worker_count, host, port, metrics_port)) for i in range(worker_count)]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+    print("Broker stopped")
 
 if __name__ == "__main__":
-    asyncio.run(start_server())
+    parser = argparse.ArgumentParser(description="PyLogStreams broker")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help="broker processes, topics are split between them")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help="serve Prometheus metrics on localhost, worker i on this port + i")
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port, args.metrics_port)
+    else:
+        run_worker(0, 1, args.host, args.port, args.metrics_port)
@@ -0,0 +1,168 @@
+import mmap
+import os
+import threading
+import time
+from log_manager import topics_log_file, segmentCache, get_segment_index, get_offset_from_filename, get_topic_lock
+from compression import RECORD_COMPRESSED, RECORD_SKIP, RECORD_KEYED, RECORD_LENGTH_MASK
+from topic_config import get_topic_config, INTERNAL_TOPIC_PREFIX
+
+COMPACTION_INTERVAL = 30 # Seconds between checks for newly sealed segments of compacted topics
+
+TOMBSTONE_RETENTION = 24*60*60 # Seconds, a tombstone is dropped once its segment is older, consumers had time to see it
+
+COMPACTED_SUFFIX = '.compacted' # Rewritten segment, replaces the segment once complete
+
+compacted_upto = {} # (topic: start offset of the newest sealed segment already compacted)
+
+compactor_stop = threading.Event() # Set on shutdown, the compactor returns after the topic it's rewriting
+
+compactor_thread = None
+
+def record_key(topic, msg_bytes: bytes, keyed: bool):
+    """Returns (key, tombstone) of a message, key is None for messages that are always kept"""
+    if topic.startswith(INTERNAL_TOPIC_PREFIX):
+        # Offset commits: [ts] [id] [topic] [offset], the latest commit of an id and topic wins
+        parts = msg_bytes.split(b' ')
+        if len(parts) != 4:
+            return None, False
+        return parts[1] + b' ' + parts[2], False
+    if not keyed:
+        # Produced without a key, its first word means nothing
+        return None, False
+    # [key] [value], a key with an empty value deletes it
+    key, _, value = msg_bytes.partition(b' ')
+    return key, not value
+
+def scan_records(mm):
+    """Yields (position, end, length with flags) of the records of a sealed segment"""
+    position = 0
+    while position + 4 <= mm.size():
+        length = int.from_bytes(mm[position:position+4], 'big')
+        if length == 0:
+            break
+        end = position + 4 + (length & RECORD_LENGTH_MASK)
+        yield position, end, length
+        position = end
+
+def open_segment(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def compact_topic(topic, hashed):
+    """Keeps only the latest record of every key in the sealed segments of the topic"""
+    sealed = topics_log_file.get(topic, [])[:-1]
+    if not sealed:
+        return
+    # Internal records have no checksum
+    hashed = hashed and not topic.startswith(INTERNAL_TOPIC_PREFIX)
+    # Key: global offset of its latest record
+    latest = {}
+    for segment in sealed:
+        start_offset = get_offset_from_filename(segment[0].name)
+        mm = open_segment(segment[0].name)
+        try:
+            for position, end, length in scan_records(mm):
+                if length & (RECORD_COMPRESSED | RECORD_SKIP):
+                    continue
+                msg_bytes = mm[position+4:end-4] if hashed else mm[position+4:end]
+                key, _ = record_key(topic, msg_bytes, length & RECORD_KEYED)
+                if key is not None:
+                    latest[key] = start_offset + position
+        finally:
+            mm.close()
+    removed = 0
+    for segment in sealed:
+        removed += compact_segment(topic, segment, latest, hashed)
+    compacted_upto[topic] = get_offset_from_filename(sealed[-1][0].name)
+    if removed:
+        print(f"Compacted {topic}: {removed} bytes removed")
+
+def compact_segment(topic, segment, latest, hashed) -> int:
+    """Rewrites the segment without the replaced records, returns the bytes removed.
+    Record positions don't change, each run of removed records becomes one skip record over a hole."""
+    path = segment[0].name
+    start_offset = get_offset_from_filename(path)
+    expire_tombstones = time.time() - segment[2] > TOMBSTONE_RETENTION
+    mm = open_segment(path)
+    try:
+        kept = [] # (position, end)
+        removed = 0
+        records_end = 0
+        for position, end, length in scan_records(mm):
+            records_end = end
+            if length & RECORD_SKIP:
+                continue
+            if not length & RECORD_COMPRESSED:
+                msg_bytes = mm[position+4:end-4] if hashed else mm[position+4:end]
+                key, tombstone = record_key(topic, msg_bytes, length & RECORD_KEYED)
+                if key is not None and (latest[key] != start_offset + position or (tombstone and expire_tombstones)):
+                    removed += end - position
+                    continue
+            kept.append((position, end))
+        if not removed:
+            return 0
+        tmp_path = path + COMPACTED_SUFFIX
+        with open(tmp_path, 'wb') as out:
+            # Same size as the segment, the removed runs stay unallocated
+            out.truncate(mm.size())
+            run_start = 0
+            # Removed records at the end become a skip run too
+            for position, end in kept + [(records_end, None)]:
+                if position > run_start:
+                    # One skip record over the whole run, at most a segment so the length fits the mask
+                    out.seek(run_start)
+                    out.write(((position - run_start - 4) | RECORD_SKIP).to_bytes(4, 'big'))
+                if end is None:
+                    break
+                out.seek(position)
+                out.write(mm[position:end])
+                run_start = end
+            out.flush()
+            os.fsync(out.fileno())
+    finally:
+        mm.close()
+    with get_topic_lock(topic):
+        # Expiry may have dropped the segment meanwhile, replacing it would bring back a file marked for deletion
+        if not any(fp[0].name == path for fp in topics_log_file.get(topic, [])[:-1]):
+            os.remove(tmp_path)
+            return 0
+        # Readers jump with the index, past the skip records. Compacted segments are walked record by record instead.
+        index = get_segment_index(path)
+        index.truncate(0)
+        index.flush()
+        # Readers holding the old mapping still see consistent records, new reads map the compacted file
+        segmentCache.remove(path)
+        os.replace(tmp_path, path)
+    return removed
+
+def compactor(hashed):
+    """Runs in background, compacts the topics with cleanup.policy=compact when they seal a segment"""
+    while not compactor_stop.is_set():
+        for topic, segments in list(topics_log_file.items()):
+            if compactor_stop.is_set():
+                return
+            if get_topic_config(topic.split('/')[0], 'cleanup.policy') != 'compact' or len(segments) < 2:
+                continue
+            if compacted_upto.get(topic) == get_offset_from_filename(segments[-2][0].name):
+                continue
+            try:
+                compact_topic(topic, hashed)
+            except FileNotFoundError:
+                # A segment was deleted meanwhile, retry on the next pass
+                continue
+            except Exception as e:
+                print(f"Can't compact {topic}: {e}")
+        compactor_stop.wait(COMPACTION_INTERVAL)
+
+def start_compactor(hashed):
+    global compactor_thread
+    compactor_thread = threading.Thread(target=compactor, args=(hashed,), daemon=True)
+    compactor_thread.start()
+
+def stop_compactor() -> bool:
+    """Stops the compactor, returns False if it's still rewriting a segment after the timeout"""
+    compactor_stop.set()
+    if compactor_thread is None:
+        return True
+    compactor_thread.join(timeout=30)
+    return not compactor_thread.is_alive()
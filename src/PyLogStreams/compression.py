@@ -0,0 +1,76 @@
+import bz2
+import lzma
+import zlib
+from utility import checksum_verify
+
+# A record whose length has this bit set holds a compressed batch: [1B codec][compressed records][4B checksum].
+# The broker stores and sends it as is, only consumers reading one message at a time get it decompressed.
+RECORD_COMPRESSED = 0x80000000
+
+# A record whose length has this bit set is a run of records removed by compaction, readers jump over it.
+# Only its header is written, the rest of the run is a hole in a sparse file.
+RECORD_SKIP = 0x40000000
+
+# A record whose length has this bit set was produced with a key, [key] [value]. Only keyed records are compacted,
+# a key with an empty value is a tombstone.
+RECORD_KEYED = 0x20000000
+
+RECORD_LENGTH_MASK = 0x1FFFFFFF # Record length without the flag bits
+
+DECOMPRESSED_MAX_BYTES = 16*1024*1024 # 16MB, records of a compressed batch, bigger batches are rejected on append
+
+# Codec id: (compress, decompressor), the id is stored in the record. A decompressor decompresses in bounded steps
+# like zlib.decompressobj(): decompress(data, max_length) and eof, so a small batch can't expand past the limit.
+CODECS = {
+    1: (zlib.compress, zlib.decompressobj),
+    2: (bz2.compress, bz2.BZ2Decompressor),
+    3: (lzma.compress, lzma.LZMADecompressor),
+}
+
+def register_codec(codec: int, compress, decompressor):
+    """Adds a codec, ids are stored on disk so they can't be reused for another codec"""
+    if not 0 < codec < 256 or codec in CODECS:
+        raise ValueError(f"Codec id {codec} is invalid or taken")
+    CODECS[codec] = (compress, decompressor)
+
+def decompress_records(msg_bytes, max_bytes=DECOMPRESSED_MAX_BYTES):
+    """Returns the records of a compressed batch [1B codec][compressed records],
+    None if the codec is unknown, the records can't be decoded or are bigger than max_bytes"""
+    codec = CODECS.get(msg_bytes[0]) if len(msg_bytes) else None
+    if codec is None:
+        return None
+    try:
+        decompressor = codec[1]()
+        records = decompressor.decompress(msg_bytes[1:], max_bytes + 1)
+    except Exception:
+        # zlib.error, OSError, lzma.LZMAError... registered codecs can raise anything
+        return None
+    if len(records) > max_bytes or not decompressor.eof:
+        return None # Too big, or truncated
+    return records
+
+def iter_messages(records, check_hash, verify=True):
+    """Yields the messages of records framed as on disk, compressed batches are expanded.
+    Corrupted, undecodable and compacted records are skipped. Without verify the hashes of records already verified
+    by the append are only removed, the messages inside a compressed batch are still verified."""
+    pos = 0
+    while pos + 4 <= len(records):
+        length = int.from_bytes(records[pos:pos+4], 'big')
+        msg_len = length & RECORD_LENGTH_MASK
+        msg_bytes = records[pos+4:pos+4+msg_len]
+        pos += 4 + msg_len
+        if length & RECORD_SKIP:
+            continue
+        if check_hash:
+            msg_bytes, hash = msg_bytes[:-4], int.from_bytes(msg_bytes[-4:], 'big')
+            if verify and not checksum_verify(msg_bytes, hash):
+                print("Hash verification failed")
+                continue
+        if length & RECORD_COMPRESSED:
+            batch = decompress_records(msg_bytes)
+            if batch is None:
+                print("Compressed batch can't be decoded")
+                continue
+            yield from iter_messages(batch, check_hash)
+        else:
+            yield msg_bytes
@@ -0,0 +1,148 @@
+from bisect import bisect_right
+from compression import iter_messages
+from protocol_v2 import frame_header, OP_RECORDS
+
+TAIL_RING_BYTES = 4*1024*1024 # 4MB, most recent records of a topic kept in memory for the tailing subscribers
+
+FANOUT_MAX_BATCHES = 16 # Shared batches kept per topic for the tailing subscribers
+
+FANOUT_BATCH_BYTES = 32_000 # Max records read into one shared batch
+
+class SharedBatch:
+    """Records of a topic read once and framed once for all the subscribers at the same offset"""
+    def __init__(self, topic: str, records: bytes, next_offset: int, check_hash: bool):
+        self.topic = topic
+        self.records = records
+        self.next_offset = next_offset
+        self.check_hash = check_hash
+        self.batch = None # BAT frame
+        self.binary = None # OP_RECORDS frame for the v2 clients
+        self.frames = None # One frame per message
+        self.count = 0 # Messages in frames
+
+    def batch_frame(self) -> bytes:
+        # BAT [topic] [4B length][message][4B checksum]...
+        if self.batch is None:
+            header = f'BAT {self.topic} '.encode()
+            self.batch = (len(header)+len(self.records)).to_bytes(4,'big') + header + self.records
+        return self.batch
+
+    def binary_frame(self) -> bytes:
+        if self.binary is None:
+            self.binary = frame_header(OP_RECORDS, self.topic.encode(), len(self.records)) + self.records
+        return self.binary
+
+    def message_frames(self) -> bytes:
+        # [4B length][topic] [message]... the records were verified by the append, only their hashes are removed
+        if self.frames is None:
+            try:
+                self.frames, self.count = frame_messages(self.topic, self.records, self.check_hash, verify=False)
+            except Exception as e:
+                # Cached empty, the batch is skipped once for every subscriber instead of failing each of them
+                print(f"Can't decode the records of {self.topic} up to {self.next_offset}: {e}")
+                self.frames, self.count = b'', 0
+        return self.frames
+
+def frame_messages(topic, records, check_hash, verify=True):
+    """Frames every message of the records for a client reading one message per frame,
+    returns the frames and the number of messages"""
+    prefix = f'{topic} '.encode()
+    frames = [(len(prefix)+len(msg_bytes)).to_bytes(4,'big') + prefix + msg_bytes
+              for msg_bytes in iter_messages(memoryview(records), check_hash, verify)]
+    return b''.join(frames), len(frames)
+
+class TailRing:
+    """Most recent appends of a topic, framed as on disk. Filled on the event loop when the append writers
+    complete, the oldest appends are dropped past TAIL_RING_BYTES."""
+    def __init__(self):
+        self.offsets = [] # Offset of each append, ascending
+        self.records = [] # Records of each append, None once dropped
+        self.first = 0 # Index of the oldest append kept, the lists are compacted when half of them is dropped
+        self.end = -1 # Offset after the newest append
+        self.size = 0 # Bytes kept
+
+    def append(self, offset: int, records):
+        if offset != self.end:
+            # The ring must stay contiguous, start over after a gap
+            self.offsets, self.records, self.first, self.size = [], [], 0, 0
+        self.offsets.append(offset)
+        self.records.append(records)
+        self.size += len(records)
+        self.end = offset + len(records)
+        # The newest append is always kept, even if it's bigger than the ring
+        while self.size > TAIL_RING_BYTES and self.first < len(self.records)-1:
+            self.size -= len(self.records[self.first])
+            self.records[self.first] = None
+            self.first += 1
+        if self.first*2 > len(self.records):
+            del self.offsets[:self.first]
+            del self.records[:self.first]
+            self.first = 0
+
+    def read(self, offset: int, max_bytes: int):
+        """Returns the records from offset up to an append boundary that fit in max_bytes (at least up to the end
+        of the first append), None if offset isn't in the ring. offset must be a record boundary."""
+        if self.first == len(self.offsets) or not self.offsets[self.first] <= offset < self.end:
+            return None
+        i = bisect_right(self.offsets, offset, self.first) - 1
+        records = self.records[i]
+        if offset > self.offsets[i]:
+            records = memoryview(records)[offset-self.offsets[i]:]
+        parts = [records]
+        size = len(records)
+        for j in range(i+1, len(self.records)):
+            if size + len(self.records[j]) > max_bytes:
+                break
+            parts.append(self.records[j])
+            size += len(self.records[j])
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+class TopicDispatcher:
+    """Shared batches of one topic cut from its tail ring, keyed by start offset. Subscribers at the same offset
+    share a batch, subscribers behind the ring read the log with their own cursor."""
+    def __init__(self, topic: str, check_hash: bool):
+        self.topic = topic
+        self.check_hash = check_hash
+        self.ring = TailRing()
+        self.batches = {} # (start offset: SharedBatch) oldest first
+        self.hits = 0 # Reads served from memory
+        self.misses = 0 # Reads outside the ring
+
+    def get(self, offset: int) -> SharedBatch:
+        batch = self.batches.get(offset)
+        if batch is None:
+            records = self.ring.read(offset, FANOUT_BATCH_BYTES)
+            if records is None:
+                self.misses += 1
+                return None
+            batch = SharedBatch(self.topic, records, offset+len(records), self.check_hash)
+            self.batches[offset] = batch
+            if len(self.batches) > FANOUT_MAX_BATCHES:
+                del self.batches[next(iter(self.batches))]
+        self.hits += 1
+        return batch
+
+dispatchers = {} # (topic: TopicDispatcher, ...) only topics with subscribers or fetches waiting
+
+def get_dispatcher(topic, check_hash) -> TopicDispatcher:
+    dispatcher = dispatchers.get(topic)
+    if dispatcher is None:
+        dispatcher = dispatchers[topic] = TopicDispatcher(topic, check_hash)
+    return dispatcher
+
+def get_shared_batch(topic, offset, check_hash) -> SharedBatch:
+    """Returns the shared batch of records starting at offset, or None if the subscriber must read it itself"""
+    dispatcher = dispatchers.get(topic)
+    if dispatcher is None:
+        return None
+    return dispatcher.get(offset)
+
+def append_tail(topic, appends, check_hash):
+    """Keeps the records appended to the topic, [(offset, records), ...], in its tail ring"""
+    ring = get_dispatcher(topic, check_hash).ring
+    for offset, records in appends:
+        ring.append(offset, records)
+
+def drop_dispatcher(topic):
+    """Frees the tail ring and shared batches of a topic nobody waits on anymore"""
+    dispatchers.pop(topic, None)
@@ -0,0 +1,71 @@
+from topic_config import topic_logs
+
+GROUP_OFFSETS_PREFIX = 'group:' # Offsets of a group are committed under the id group:[name]
+
+class Group:
+    """Members of a consumer group and the logs assigned to each of them"""
+    def __init__(self, name: str):
+        self.name = name
+        self.offsets_id = GROUP_OFFSETS_PREFIX + name
+        self.members = {} # (client_id: connection) the connection that joined, stale leaves are ignored
+        self.topics = {} # (client_id: {topic, ...})
+        self.assignment = {} # (client_id: [log, ...])
+        self.generation = 0
+
+    def rebalance(self):
+        """Deals the logs of every subscribed topic round-robin to the members subscribed to it"""
+        assignment = {client_id: [] for client_id in self.members}
+        for topic in sorted(set().union(*self.topics.values())):
+            members = sorted(client_id for client_id, topics in self.topics.items() if topic in topics)
+            for i, log in enumerate(topic_logs(topic)):
+                assignment[members[i % len(members)]].append(log)
+        self.assignment = assignment
+        self.generation += 1
+        print(f"Group {self.name} generation {self.generation}: {assignment}")
+
+groups = {} # (name: Group, ...)
+
+client_groups = {} # (client_id: {name, ...})
+
+def join_group(name, client_id, topic, connection) -> Group:
+    group = groups.get(name)
+    if group is None:
+        group = groups[name] = Group(name)
+    if group.members.get(client_id) is not connection:
+        # New member, or the client reconnected
+        group.members[client_id] = connection
+        group.topics[client_id] = set()
+    if topic in group.topics[client_id] and client_id in group.assignment:
+        return group
+    group.topics[client_id].add(topic)
+    client_groups.setdefault(client_id, set()).add(name)
+    group.rebalance()
+    return group
+
+def leave_groups(client_id, connection):
+    """Removes the client from its groups, unless it already joined them again on another connection"""
+    for name in list(client_groups.get(client_id, ())):
+        group = groups[name]
+        if group.members.get(client_id) is not connection:
+            continue
+        del group.members[client_id]
+        del group.topics[client_id]
+        client_groups[client_id].discard(name)
+        if group.members:
+            group.rebalance()
+        else:
+            del groups[name]
+    if not client_groups.get(client_id):
+        client_groups.pop(client_id, None)
+
+def assigned_logs(client_id) -> list:
+    """Returns [(log, offsets id), ...] of the logs assigned to the client in all its groups"""
+    logs = []
+    for name in client_groups.get(client_id, ()):
+        group = groups[name]
+        logs.extend((log, group.offsets_id) for log in group.assignment.get(client_id, ()))
+    return logs
+
+def is_assigned(client_id, offsets_id, log) -> bool:
+    group = groups.get(offsets_id[len(GROUP_OFFSETS_PREFIX):])
+    return group is not None and log in group.assignment.get(client_id, ())
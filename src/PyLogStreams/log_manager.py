@@ -1,23 +1,42 @@
 import time
-import queue
+import heapq
 import mmap
 import os
 import threading
 import platform
 import _io
 from dataclasses import dataclass
-from segment_cache import LRUCache
+from segment_cache import SegmentCache
+from segment_index import OffsetIndex, TimeIndex, index_path, time_index_path
 from utility import set_sequential_hint, checksum_verify
+from compression import RECORD_COMPRESSED, RECORD_SKIP, RECORD_KEYED, RECORD_LENGTH_MASK, CODECS, decompress_records
+import metrics
 
 RETENSION = 5*60*60 # Seconds
 
 GRACE_DELETION_TIME = 5 # Delete file after 5 seconds of being marked
 
+EXPIRY_RETRY_TIME = 60 # Seconds, check a topic again after its expiry check failed
+
 SEGMENT_SIZE = 10*1024*1024 # 10MB, split the segments at 10MB size
 
 SEG_SIZE_INC = 1024*1024 # 1MB, what which size he segments should increase
 
-OLD_SEGMENT_CACHE_SIZE = 1000 # Number of old segments to keep in cache
+OLD_SEGMENT_CACHE_SIZE = 1000 # Number of old segments to keep mapped, each holds one file descriptor
+
+OLD_SEGMENT_CACHE_BYTES = 2*1024*1024*1024 # 2GB, mapped bytes of old segments to keep in cache
+
+MAX_READ_BYTES = 64*1024 # 64KB, default size of a batch returned by read_messages
+
+SENDFILE_MAX_BYTES = 1024*1024 # 1MB, size of a sealed segment range streamed with sendfile
+
+INDEX_INTERVAL_BYTES = 4*1024 # 4KB, add a sparse index entry at most once per 4KB of records
+
+INDEX_MAX_ENTRIES = SEGMENT_SIZE//INDEX_INTERVAL_BYTES + 1
+
+TIME_INDEX_INTERVAL_MS = 1000 # Add a time index entry at most once per second of appends
+
+TIME_INDEX_MAX_ENTRIES = RETENSION*1000//TIME_INDEX_INTERVAL_MS + 1 # Segments roll over at least every RETENSION
 
 # Currently not used
 @dataclass
@@ -30,25 +49,56 @@ class Segment:
 
 topics_log_file = {} # (topic: [Segment, Segment1...], ...)
 
-# release segment caches
+segment_indexes = {} # ('logs/topic/0_log.txt': OffsetIndex, ...) for active and cached segments
+
+time_indexes = {} # ('logs/topic/0_log.txt': TimeIndex, ...) of the active segments
+
+topic_create_lock = threading.Lock()
+
+topic_locks = {} # (topic: Lock) serializes the changes to the segment list of the topic, readers don't take it
+
+topic_retention = {} # (topic: seconds or None) overrides of RETENSION, None keeps records until compacted away
+
+topic_retention_bytes = {} # (topic: bytes) size limit of each log of the topic, the oldest segments are dropped above it
+
+# release segment caches, called by the readers' evictions
 def on_segment_evicted(key, seg: Segment):
+    close_segment_index(key)
     #File is opened
     if seg.f:
         # Close mmap and file
         if seg.mm:
-            seg.mm.close()
+            try:
+                seg.mm.close()
+            except BufferError:
+                # A reader still holds a view, the mapping is released with the last view
+                pass
         seg.f.close()
-segmentCache = LRUCache(OLD_SEGMENT_CACHE_SIZE, on_segment_evicted)
+segmentCache = SegmentCache(OLD_SEGMENT_CACHE_SIZE, OLD_SEGMENT_CACHE_BYTES, on_segment_evicted)
 
 # Only keeps the latest offset of active segment
 segments_write_offset = {} # ('files/topic/seg1.txt': 0230, ...)
 
-delete_file_queue = queue.Queue() # FIFO thread safe queue for deleting the files
+delete_file_heap = [] # [(deletion_time, path), ...] min-heap of the files marked for deletion
+
+delete_file_cond = threading.Condition() # Guards delete_file_heap, notified when a file is marked
+
+expiry_heap = [] # [(deadline, topic), ...] min-heap of the next time each topic may have segments to drop
+
+expiry_deadlines = {} # (topic: deadline) the live entry of the topic in expiry_heap, the others are stale
+
+expiry_cond = threading.Condition() # Guards the expiry heap, notified when an earlier deadline is scheduled
 
 LOG_FILE_DIR = 'logs'
 if not os.path.isdir(LOG_FILE_DIR):
     os.makedirs(LOG_FILE_DIR)
 
+MANIFEST_FILE = 'manifest.txt' # Segment metadata of a topic, written on rollover and clean shutdown
+
+PARTITION_PREFIX = 'partition-' # Partition logs are stored in logs/[topic]/partition-[n]/
+
+CLEAN_SHUTDOWN_FILE = '.clean_shutdown' # In the topic directory, exists only after close_all_segments wrote its manifest
+
 def get_file_birthtime(st: os.stat_result) -> float:
     """os.stat_result object as input """
     if hasattr(st, "st_birthtime"):
@@ -56,46 +106,174 @@ def get_file_birthtime(st: os.stat_result) -> float:
     else:
         return st.st_ctime       # fallback for Windows
 
-def load_topics_log():
+class SealedFile:
+    """Stands in for the file handle of a sealed segment loaded from the manifest, only the name is used"""
+    def __init__(self, name: str):
+        self.name = name
+
+    def close(self):
+        pass
+
+def list_topic_logs(owns=None) -> list:
+    """Returns the logs found in the logs directory, partitions are logged as [topic]/partition-[n]"""
+    logs = []
     for topic in os.listdir(LOG_FILE_DIR):
         topic_dir = os.path.join(LOG_FILE_DIR,topic)
-        segments = os.listdir(topic_dir)
-        files = []
-        for seg in segments[:-1]:
-            f = open(os.path.join(topic_dir,seg), 'r')
-            st = os.stat(f.fileno())
-            f.close()
-            files.append((f, None,get_file_birthtime(st), st.st_size, -1))
+        if not os.path.isdir(topic_dir) or (owns and not owns(topic)):
+            continue
+        logs.append(topic)
+        for partition in os.listdir(topic_dir):
+            if partition.startswith(PARTITION_PREFIX) and os.path.isdir(os.path.join(topic_dir, partition)):
+                logs.append(f"{topic}/{partition}")
+    return logs
+
+def load_topics_log(owns=None):
+    """Loads the topics found in the logs directory, only those accepted by owns(topic) if given"""
+    for topic in list_topic_logs(owns):
+        topic_dir = os.path.join(LOG_FILE_DIR,topic)
+        # Active segments are trusted without scanning only after a clean shutdown
+        clean_marker = os.path.join(topic_dir, CLEAN_SHUTDOWN_FILE)
+        clean_shutdown = os.path.exists(clean_marker)
+        # Skip the sidecar index and manifest files, listdir order is arbitrary
+        segments = sorted((seg for seg in os.listdir(topic_dir) if seg.endswith('_log.txt')), key=get_offset_from_filename)
         if len(segments) == 0:
             continue
+        manifest = read_manifest(topic)
+        files = []
+        for i, seg in enumerate(segments[:-1]):
+            filepath = os.path.join(topic_dir,seg)
+            start_offset = get_offset_from_filename(seg)
+            # A sealed segment ends where the next one starts
+            end_offset = get_offset_from_filename(segments[i+1])
+            if start_offset in manifest:
+                create_time, filesize, _ = manifest[start_offset]
+            else:
+                st = os.stat(filepath)
+                create_time, filesize = get_file_birthtime(st), st.st_size
+            files.append((SealedFile(filepath), None, create_time, filesize, end_offset))
         f = open(os.path.join(topic_dir, segments[-1]), 'r+b')
-        st = os.stat(f.fileno())
         mm = mmap.mmap(f.fileno(),0)
-        write_offset = get_write_offset(f,mm)
-        files.append((f, mm, get_file_birthtime(st), st.st_size, write_offset))
+        start_offset = get_offset_from_filename(f.name)
+        if start_offset in manifest:
+            create_time, _, write_offset = manifest[start_offset]
+        else:
+            create_time, write_offset = get_file_birthtime(os.stat(f.fileno())), -1
+        if not clean_shutdown or write_offset < start_offset:
+            # Crash recovery, scan the active segment past its last index entry
+            write_offset = start_offset + get_write_offset(mm, get_segment_index(f.name))
+            # Time entries of records lost in the crash would point past them
+            time_index = get_time_index(f.name)
+            while time_index.entries > 0 and time_index.last_position() >= write_offset - start_offset:
+                time_index.truncate(time_index.entries-1)
+        else:
+            get_segment_index(f.name)
+        files.append((f, mm, create_time, mm.size(), write_offset))
         topics_log_file[topic] = files
-
-def get_write_offset(f, mm):
-    # Find write_offset (end of log)
-    write_offset = 0
+        schedule_expiry(topic)
+        if clean_shutdown:
+            os.remove(clean_marker)
+
+def read_manifest(topic) -> dict:
+    """Returns {start_offset: (create_time, filesize, write_offset)} from the topic manifest"""
+    manifest = {}
+    path = os.path.join(LOG_FILE_DIR, topic, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return manifest
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split(' ')
+            if len(parts)!=4:
+                continue
+            manifest[int(parts[0])] = (float(parts[1]), int(parts[2]), int(parts[3]))
+    return manifest
+
+def write_manifest(topic):
+    """Atomically writes [start_offset] [create_time] [filesize] [write_offset] for every segment of the topic"""
+    segments = topics_log_file.get(topic, [])
+    path = os.path.join(LOG_FILE_DIR, topic, MANIFEST_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for seg in segments:
+            filesize = seg[1].size() if seg[1] is not None else seg[3]
+            f.write(f"{get_offset_from_filename(seg[0].name)} {seg[2]} {filesize} {seg[4]}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def get_write_offset(mm, index: OffsetIndex):
+    """Returns the end of log inside the segment, scanning only past the last index entry"""
+    # Drop index entries that point past the written records (e.g. index persisted, segment not)
+    while index.entries > 0:
+        position = index.last_position()
+        if position + 4 <= mm.size() and mm[position:position+4] != b'\x00\x00\x00\x00':
+            break
+        index.truncate(index.entries-1)
+    write_offset = index.last_position()
+    last_indexed = write_offset
     while write_offset + 4 <= mm.size():
         length_bytes = mm[write_offset:write_offset+4]
         if not length_bytes or length_bytes == b'\x00\x00\x00\x00':
             break
-        msg_len = int.from_bytes(length_bytes, 'big')
-        write_offset += 4+msg_len
+        length = int.from_bytes(length_bytes, 'big')
+        if length & RECORD_SKIP:
+            # Compacted segments keep no index entries, readers must walk into every skip record
+            index.truncate(0)
+            last_indexed = None
+        # Rebuild missing index entries while scanning
+        if last_indexed is not None and write_offset - last_indexed >= INDEX_INTERVAL_BYTES:
+            index.append(write_offset)
+            last_indexed = write_offset
+        write_offset += 4+(length & RECORD_LENGTH_MASK)
     return write_offset
 
+def get_segment_index(filename: str) -> OffsetIndex:
+    """Returns the offset index of a segment, opening it on first use"""
+    index = segment_indexes.get(filename)
+    if index is None:
+        index = OffsetIndex(index_path(filename), INDEX_MAX_ENTRIES)
+        segment_indexes[filename] = index
+    return index
+
+def get_time_index(filename: str) -> TimeIndex:
+    index = time_indexes.get(filename)
+    if index is None:
+        index = TimeIndex(time_index_path(filename), TIME_INDEX_MAX_ENTRIES)
+        time_indexes[filename] = index
+    return index
+
+def close_segment_index(filename: str):
+    for indexes in (segment_indexes, time_indexes):
+        index = indexes.pop(filename, None)
+        if index:
+            index.close()
+
+def index_append_time(filename: str, position: int):
+    # One entry per TIME_INDEX_INTERVAL_MS, at the first record appended after it
+    time_index = get_time_index(filename)
+    now_ms = int(time.time()*1000)
+    if now_ms - time_index.last_time() >= TIME_INDEX_INTERVAL_MS:
+        time_index.append(now_ms, position)
+
+def get_topic_lock(topic) -> threading.Lock:
+    lock = topic_locks.get(topic)
+    if lock is None:
+        # setdefault is atomic, topic_create_lock may already be held by the caller
+        lock = topic_locks.setdefault(topic, threading.Lock())
+    return lock
+
 def get_topic_log(topic, offset=-1):
     # Return the segment with offset and also it's index
     # offset=-1 returns the active segment
     if topic not in topics_log_file:
-        topic_dir = os.path.join(LOG_FILE_DIR, topic)
-        if not os.path.isdir(topic_dir):
-            os.makedirs(topic_dir)
-        rollover_file(topic)
-    l,r = 0, len(topics_log_file[topic])-1
+        # Readers on the event loop and the append writers can both create a topic
+        with topic_create_lock:
+            if topic not in topics_log_file:
+                topic_dir = os.path.join(LOG_FILE_DIR, topic)
+                if not os.path.isdir(topic_dir):
+                    os.makedirs(topic_dir)
+                rollover_file(topic)
     topics_list = topics_log_file[topic]
+    l,r = 0, len(topics_list)-1
     index = r
     if offset!=-1:
         while l <= r:
@@ -117,50 +295,89 @@ def get_topic_log(topic, offset=-1):
         else:
             # Load from file
             filename = __segment[0].name
-            f = open(filename, 'r+b')
-            mm = mmap.mmap(f.fileno(), 0)
+            # Sealed segments are never written again, map them read-only. The mapping keeps its own descriptor
+            with open(filename, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             # Save to cache
-            segmentCache.put(cache_key, Segment(f, mm, __segment[2], __segment[3], __segment[4]))
+            segmentCache.put(cache_key, Segment(f, mm, __segment[2], __segment[3], __segment[4]), len(mm))
             return (f, mm, __segment[2], __segment[3], __segment[4], index)
 
     return __segment + (index,) # Include index in return tuple
 
 def rollover_file(topic):
-    segment_list = []
-    if topic in topics_log_file:
-        segment_list = topics_log_file[topic]
-    else:
-        topics_log_file[topic] = []
-    active_seg = None
-    if len(segment_list) > 0:
-        active_seg = segment_list[-1]
-    # Closing active segment if it's exists and opened
-    if (active_seg and active_seg[1] is not None):  # Checking if mmap is None
-        active_seg[1].close()
-        active_seg[0].close()
-        topics_log_file[topic][-1] = (active_seg[0], None, active_seg[2], active_seg[3], active_seg[4])
-    start_offset = 0
-    # If there's previous segment then updating new write offset
-    if active_seg:
-        start_offset = active_seg[4]
-    filepath = os.path.join(LOG_FILE_DIR,topic,f"{str(start_offset)}_log.txt")
-    #Create file if it doesn't exist
-    if not os.path.exists(filepath):
-        with open(filepath, 'wb') as f:
-            f.truncate(SEG_SIZE_INC) # 1MB initial size
-    f = open(filepath, 'r+b')
-    # Hint to OS for sequential access
-    mm = mmap.mmap(f.fileno(), 0)
-    set_sequential_hint(mm,f.fileno())
-    __segment = (f,mm,time.time(), SEG_SIZE_INC, start_offset)
-    new_segment_list = topics_log_file[topic] + [__segment]
-    # Reference swap with new list
-    topics_log_file[topic] = new_segment_list
-    return __segment
+    # The list is read and swapped under the topic lock, expiry can't drop segments during the flush and have them put back
+    with get_topic_lock(topic):
+        segment_list = topics_log_file.get(topic, [])
+        active_seg = None
+        if len(segment_list) > 0:
+            active_seg = segment_list[-1]
+        # Sealing active segment if it's exists and opened
+        if (active_seg and active_seg[1] is not None):  # Checking if mmap is None
+            filesize = active_seg[1].size()
+            # Group commits only fsync the active segment, records acked as fsynced may still be in this one
+            flush_segment(active_seg[0], active_seg[1])
+            # No more appends, seeks by time open the sealed time index on demand. Dropped, not closed, like the mapping.
+            time_indexes.pop(active_seg[0].name, None)
+            # Readers on the event loop may still be slicing the mapping, it's released with their last reference instead of
+            # closed here. The cache is only filled and evicted by the readers, they map the sealed segment again read-only.
+            segment_list[-1] = (SealedFile(active_seg[0].name), None, active_seg[2], filesize, active_seg[4])
+            active_seg[0].close()
+        start_offset = 0
+        # If there's previous segment then updating new write offset
+        if active_seg:
+            start_offset = active_seg[4]
+        filepath = os.path.join(LOG_FILE_DIR,topic,f"{str(start_offset)}_log.txt")
+        #Create file if it doesn't exist
+        if not os.path.exists(filepath):
+            with open(filepath, 'wb') as f:
+                f.truncate(SEG_SIZE_INC) # 1MB initial size
+        f = open(filepath, 'r+b')
+        # Hint to OS for sequential access
+        mm = mmap.mmap(f.fileno(), 0)
+        set_sequential_hint(mm,f.fileno())
+        get_segment_index(f.name)
+        __segment = (f,mm,time.time(), SEG_SIZE_INC, start_offset)
+        new_segment_list = segment_list + [__segment]
+        # Reference swap with new list
+        topics_log_file[topic] = new_segment_list
+        write_manifest(topic)
+        if active_seg:
+            # A sealed segment can expire, and the topic grew
+            schedule_expiry(topic)
+        return __segment
+
+def reserve_space(topic, size):
+    """Returns the active segment with room for size more bytes, growing or rolling it over if needed"""
+    # We are ignoring index because list size can change while appending the message
+    f,mm,create_time,filesize,write_offset, _ = get_topic_log(topic)
+    file_write_offset = write_offset - get_offset_from_filename(f.name)
+    # Check if we need to rollover
+    #Expiry check, a topic with a shorter retention rolls over sooner so its records don't outlive it
+    # An empty segment isn't rolled, the next one would start at the same offset
+    if file_write_offset > 0 and (time.time() - create_time) >= min(RETENSION, get_retention(topic) or RETENSION):
+        f,mm,create_time,filesize,write_offset = rollover_file(topic)
+        file_write_offset = 0
+    #Size check
+    while file_write_offset + size > mm.size():
+        # An empty segment always grows, so records bigger than a segment still fit somewhere
+        if mm.size() + SEG_SIZE_INC <= SEGMENT_SIZE or file_write_offset == 0:
+            # mmap.resize extends the file too, no need to write the zeros ourselves
+            mm.resize(mm.size() + SEG_SIZE_INC)
+        else:
+            # Size limit reached for the segment
+            f,mm,create_time,filesize,write_offset = rollover_file(topic)
+            file_write_offset = 0
+    return f,mm,create_time,filesize,write_offset
 
-""" Take topic, message in bytes, and checksum. Stores it and returns the result code """
-# Appended message framing [msg_bytes][4 bytes hash]
-def append_message(topic, msg_bytes, hash=None) -> int: # Result code
+def frame_record(msg_bytes, hash=None, keyed=False) -> bytes:
+    """Frames a message as stored by append_message, [4B length][msg_bytes][4B hash]"""
+    if hash:
+        # Append the hash at last of message
+        msg_bytes += hash
+    return (len(msg_bytes) | (RECORD_KEYED if keyed else 0)).to_bytes(4,'big') + msg_bytes
+
+def check_message(msg_bytes, hash=None) -> int: # Result code
+    """Validates a message before it is framed, 0 if it can be appended"""
     if not msg_bytes or msg_bytes==b'':
         return 1 # Invalid message
     if hash and len(hash)!=4:
@@ -169,40 +386,81 @@ def append_message(topic, msg_bytes, hash=None) -> int: # Result code
     if hash:
         if not checksum_verify(msg_bytes, int.from_bytes(hash, 'big')):
             return 2 # Corrupted message
-        # Append the hash at last of message
-        msg_bytes += hash
+    return 0
 
-    # We are ignoring index because list size can change while appending the message
-    f,mm,create_time,filesize,write_offset, _ = get_topic_log(topic)
-    file_start_offset = get_offset_from_filename(f.name)
-    file_write_offset = write_offset-file_start_offset
-    msg_len = len(msg_bytes)
-    # Check if we need to rollover
-    #Expiry check
-    if (time.time() - create_time) >= RETENSION:
-        f,mm,create_time,filesize,write_offset = rollover_file(topic)
-        file_start_offset = get_offset_from_filename(f.name)
-        file_write_offset = write_offset - file_start_offset
-    #Size check
-    if file_write_offset + 4 + msg_len > mm.size():
-        if mm.size() + SEG_SIZE_INC <= SEGMENT_SIZE:
-            # Resize file and mmap here
-            f.seek(0, os.SEEK_END)
-            f.write(b'\x00'*(SEG_SIZE_INC)) # Add EXTRA_SIZE
-            mm.resize(mm.size() + SEG_SIZE_INC)
-        else:
-            # Size limit reached for the segment
-            # Updating vars
-            f,mm,create_time,filesize,write_offset = rollover_file(topic)
-            file_start_offset = get_offset_from_filename(f.name)
-            file_write_offset = write_offset - file_start_offset
+""" Take topic, message in bytes, and checksum. Stores it and returns the result code """
+# Appended message framing [msg_bytes][4 bytes hash]
+def append_message(topic, msg_bytes, hash=None, keyed=False) -> int: # Result code
+    code = check_message(msg_bytes, hash)
+    if code:
+        return code
+    append_record(topic, frame_record(msg_bytes, hash, keyed))
+    return 0 # Success
 
-    mm[file_write_offset:file_write_offset+4] = msg_len.to_bytes(4,'big')
-    mm[file_write_offset+4:file_write_offset+4+msg_len] = msg_bytes
+def append_record(topic, record):
+    """Stores a single record already framed by frame_record"""
+    msg_len = len(record) - 4
+    f,mm,create_time,filesize,write_offset = reserve_space(topic, 4+msg_len)
+    file_write_offset = write_offset - get_offset_from_filename(f.name)
+
+    mm[file_write_offset:file_write_offset+4+msg_len] = record
+    index = get_segment_index(f.name)
+    if file_write_offset - index.last_position() >= INDEX_INTERVAL_BYTES:
+        index.append(file_write_offset)
+    index_append_time(f.name, file_write_offset)
     # #Flush changes to file
     # mm.flush()
-    # Updating the last element
-    topics_log_file[topic][-1] = (f,mm,create_time,filesize,write_offset+4+msg_len)
+    # Updating the last element, in the list expiry may have just swapped
+    with get_topic_lock(topic):
+        topics_log_file[topic][-1] = (f,mm,create_time,filesize,write_offset+4+msg_len)
+    metrics.count_in(topic, 4+msg_len)
+
+""" Take topic and records already framed as on disk, verifies and stores them with a single write """
+# Batch framing [4 bytes length][msg_bytes][4 bytes hash]...  hash only if hashed
+def append_batch(topic, batch_bytes, hashed=True) -> int: # Result code
+    if not batch_bytes:
+        return 1 # Invalid message
+    batch = memoryview(batch_bytes)
+    batch_len = len(batch)
+    # Record positions inside the batch, needed for the offset index
+    positions = []
+    pos = 0
+    while pos < batch_len:
+        if pos + 4 > batch_len:
+            return 1 # Truncated record header
+        length = int.from_bytes(batch[pos:pos+4], 'big')
+        msg_len = length & RECORD_LENGTH_MASK
+        if msg_len == 0 or pos + 4 + msg_len > batch_len:
+            return 1 # Empty or truncated record
+        if length & ~(RECORD_LENGTH_MASK | RECORD_COMPRESSED):
+            return 1 # Skip and keyed records are only written by the broker
+        if length & RECORD_COMPRESSED and batch[pos+4] not in CODECS:
+            return 1 # Unknown codec, the checksum covers [codec][compressed records] and is checked below
+        if hashed:
+            if msg_len <= 4:
+                return 3 # Invalid hash
+            hash_pos = pos + msg_len # Start of last 4 bytes of the record
+            if not checksum_verify(batch[pos+4:hash_pos], int.from_bytes(batch[hash_pos:hash_pos+4], 'big')):
+                return 2 # Corrupted message
+        if length & RECORD_COMPRESSED:
+            # A valid checksum doesn't make the body decodable, a bad one would stall every per-message reader.
+            # Decoded in bounded steps, a small batch expanding to gigabytes is rejected at DECOMPRESSED_MAX_BYTES.
+            if decompress_records(batch[pos+4:pos+msg_len if hashed else pos+4+msg_len]) is None:
+                return 1 # Undecodable or too big compressed batch
+        positions.append(pos)
+        pos += 4 + msg_len
+
+    f,mm,create_time,filesize,write_offset = reserve_space(topic, batch_len)
+    file_write_offset = write_offset - get_offset_from_filename(f.name)
+    mm[file_write_offset:file_write_offset+batch_len] = batch
+    index = get_segment_index(f.name)
+    for pos in positions:
+        if file_write_offset + pos - index.last_position() >= INDEX_INTERVAL_BYTES:
+            index.append(file_write_offset + pos)
+    index_append_time(f.name, file_write_offset)
+    with get_topic_lock(topic):
+        topics_log_file[topic][-1] = (f,mm,create_time,filesize,write_offset+batch_len)
+    metrics.count_in(topic, batch_len, len(positions))
     return 0 # Success
 
 def get_oldest_offset(topic):
@@ -212,7 +470,7 @@ def get_oldest_offset(topic):
     while l<r:
         mid = l + (r-l)//2
         created_time = topics_log_file[topic][mid][2]
-        if created_time > time.time() - RETENSION:
+        if not is_expired(topic, created_time):
             r = mid
         else:
             l = mid + 1
@@ -226,6 +484,78 @@ def get_latest_offset(topic):
     write_offset = last_segment[4]
     return write_offset
 
+def find_record_offset(topic, offset):
+    """Returns the offset of the record boundary at or before offset"""
+    latest_offset = get_latest_offset(topic)
+    if offset >= latest_offset:
+        return latest_offset
+    segment = get_topic_log(topic, offset)
+    start_offset = get_offset_from_filename(segment[0].name)
+    if offset <= start_offset:
+        return start_offset
+    mm = segment[1]
+    index = get_segment_index(segment[0].name)
+    if index.created and segment[5] < len(topics_log_file[topic])-1:
+        # Index file was missing for this old segment, build it once
+        get_write_offset(mm, index)
+        index.created = False
+    file_offset = offset - start_offset
+    position = index.lookup(file_offset)
+    # Walk the records between the index entry and the requested offset
+    while position + 4 <= mm.size():
+        length_bytes = mm[position:position+4]
+        if length_bytes == b'\x00\x00\x00\x00':
+            break
+        next_position = position + 4 + (int.from_bytes(length_bytes, 'big') & RECORD_LENGTH_MASK)
+        if next_position > file_offset:
+            break
+        position = next_position
+    return start_offset + position
+
+def find_time_offset(topic, timestamp_ms):
+    """Returns the offset of the first record appended at or after timestamp_ms, or of a record
+    appended less than TIME_INDEX_INTERVAL_MS before it"""
+    segments = topics_log_file.get(topic)
+    if not segments:
+        return 0
+    # Last segment created at or before the time, the records of the later ones are all newer
+    l, r = 0, len(segments)-1
+    index = -1
+    while l <= r:
+        mid = l + (r-l)//2
+        if segments[mid][2]*1000 <= timestamp_ms:
+            index = mid
+            l = mid + 1
+        else:
+            r = mid - 1
+    if index == -1:
+        return get_oldest_offset(topic)
+    filename = segments[index][0].name
+    # Only the writer opens and registers the index of the active segment, it may just have been sealed
+    time_index = time_indexes.get(filename)
+    if time_index is not None:
+        position = time_index.lookup(timestamp_ms, TIME_INDEX_INTERVAL_MS)
+    else:
+        position = lookup_sealed_time(filename, timestamp_ms)
+    if position == -1:
+        # Every record of the segment is older, start at the next one
+        return segments[index][4] if index < len(segments)-1 else get_latest_offset(topic)
+    # Compaction can turn the record into part of a skip run, snap to its start
+    return max(get_oldest_offset(topic), find_record_offset(topic, get_offset_from_filename(filename) + position))
+
+def lookup_sealed_time(filename, timestamp_ms):
+    """Looks up the time index of a sealed segment, opened read-only for the seek. Seeks by time are rare,
+    sealed segments keep no time index open, and a read never creates one."""
+    try:
+        time_index = TimeIndex(time_index_path(filename), TIME_INDEX_MAX_ENTRIES, read_only=True)
+    except (FileNotFoundError, ValueError):
+        # No index (empty file can't be mapped), every record of the segment may be newer
+        return 0
+    try:
+        return time_index.lookup(timestamp_ms, TIME_INDEX_INTERVAL_MS)
+    finally:
+        time_index.close()
+
 def check_message_available(topic, offset):
     return offset < get_latest_offset(topic)
 
@@ -244,14 +574,17 @@ def read_message(topic, offset=0, check_hash=False):
         # Something wrong, offset out of range
         return None, get_latest_offset(topic) # Returns the latest offset available
     length_bytes = mm[file_offset: file_offset+4]
-    retained_time = time.time() - segment[2]
     if not length_bytes or length_bytes==b'\x00\x00\x00\x00':
         return None, offset
     # Check if the segment is expired
-    if retained_time > RETENSION:
+    if is_expired(topic, segment[2]):
         return None, get_oldest_offset(topic) # Returns the oldest offset available
 
-    msg_len = int.from_bytes(length_bytes, 'big')
+    length = int.from_bytes(length_bytes, 'big')
+    msg_len = length & RECORD_LENGTH_MASK
+    if length & (RECORD_COMPRESSED | RECORD_SKIP):
+        # One message at a time can't represent a batch, read it with read_messages. Compacted runs are jumped over.
+        return None, offset+4+msg_len
     read_bytes = mm[file_offset+4: file_offset+4+msg_len]
     if check_hash:
         msg_bytes = read_bytes[:-4]
@@ -263,10 +596,83 @@ def read_message(topic, offset=0, check_hash=False):
             return None, offset+4+msg_len # Message got corrupted return the next offset
     else:
         msg_bytes = read_bytes
-    return msg_bytes.decode(), offset+4+msg_len
+    return msg_bytes, offset+4+msg_len
+
+def locate_records(topic, offset, max_bytes):
+    """Finds the whole records starting at offset that fit in max_bytes (at least one record).
+    Returns the segment, the records position and length inside it, and the next offset."""
+    segment = get_topic_log(topic, offset)
+    start_offset = get_offset_from_filename(segment[0].name)
+    file_offset = offset-start_offset
+    mm = segment[1]
+    # Only the active segment has a live write offset
+    if segment[5] == len(topics_log_file[topic])-1:
+        end = segment[4]-start_offset
+        if file_offset >= end:
+            return None, 0, 0, offset # Offset out of range
+    else:
+        end = mm.size()
+    if file_offset + 4 > mm.size():
+        # Something wrong, offset out of range
+        return None, 0, 0, get_latest_offset(topic) # Returns the latest offset available
+    # Check if the segment is expired
+    if is_expired(topic, segment[2]):
+        return None, 0, 0, get_oldest_offset(topic) # Returns the oldest offset available
+
+    limit = min(end, file_offset + max_bytes)
+    # Jump close to the limit with the offset index, then walk the remaining records
+    position = max(file_offset, get_segment_index(segment[0].name).lookup(limit))
+    while position + 4 <= end:
+        length = int.from_bytes(mm[position:position+4], 'big')
+        if length == 0:
+            break
+        next_position = position + 4 + (length & RECORD_LENGTH_MASK)
+        if length & RECORD_SKIP:
+            # Compacted segments have no index entries, so a skip record is always walked into
+            if position > file_offset:
+                break # Range ends before the compacted run
+            # Leading compacted run, the range starts after it
+            file_offset = position = next_position
+            limit = min(end, file_offset + max_bytes)
+            continue
+        # Always return the first record, even if it's bigger than max_bytes
+        if next_position > end or (next_position > limit and position > file_offset):
+            break
+        position = next_position
+    if position == file_offset:
+        return None, 0, 0, start_offset+file_offset
+    return segment, file_offset, position-file_offset, start_offset+position
+
+def read_messages(topic, offset=0, max_bytes=MAX_READ_BYTES):
+    """Returns a memoryview over the whole records starting at offset that fit in max_bytes
+    (at least one record), and the next offset. Records keep their disk framing
+    [4B length][message][4B hash], nothing is decoded or verified here."""
+    segment, file_offset, length, next_offset = locate_records(topic, offset, max_bytes)
+    if segment is None:
+        return None, next_offset
+    if segment[5] == len(topics_log_file[topic])-1:
+        # The active mapping is resized by the append writers, an exported view would make resize fail
+        return memoryview(segment[1][file_offset:file_offset+length]), next_offset
+    return memoryview(segment[1])[file_offset:file_offset+length], next_offset
+
+def read_segment_range(topic, offset=0, max_bytes=SENDFILE_MAX_BYTES):
+    """Same as read_messages but returns the segment path, position and length of the records,
+    so they can be streamed from the file with sendfile. Disk framing equals batch wire framing."""
+    segment, file_offset, length, next_offset = locate_records(topic, offset, max_bytes)
+    if segment is None:
+        return None, 0, 0, next_offset
+    return segment[0].name, file_offset, length, next_offset
+
+def get_active_segment_offset(topic):
+    """Returns the start offset of the active segment, offsets below it are in sealed segments"""
+    if topic not in topics_log_file or len(topics_log_file[topic])==0:
+        return 0
+    return get_offset_from_filename(topics_log_file[topic][-1][0].name)
 
 def mark_file(f, mm, deletion_time):
-    delete_file_queue.put((f.name,deletion_time))
+    with delete_file_cond:
+        heapq.heappush(delete_file_heap, (deletion_time, f.name))
+        delete_file_cond.notify()
 
 def get_offset_from_filename(filename: str) -> int:
     # filename: /logs/topic/001010_log.txt -> 1010
@@ -275,55 +681,121 @@ def get_offset_from_filename(filename: str) -> int:
     return offset
 
 
+def get_retention(topic):
+    # Partitions share the retention of their topic
+    return topic_retention.get(topic.split('/')[0], RETENSION)
+
+def is_expired(topic, create_time) -> bool:
+    retention = get_retention(topic)
+    return retention is not None and time.time() - create_time > retention
+
+def get_retention_bytes(topic):
+    return topic_retention_bytes.get(topic.split('/')[0])
+
+def schedule_expiry(topic, deadline=0):
+    """Makes the cleaner check the topic at deadline, now by default. Later deadlines than the scheduled one are ignored,
+    the check schedules the next one itself."""
+    with expiry_cond:
+        if deadline >= expiry_deadlines.get(topic, float('inf')):
+            return
+        expiry_deadlines[topic] = deadline
+        heapq.heappush(expiry_heap, (deadline, topic))
+        expiry_cond.notify()
+
+def expire_segments(topic):
+    """Marks for deletion the sealed segments of the topic that expired or are over its size limit,
+    returns when the oldest remaining one expires or None"""
+    retention = get_retention(topic)
+    max_bytes = get_retention_bytes(topic)
+    now = time.time()
+    # Rollover swaps the list too, a segment dropped here must not be put back
+    with get_topic_lock(topic):
+        files = topics_log_file.get(topic)
+        if not files:
+            return None
+        # Bytes written, not the mapped size which grows by SEG_SIZE_INC ahead of the appends
+        sizes = [fp[4] - get_offset_from_filename(fp[0].name) for fp in files]
+        total_bytes = sum(sizes)
+        # Segments are sorted by creation, the active one is never dropped
+        expired = 0
+        for fp, size in zip(files[:-1], sizes):
+            if (retention is None or fp[2] + retention > now) and (max_bytes is None or total_bytes <= max_bytes):
+                break
+            total_bytes -= size
+            expired += 1
+        if expired:
+            topics_log_file[topic] = files[expired:] # Reference swap, readers keep the list they hold
+            for fp in files[:expired]:
+                mark_file(fp[0], fp[1], now+GRACE_DELETION_TIME)
+        remaining = topics_log_file[topic]
+    if retention is None or len(remaining) < 2:
+        return None # Rolling over schedules the next check
+    return remaining[0][2] + retention
+
 def log_cleaner():
-    """Runs in background, checks expired logsegments and mark them deletion"""
+    """Runs in background, checks each topic when its oldest segment expires or it rolled over"""
     while True:
-        expired_time = time.time() - RETENSION
-        for topic, files in list(topics_log_file.items()):
-            old_files = files
-            l ,r=0, len(files)-2
-            index = -1
-            while (l<=r):
-                mid = l + (r-l)//2
-                created_time = files[mid][2]
-                if (created_time < expired_time):
-                    l = mid+1
-                    index = mid
-                else:
-                    r = mid-1
-            new_files = []
-            expired_files = []
-            for i in range(0, len(files)):
-                if i>index:
-                    new_files.append(files[i])
-                else:
-                    expired_files.append(files[i])
-            if topics_log_file[topic] is old_files:
-                topics_log_file[topic] = new_files # Perform atomic swap or reference swap
-                for fp in expired_files:
-                    mark_file(fp[0],fp[1],fp[2]+RETENSION+GRACE_DELETION_TIME)
-        time.sleep(1)  # Runs on every 1 seconds
+        with expiry_cond:
+            while not expiry_heap or expiry_heap[0][0] > time.time():
+                expiry_cond.wait(expiry_heap[0][0] - time.time() if expiry_heap else None)
+            deadline, topic = heapq.heappop(expiry_heap)
+            if expiry_deadlines.get(topic) != deadline:
+                continue # Replaced by an earlier deadline that was already handled
+            del expiry_deadlines[topic]
+        check_expiry(topic)
+
+def check_expiry(topic):
+    """Expires the segments of a topic popped from the heap and schedules its next check, a failed check is retried"""
+    next_deadline = time.time() + EXPIRY_RETRY_TIME
+    try:
+        next_deadline = expire_segments(topic)
+    except Exception as e:
+        print(f"Can't expire segments of {topic}: {e}")
+    finally:
+        # Popped from the heap, a failed check must not leave the topic unscheduled
+        if next_deadline is not None:
+            schedule_expiry(topic, next_deadline)
 
 def file_remover():
-    """Runs in background, delete files that were marked."""
+    """Runs in background, delete files that were marked, in deletion time order."""
     while True:
-        try:
-            path,deletion_time = delete_file_queue.get(timeout=1)
-        except queue.Empty:
-            continue
-        time_pending = deletion_time - time.time()
-        if (time_pending > 0):
-            time.sleep(time_pending)
-        try:
-            # Remove from segment cache if exists
-            segmentCache.remove(path)
-            os.remove(path)
-        except Exception as e:
-            print(f"Can't delete file {e}")
+        with delete_file_cond:
+            while not delete_file_heap or delete_file_heap[0][0] > time.time():
+                delete_file_cond.wait(delete_file_heap[0][0] - time.time() if delete_file_heap else None)
+            due = []
+            while delete_file_heap and delete_file_heap[0][0] <= time.time():
+                due.append(heapq.heappop(delete_file_heap)[1])
+        for path in due:
+            try:
+                # Remove from segment cache if exists
+                segmentCache.remove(path)
+                close_segment_index(path)
+                os.remove(path)
+                for sidecar in (index_path(path), time_index_path(path)):
+                    if os.path.exists(sidecar):
+                        os.remove(sidecar)
+            except Exception as e:
+                print(f"Can't delete file {e}")
+
+def flush_segment(f, mm):
+    mm.flush()
+    os.fsync(f.fileno())
+    for indexes in (segment_indexes, time_indexes):
+        index = indexes.get(f.name)
+        if index:
+            index.flush()
+
+def sync_topic(topic):
+    """Flushes and fsyncs the active segment of the topic, used by the group commits"""
+    segments = topics_log_file.get(topic)
+    if not segments or segments[-1][1] is None:
+        return
+    flush_segment(segments[-1][0], segments[-1][1])
 
 def lazy_flush():
     """Runs in background, lazy flush active segments"""
     while True:
+        start = time.perf_counter_ns()
         for topic,segments in list(topics_log_file.items()):
             if not segments:
                 continue
@@ -333,17 +805,26 @@ def lazy_flush():
             if mm is None:
                 continue
             try:
-                mm.flush()
-                os.fsync(f.fileno())
+                flush_segment(f, mm)
             except ValueError:
                 ## mmap closed, or file closed mid-flush
                 continue
             except Exception as e:
                 print(f"Lazy flush error: {e}")
+        metrics.flush_duration.record_since(start)
         time.sleep(0.5)
 
-def close_all_segments():
+def close_all_segments(clean=True):
+    """Writes the manifests and closes every segment. The clean shutdown markers are only written if clean,
+    when no thread can append anymore, otherwise the next start scans the active segments."""
     for topic, segments in topics_log_file.items():
+        manifest_written = False
+        try:
+            # Committed write offsets let the next start skip scanning the active segments
+            write_manifest(topic)
+            manifest_written = True
+        except Exception as e:
+            print(f"Can't write manifest of {topic}: {e}")
         for f, mm, _, _, _ in segments:
             try:
                 if mm:
@@ -353,6 +834,14 @@ def close_all_segments():
                 f.close()
             except:
                 pass
+        if manifest_written and clean:
+            with open(os.path.join(LOG_FILE_DIR, topic, CLEAN_SHUTDOWN_FILE), 'w'):
+                pass
+    for indexes in (segment_indexes, time_indexes):
+        for index in list(indexes.values()):
+            index.flush()
+            index.close()
+        indexes.clear()
 
 def start_threads():
     t1 = threading.Thread(target=log_cleaner,daemon=True)
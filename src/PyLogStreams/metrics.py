@@ -0,0 +1,130 @@
+import time
+
+METRIC_PREFIX = 'pylogstreams_'
+
+HISTOGRAM_SUB_BITS = 3 # Each power of two is split in 2**3 linear buckets, at most 12.5% error
+
+HISTOGRAM_MAX_BITS = 36 # Values are tracked up to 2**36, larger ones land in the last bucket
+
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BITS
+
+HISTOGRAM_BUCKETS = (HISTOGRAM_MAX_BITS - HISTOGRAM_SUB_BITS + 1) * HISTOGRAM_SUB_BUCKETS
+
+QUANTILES = (0.5, 0.99, 0.999) # Reported by render()
+
+class Histogram:
+    """Log-linear histogram: values below 2*HISTOGRAM_SUB_BUCKETS get one bucket each, every power of two
+    above is split in HISTOGRAM_SUB_BUCKETS. Recording increments preallocated counters, nothing is allocated.
+    Recorded from several threads without a lock, a rare lost increment is accepted."""
+    def __init__(self, name: str, help: str, unit: str):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+
+    def record(self, value: int):
+        if value < 2*HISTOGRAM_SUB_BUCKETS:
+            index = max(value, 0)
+        else:
+            shift = value.bit_length() - HISTOGRAM_SUB_BITS - 1
+            index = min(shift*HISTOGRAM_SUB_BUCKETS + (value >> shift), HISTOGRAM_BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+
+    def record_since(self, start_ns: int):
+        """Records the microseconds elapsed since start_ns, a time.perf_counter_ns()"""
+        self.record((time.perf_counter_ns() - start_ns) // 1000)
+
+    def quantile(self, q: float) -> int:
+        """Upper bound of the bucket holding the q quantile, 0 when empty"""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return bucket_upper_bound(index)
+        return 0
+
+def bucket_upper_bound(index: int) -> int:
+    if index < 2*HISTOGRAM_SUB_BUCKETS:
+        return index
+    shift = index // HISTOGRAM_SUB_BUCKETS - 1
+    return ((index - shift*HISTOGRAM_SUB_BUCKETS) << shift) + (1 << shift) - 1
+
+histograms = [] # [Histogram, ...] rendered in this order
+
+def histogram(name: str, help: str, unit: str = 'us') -> Histogram:
+    h = Histogram(name, help, unit)
+    histograms.append(h)
+    return h
+
+append_latency = histogram('append_latency', "Time to append one produce request to the log")
+fsync_latency = histogram('fsync_latency', "Time of the fsync of a group commit")
+fetch_latency = histogram('fetch_latency', "Time from a fetch request to its reply, including the wait for min_bytes")
+flush_duration = histogram('flush_duration', "Time of a lazy flush pass over the active segments")
+delivery_bytes = histogram('delivery', "Bytes a consumer writer sends before draining, see BATCH_SIZE, MAX_BUFFERED, LINGER_MS", 'bytes')
+
+class TopicCounters:
+    __slots__ = ('bytes_in', 'records_in', 'bytes_out', 'frames_out')
+    def __init__(self):
+        self.bytes_in = 0
+        self.records_in = 0 # A compressed batch is one record
+        self.bytes_out = 0
+        self.frames_out = 0 # A batch frame carries many records, a message frame one message
+
+topic_counters = {} # (topic: TopicCounters)
+
+def get_topic_counters(topic) -> TopicCounters:
+    c = topic_counters.get(topic)
+    if c is None:
+        c = topic_counters[topic] = TopicCounters()
+    return c
+
+def count_in(topic, size: int, records: int = 1):
+    c = get_topic_counters(topic)
+    c.bytes_in += size
+    c.records_in += records
+
+def count_out(topic, size: int, frames: int = 1):
+    c = get_topic_counters(topic)
+    c.bytes_out += size
+    c.frames_out += frames
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def render(families=(), labels=None) -> str:
+    """Returns every metric in the Prometheus text format. families are extra
+    (name, type, help, [(labels, value), ...]) computed by the caller, labels are added to all metrics."""
+    labels = labels or {}
+    lines = []
+    def header(name, kind, help):
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {help}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {kind}')
+    def sample(name, sample_labels, value):
+        lines.append(f'{METRIC_PREFIX}{name}{format_labels({**labels, **sample_labels})} {value}')
+    for h in histograms:
+        name = f'{h.name}_{h.unit}'
+        header(name, 'summary', h.help)
+        for q in QUANTILES:
+            sample(name, {'quantile': q}, h.quantile(q))
+        sample(name + '_sum', {}, h.total)
+        sample(name + '_count', {}, h.count)
+    for name, attribute, help in (('bytes_in_total', 'bytes_in', "Bytes of records appended"),
+                                  ('records_in_total', 'records_in', "Records appended"),
+                                  ('bytes_out_total', 'bytes_out', "Bytes sent to consumers and fetches"),
+                                  ('frames_out_total', 'frames_out', "Frames sent to consumers and fetches")):
+        header(name, 'counter', help)
+        for topic, c in list(topic_counters.items()):
+            sample(name, {'topic': topic}, getattr(c, attribute))
+    for name, kind, help, samples in families:
+        header(name, kind, help)
+        for sample_labels, value in samples:
+            sample(name, sample_labels, value)
+    return '\n'.join(lines) + '\n'
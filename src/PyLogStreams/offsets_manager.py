@@ -1,46 +1,146 @@
-from log_manager import read_message, append_message, RETENSION
+from log_manager import read_messages, append_batch, get_latest_offset, get_oldest_offset, LOG_FILE_DIR
+import os
+import threading
 import time
 
 INTERNAL_CONSUMER_LOG = "__consumer_offset"
 
-client_offsets = {}
+OFFSET_FLUSH_INTERVAL = 1 # Seconds, coalesced commits are appended to the internal log at most this often
+
+SNAPSHOT_INTERVAL = 60 # Seconds, how often a compact snapshot of all offsets is written
+
+SNAPSHOT_FILE = os.path.join(LOG_FILE_DIR, INTERNAL_CONSUMER_LOG, 'offsets_snapshot.txt')
+
+client_offsets = {} # (id: {topic: offset, ...}, ...)
+
+dirty_offsets = {} # ((id, topic): offset, ...) commits not yet appended to the internal log
+
+offsets_lock = threading.Lock()
+
+flusher_stop = threading.Event() # Set on shutdown, the flusher returns after its current flush
+
+flusher_thread = None
+
+def set_worker(worker_id):
+    """Each broker worker keeps the offsets of its own topics in a separate internal log"""
+    global INTERNAL_CONSUMER_LOG, SNAPSHOT_FILE
+    INTERNAL_CONSUMER_LOG = f"__consumer_offset-{worker_id}"
+    SNAPSHOT_FILE = os.path.join(LOG_FILE_DIR, INTERNAL_CONSUMER_LOG, 'offsets_snapshot.txt')
 
 def load_client_offsets():
-    entries = {}
-    offset = 0
+    """Loads the latest snapshot, then replays only the internal log written after it"""
+    entries, offset = read_snapshot()
+    offset = max(offset, get_oldest_offset(INTERNAL_CONSUMER_LOG))
     while True:
-        # No checksum of message in internal logs
-        msg, new_offset = read_message(INTERNAL_CONSUMER_LOG, offset, check_hash=False)
-        if offset == new_offset:
-            break
-        # Msg none means we reached a deleted/expired message
-        # offset will be updated to next valid message
-        if msg is None:
-            continue
-        parts = msg.split(' ')
-        if len(parts)!=4:
+        records, new_offset = read_messages(INTERNAL_CONSUMER_LOG, offset)
+        if records is None:
+            # Msg none means we reached the end, or a deleted/expired message
+            # offset will be updated to next valid message
+            if new_offset <= offset:
+                break
             offset = new_offset
             continue
-        ts_ms = int(parts[0])
-        id = parts[1]
-        topic = parts[2]
-        topic_offset = int(parts[3])
-        if id not in entries:
-            entries[id] = {}
-        entries[id][topic] = topic_offset
+        # No checksum of message in internal logs
+        pos = 0
+        while pos < len(records):
+            msg_len = int.from_bytes(records[pos:pos+4], 'big')
+            parts = bytes(records[pos+4:pos+4+msg_len]).decode().split(' ')
+            pos += 4 + msg_len
+            if len(parts)!=4:
+                continue
+            id = parts[1]
+            topic = parts[2]
+            if id not in entries:
+                entries[id] = {}
+            entries[id][topic] = int(parts[3])
+        records.release()
         offset = new_offset
-    client_offsets = entries
+    with offsets_lock:
+        client_offsets.clear()
+        client_offsets.update(entries)
 
     for id in list(client_offsets.keys()):
         print(f"Loaded offsets for client {id}: {client_offsets[id]}")
 
+def read_snapshot():
+    """Returns the offsets stored in the snapshot and the internal log offset it covers"""
+    entries = {}
+    if not os.path.exists(SNAPSHOT_FILE):
+        return entries, 0
+    with open(SNAPSHOT_FILE, 'r') as f:
+        # First line is the internal log offset, every line after is [id] [topic] [offset]
+        log_offset = int(f.readline())
+        for line in f:
+            parts = line.split(' ')
+            if len(parts)!=3:
+                continue
+            if parts[0] not in entries:
+                entries[parts[0]] = {}
+            entries[parts[0]][parts[1]] = int(parts[2])
+    return entries, log_offset
+
+def write_snapshot(log_offset):
+    with offsets_lock:
+        snapshot = [(id, topic, offset) for id, topics in client_offsets.items() for topic, offset in topics.items()]
+    os.makedirs(os.path.dirname(SNAPSHOT_FILE), exist_ok=True)
+    tmp_file = SNAPSHOT_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(f"{log_offset}\n")
+        f.writelines(f"{id} {topic} {offset}\n" for id, topic, offset in snapshot)
+        f.flush()
+        os.fsync(f.fileno())
+    # Atomic swap, a crash leaves either the old or the new snapshot
+    os.replace(tmp_file, SNAPSHOT_FILE)
+
+def flush_client_offsets():
+    """Appends the coalesced commits to the internal log in a single batch"""
+    with offsets_lock:
+        if not dirty_offsets:
+            return
+        pending = list(dirty_offsets.items())
+        dirty_offsets.clear()
+    ts_ms = int(time.time()*1000)
+    records = []
+    for (id, topic), offset in pending:
+        msg_bytes = f"{ts_ms} {id} {topic} {offset}".encode()
+        records.append(len(msg_bytes).to_bytes(4,'big') + msg_bytes)
+    append_batch(INTERNAL_CONSUMER_LOG, b''.join(records), hashed=False)
+
+def offsets_flusher():
+    """Runs in background, flushes commits and writes periodic snapshots"""
+    last_snapshot = time.time()
+    while not flusher_stop.wait(OFFSET_FLUSH_INTERVAL):
+        try:
+            flush_client_offsets()
+            if time.time() - last_snapshot >= SNAPSHOT_INTERVAL:
+                write_snapshot(get_latest_offset(INTERNAL_CONSUMER_LOG))
+                last_snapshot = time.time()
+        except Exception as e:
+            print(f"Offsets flush error: {e}")
+
+def start_offsets_flusher():
+    global flusher_thread
+    flusher_thread = threading.Thread(target=offsets_flusher, daemon=True)
+    flusher_thread.start()
+
+def stop_offsets_flusher() -> bool:
+    """Stops the flusher, returns False if it's still appending after the timeout"""
+    flusher_stop.set()
+    if flusher_thread is None:
+        return True
+    flusher_thread.join(timeout=5)
+    return not flusher_thread.is_alive()
+
 def get_client_offsets(id) -> dict:
     if id not in client_offsets:
-        client_offsets[id] = {}
+        with offsets_lock:
+            client_offsets[id] = {}
     return client_offsets[id]
 
 def update_client_offset(id: str, topic: str, offset: int):
-    if id not in client_offsets:
-        client_offsets[id] = {}
-    client_offsets[id][topic] = offset
-    append_message(INTERNAL_CONSUMER_LOG, f"{int(time.time()*1000)} {id} {topic} {offset}".encode())
\ No newline at end of file
+    with offsets_lock:
+        if id not in client_offsets:
+            client_offsets[id] = {}
+        client_offsets[id][topic] = offset
+        # Only the last commit per (client, topic) is kept until the next flush
+        dirty_offsets[(id, topic)] = offset
@@ -0,0 +1,48 @@
+import struct
+import zlib
+
+# A v2 client starts its connection with these bytes. Read as a v1 frame length they would be a 1.3GB frame,
+# so the broker tells the protocols apart on the first 4 bytes.
+MAGIC = b'PLS\x02'
+
+# [4B length][1B opcode][1B flags][2B topic length][4B correlation id][4B crc32], then the topic and the payload.
+# The length counts everything after itself, the crc covers the payload when FLAG_CRC is set.
+HEADER = struct.Struct('>IBBHII')
+
+# Requests, the topic is empty unless noted
+OP_REGISTER = 1 # Replied with OP_REGISTER, payload the new client id
+OP_LOGIN = 2 # Payload client id
+OP_SUBSCRIBE = 3 # Topic, payload group name or empty
+OP_SEEK = 4 # Topic, payload OFFSET: -1 latest, epoch ms with FLAG_TIME, else snapped to a record boundary
+OP_PRODUCE = 5 # Topic, payload one message, routed by its first word with FLAG_KEYED
+OP_PRODUCE_BATCH = 6 # Topic, payload records framed as on disk [4B length][message][4B checksum]...
+OP_ACKS = 7 # Payload 1B acks level of the following produce requests
+OP_CONFIG = 8 # Topic, payload [key]=[value]
+OP_FETCH = 9 # Topic, payload FETCH_REQUEST, replied with OP_FETCH, payload OFFSET of the next record then records
+OP_CREDIT = 10 # Payload OFFSET bytes the broker may send
+OP_PING = 11
+OP_STATS = 14 # Replied with OP_STATS, payload the metrics of the worker in the Prometheus text format
+
+# Broker to client
+OP_ACK = 12 # Payload ACK entries [4B correlation id][1B code][8B offset]...
+OP_RECORDS = 13 # Topic, payload records of a subscription framed as on disk
+
+FLAG_CRC = 0x01 # The crc field is set
+FLAG_KEYED = 0x02 # OP_PRODUCE: records of the same key go to the same partition
+FLAG_TIME = 0x04 # OP_SEEK: the offset is a time
+
+FETCH_REQUEST = struct.Struct('>qIII') # offset, max_bytes, min_bytes, max_wait_ms
+
+OFFSET = struct.Struct('>q')
+
+# Requests whose topic decides the worker serving them
+ROUTED_OPCODES = (OP_SUBSCRIBE, OP_SEEK, OP_PRODUCE, OP_PRODUCE_BATCH, OP_CONFIG, OP_FETCH)
+
+def frame_header(opcode: int, topic: bytes = b'', payload_len: int = 0, correlation: int = 0, flags: int = 0, crc: int = 0) -> bytes:
+    """Header and topic of a frame, the payload is written after it"""
+    return HEADER.pack(HEADER.size - 4 + len(topic) + payload_len, opcode, flags, len(topic), correlation, crc) + topic
+
+def encode_frame(opcode: int, topic: bytes = b'', payload: bytes = b'', correlation: int = 0, flags: int = 0, crc: bool = False) -> bytes:
+    if crc:
+        flags |= FLAG_CRC
+    return frame_header(opcode, topic, len(payload), correlation, flags, zlib.crc32(payload) if crc else 0) + payload
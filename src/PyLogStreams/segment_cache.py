@@ -1,30 +1,107 @@
 from collections import OrderedDict
 import threading
 
-class LRUCache:
-    def __init__(self, capacity: int, callback):
-        self.cache = OrderedDict()
+class CacheEntry:
+    __slots__ = ('value', 'size', 'referenced')
+    def __init__(self, value, size: int):
+        self.value = value
+        self.size = size
+        self.referenced = False # Set on every hit, cleared when the clock hand passes
+
+class SegmentCache:
+    """Cache of sealed segment mappings bounded by entries (open files) and mapped bytes, resistant to scans.
+    Simplified 2Q: a segment mapped for the first time enters a FIFO probation queue, so a replay reading old
+    segments once only cycles through it and leaves their keys in a ghost list. A segment missed again while
+    its key is a ghost is wanted repeatedly and enters the main queue, evicted with CLOCK (a referenced entry
+    gets a second chance). A hit only sets a reference bit, get() takes no lock. put() and its evictions must
+    run on the readers' thread, the callback closes mappings nobody else slices."""
+    def __init__(self, capacity: int, max_bytes: int, callback, probation_share: float = 0.25):
         self.capacity = capacity
-        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.probation_share = probation_share # Part of both bounds the probation queue may keep when main has entries
         self.callback = callback
+        self.entries = {} # (key: CacheEntry) of both queues, read without the lock
+        self.probation = OrderedDict() # (key: CacheEntry) oldest first
+        self.main = OrderedDict() # (key: CacheEntry) the front is the clock hand
+        self.ghosts = OrderedDict() # (key: None) evicted from probation, at most capacity//2
+        self.size = 0 # Mapped bytes of all entries
+        self.probation_size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 # Removed to stay within the bounds, explicit removals aren't counted
+        self.promotions = 0 # Ghosts mapped again, admitted to main
 
     def get(self, key: str):
-        with self.lock:
-            if key not in self.cache:
-                return None
-            self.cache.move_to_end(key)
-            return self.cache[key]
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        entry.referenced = True
+        self.hits += 1
+        return entry.value
 
-    def put(self, key: str, value):
+    def put(self, key: str, value, size: int = 0):
         with self.lock:
-            if key in self.cache:
-                self.cache.move_to_end(key)
-            self.cache[key] = value
-            if len(self.cache) > self.capacity:
-                oldest_key, oldest_value = self.cache.popitem(last=False)
-                self.callback(oldest_key, oldest_value)
+            # Two readers can map the same segment at once, the last one stays cached
+            self._unlink(key)
+            entry = CacheEntry(value, size)
+            if key in self.ghosts:
+                del self.ghosts[key]
+                self.main[key] = entry
+                self.promotions += 1
+            else:
+                self.probation[key] = entry
+                self.probation_size += size
+            self.entries[key] = entry
+            self.size += size
+            self._evict(key)
+
     def remove(self, key: str):
+        """Drops the entry from any thread. The callback isn't called, a reader may still be slicing the mapping,
+        it's released with the last reference."""
         with self.lock:
-            if key in self.cache:
-                value = self.cache.pop(key)
-                self.callback(key, value)
\ No newline at end of file
+            self.ghosts.pop(key, None)
+            self._unlink(key)
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _unlink(self, key: str) -> CacheEntry:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry.size
+        if self.probation.pop(key, None) is not None:
+            self.probation_size -= entry.size
+        else:
+            self.main.pop(key, None)
+        return entry
+
+    def _evict(self, keep: str):
+        """Evicts until within the bounds, never the entry just put so its caller can use it"""
+        while len(self.entries) > self.capacity or self.size > self.max_bytes:
+            probation_full = (len(self.probation) > self.capacity * self.probation_share
+                              or self.probation_size > self.max_bytes * self.probation_share)
+            can_evict_probation = self.probation and next(iter(self.probation)) != keep
+            can_evict_main = self.main and not (len(self.main) == 1 and keep in self.main)
+            if can_evict_probation and (probation_full or not can_evict_main):
+                key, entry = self.probation.popitem(last=False)
+                self.probation_size -= entry.size
+                self.ghosts[key] = None
+                if len(self.ghosts) > max(self.capacity // 2, 1):
+                    self.ghosts.popitem(last=False)
+            elif can_evict_main:
+                key, entry = self.main.popitem(last=False)
+                if entry.referenced or key == keep:
+                    # Second chance, the hand moves on
+                    entry.referenced = False
+                    self.main[key] = entry
+                    continue
+            else:
+                break
+            del self.entries[key]
+            self.size -= entry.size
+            self.evictions += 1
+            self.callback(key, entry.value)
@@ -0,0 +1,183 @@
+import mmap
+import os
+
+INDEX_ENTRY_SIZE = 4 # Each entry is a 4 byte record position relative to the segment start
+
+TIME_INDEX_ENTRY_SIZE = 12 # Each entry is an 8 byte append time in ms and a 4 byte record position
+
+def index_path(segment_path: str) -> str:
+    # segment_path: logs/topic/1010_log.txt -> logs/topic/1010_log.index
+    return segment_path[:-4] + '.index'
+
+def time_index_path(segment_path: str) -> str:
+    # segment_path: logs/topic/1010_log.txt -> logs/topic/1010_log.timeindex
+    return segment_path[:-4] + '.timeindex'
+
+class OffsetIndex:
+    """Sparse, memory-mapped index of record positions inside one segment.
+    Entries are strictly increasing, position 0 is implicit and never stored,
+    so the first zero slot marks the end of the index."""
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.created = not os.path.exists(path)
+        if self.created:
+            with open(path, 'wb') as f:
+                f.truncate(max_entries*INDEX_ENTRY_SIZE)
+        self.f = open(path, 'r+b')
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.capacity = self.mm.size()//INDEX_ENTRY_SIZE
+        self.entries = self._count_entries()
+
+    def _entry(self, i: int) -> int:
+        return int.from_bytes(self.mm[i*INDEX_ENTRY_SIZE:(i+1)*INDEX_ENTRY_SIZE], 'big')
+
+    def _count_entries(self) -> int:
+        # Binary search for the first empty slot
+        l, r = 0, self.capacity
+        while l < r:
+            mid = l + (r-l)//2
+            if self._entry(mid) != 0:
+                l = mid + 1
+            else:
+                r = mid
+        return l
+
+    def last_position(self) -> int:
+        if self.entries == 0:
+            return 0
+        return self._entry(self.entries-1)
+
+    def append(self, position: int):
+        if self.entries >= self.capacity or position <= self.last_position():
+            return
+        start = self.entries*INDEX_ENTRY_SIZE
+        self.mm[start:start+INDEX_ENTRY_SIZE] = position.to_bytes(INDEX_ENTRY_SIZE, 'big')
+        self.entries += 1
+
+    def truncate(self, entries: int):
+        """Drops every entry from index `entries` onwards"""
+        if entries >= self.entries:
+            return
+        start = entries*INDEX_ENTRY_SIZE
+        end = self.entries*INDEX_ENTRY_SIZE
+        self.mm[start:end] = b'\x00'*(end-start)
+        self.entries = entries
+
+    def lookup(self, position: int) -> int:
+        """Returns the largest indexed record position <= position"""
+        l, r = 0, self.entries-1
+        found = 0
+        while l <= r:
+            mid = l + (r-l)//2
+            entry = self._entry(mid)
+            if entry <= position:
+                found = entry
+                l = mid + 1
+            else:
+                r = mid - 1
+        return found
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        try:
+            self.mm.close()
+            self.f.close()
+        except Exception:
+            pass
+
+class TimeIndex:
+    """Sparse, memory-mapped index of append times inside one segment.
+    An entry is the time of an append and the position of its first record, added at most once per interval,
+    so the records between two entries were appended less than an interval after the first one.
+    A read-only index is never created, opening a missing one raises FileNotFoundError."""
+    def __init__(self, path: str, max_entries: int, read_only: bool = False):
+        self.path = path
+        if read_only:
+            self.f = open(path, 'rb')
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.truncate(max_entries*TIME_INDEX_ENTRY_SIZE)
+            self.f = open(path, 'r+b')
+            self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.capacity = self.mm.size()//TIME_INDEX_ENTRY_SIZE
+        self.entries = self._count_entries()
+
+    def _time(self, i: int) -> int:
+        start = i*TIME_INDEX_ENTRY_SIZE
+        return int.from_bytes(self.mm[start:start+8], 'big')
+
+    def _position(self, i: int) -> int:
+        start = i*TIME_INDEX_ENTRY_SIZE + 8
+        return int.from_bytes(self.mm[start:start+4], 'big')
+
+    def _count_entries(self) -> int:
+        # Binary search for the first empty slot, times are never 0
+        l, r = 0, self.capacity
+        while l < r:
+            mid = l + (r-l)//2
+            if self._time(mid) != 0:
+                l = mid + 1
+            else:
+                r = mid
+        return l
+
+    def last_time(self) -> int:
+        if self.entries == 0:
+            return 0
+        return self._time(self.entries-1)
+
+    def last_position(self) -> int:
+        if self.entries == 0:
+            return 0
+        return self._position(self.entries-1)
+
+    def append(self, time_ms: int, position: int):
+        if self.entries >= self.capacity or time_ms <= self.last_time():
+            return
+        start = self.entries*TIME_INDEX_ENTRY_SIZE
+        self.mm[start:start+TIME_INDEX_ENTRY_SIZE] = time_ms.to_bytes(8, 'big') + position.to_bytes(4, 'big')
+        self.entries += 1
+
+    def truncate(self, entries: int):
+        """Drops every entry from index `entries` onwards"""
+        if entries >= self.entries:
+            return
+        start = entries*TIME_INDEX_ENTRY_SIZE
+        end = self.entries*TIME_INDEX_ENTRY_SIZE
+        self.mm[start:end] = b'\x00'*(end-start)
+        self.entries = entries
+
+    def lookup(self, time_ms: int, interval_ms: int) -> int:
+        """Returns the position of the first record that may have been appended at or after time_ms,
+        -1 if the segment has none. Records before it were all appended earlier, a few records after it may be too."""
+        l, r = 0, self.entries-1
+        found = -1
+        while l <= r:
+            mid = l + (r-l)//2
+            if self._time(mid) <= time_ms:
+                found = mid
+                l = mid + 1
+            else:
+                r = mid - 1
+        if found == -1:
+            return 0
+        if time_ms < self._time(found) + interval_ms:
+            return self._position(found)
+        if found == self.entries-1:
+            # The records after the last entry are older, unless the index was full when they were appended
+            return self._position(found) if self.entries == self.capacity else -1
+        return self._position(found+1)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        try:
+            self.mm.close()
+            self.f.close()
+        except Exception:
+            pass
@@ -0,0 +1,111 @@
+import os
+import threading
+from log_manager import LOG_FILE_DIR, PARTITION_PREFIX, topics_log_file, topic_retention, topic_retention_bytes, schedule_expiry
+
+TOPIC_CONFIG_FILE = 'config.txt' # In the topic directory, one [key]=[value] per line
+
+# Known settings and their defaults, values are parsed to the type of the default
+DEFAULT_CONFIG = {
+    'partitions': 1,
+    'cleanup.policy': 'delete', # delete expires whole segments, compact keeps the latest record of every key
+    'retention.ms': -1, # Age of the segments to delete, -1 uses the broker RETENSION
+    'retention.bytes': -1, # Size limit of each log of the topic, -1 for none
+}
+
+CONFIG_CHOICES = {
+    'cleanup.policy': ('delete', 'compact'),
+}
+
+INTERNAL_TOPIC_PREFIX = '__' # Internal topics are compacted by default
+
+topic_configs = {} # (topic: {key: value, ...}, ...) only settings that differ from the defaults
+
+config_lock = threading.Lock()
+
+def load_topic_configs(owns=None):
+    """Loads the config of every topic that has one, only those accepted by owns(topic) if given"""
+    for topic in os.listdir(LOG_FILE_DIR):
+        path = os.path.join(LOG_FILE_DIR, topic, TOPIC_CONFIG_FILE)
+        if not os.path.exists(path) or (owns and not owns(topic)):
+            continue
+        config = {}
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.strip().split('=')
+                if len(parts)!=2 or parts[0] not in DEFAULT_CONFIG:
+                    continue
+                config[parts[0]] = parse_config_value(parts[0], parts[1])
+        topic_configs[topic] = config
+        apply_topic_config(topic)
+
+def write_topic_config(topic):
+    config = topic_configs.get(topic, {})
+    topic_dir = os.path.join(LOG_FILE_DIR, topic)
+    os.makedirs(topic_dir, exist_ok=True)
+    path = os.path.join(topic_dir, TOPIC_CONFIG_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(f"{key}={value}\n" for key, value in config.items())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def parse_config_value(key, value):
+    """Returns the value with the type of the default, raises ValueError if it's not accepted"""
+    value = type(DEFAULT_CONFIG[key])(value)
+    if key in CONFIG_CHOICES and value not in CONFIG_CHOICES[key]:
+        raise ValueError(f"{key} must be one of {CONFIG_CHOICES[key]}")
+    return value
+
+def get_topic_config(topic, key):
+    config = topic_configs.get(topic, {})
+    if key == 'cleanup.policy' and key not in config and topic.startswith(INTERNAL_TOPIC_PREFIX):
+        return 'compact'
+    return config.get(key, DEFAULT_CONFIG[key])
+
+def apply_topic_config(topic):
+    """Hands the retention settings of the topic to the log manager"""
+    retention_ms = get_topic_config(topic, 'retention.ms')
+    # Compacted topics keep their records until a newer record of the same key replaces them
+    if get_topic_config(topic, 'cleanup.policy') == 'compact':
+        topic_retention[topic] = None
+    elif retention_ms >= 0:
+        topic_retention[topic] = retention_ms/1000
+    else:
+        topic_retention.pop(topic, None)
+    retention_bytes = get_topic_config(topic, 'retention.bytes')
+    if retention_bytes >= 0:
+        topic_retention_bytes[topic] = retention_bytes
+    else:
+        topic_retention_bytes.pop(topic, None)
+    for log in topic_logs(topic):
+        if log in topics_log_file:
+            schedule_expiry(log)
+
+def set_topic_config(topic, key, value) -> int: # Result code
+    if key not in DEFAULT_CONFIG:
+        return 1
+    try:
+        value = parse_config_value(key, value)
+    except ValueError:
+        return 1
+    with config_lock:
+        if key == 'partitions':
+            # Partitions can only be added, and only before the topic got unpartitioned records
+            if value < get_topic_config(topic, key) or (value > 1 and topic in topics_log_file):
+                return 1
+        topic_configs.setdefault(topic, {})[key] = value
+        write_topic_config(topic)
+        apply_topic_config(topic)
+    return 0
+
+def partition_log(topic, partition) -> str:
+    # Log name of one partition, used like a topic by the log and offsets managers
+    return f"{topic}/{PARTITION_PREFIX}{partition}"
+
+def topic_logs(topic) -> list:
+    """Logs holding the records of the topic, the topic itself when it isn't partitioned"""
+    partitions = get_topic_config(topic, 'partitions')
+    if partitions == 1:
+        return [topic]
+    return [partition_log(topic, i) for i in range(partitions)]
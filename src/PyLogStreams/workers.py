@@ -0,0 +1,77 @@
+import asyncio
+import os
+import zlib
+from log_manager import LOG_FILE_DIR
+
+worker_id = 0 # Index of this broker process
+
+worker_count = 1 # Broker processes sharing the port, topics are split between them
+
+# Commands whose first argument is a topic, routed to the worker owning it
+ROUTED_COMMANDS = ('SUB', 'SET', 'PUB', 'MPB', 'KPB', 'CFG', 'FET')
+
+# Connection settings replayed on every forwarded connection
+SESSION_COMMANDS = ('CID', 'ACK', 'BAT')
+
+def owner_of(topic: str) -> int:
+    # crc32 is stable across processes, unlike hash(), partitions stay with their topic
+    return zlib.crc32(topic.split('/', 1)[0].encode()) % worker_count
+
+def worker_socket_path(worker: int) -> str:
+    # Workers forward frames to each other over unix sockets next to the logs
+    return os.path.join(LOG_FILE_DIR, f'.worker-{worker}.sock')
+
+def frame_topic(msg_bytes: bytes) -> str:
+    # [cmd] [topic] ...
+    end = msg_bytes.find(b' ', 4)
+    if end == -1:
+        end = len(msg_bytes)
+    return bytes(msg_bytes[4:end]).decode()
+
+class Upstreams:
+    """Connections forwarding one client's frames to the workers owning its other topics.
+    Frames coming back (messages, acks) are passed to on_frame for the client socket.
+    The preamble opens every upstream connection, the v2 magic bytes for v2 clients."""
+    def __init__(self, on_frame, preamble=b''):
+        self.on_frame = on_frame
+        self.preamble = preamble
+        self.client_id = None # Set on login, the frames piped back are charged against its credit
+        self.writers = {} # (worker: StreamWriter)
+        self.session = {} # (command: frame) replayed when a new upstream is opened
+        self.tasks = []
+
+    async def send(self, worker: int, frame: bytes):
+        writer = self.writers.get(worker)
+        if writer is None:
+            reader, writer = await asyncio.open_unix_connection(worker_socket_path(worker))
+            self.writers[worker] = writer
+            self.tasks.append(asyncio.create_task(self.pipe(reader)))
+            writer.write(self.preamble)
+            for session_frame in self.session.values():
+                writer.write(session_frame)
+        writer.write(frame)
+        await writer.drain()
+
+    def broadcast(self, command: str, frame: bytes):
+        if command in SESSION_COMMANDS:
+            # Replacing a key keeps its position, CID is always the first frame of a session
+            self.session[command] = frame
+        for writer in self.writers.values():
+            writer.write(frame)
+
+    async def pipe(self, reader: asyncio.StreamReader):
+        """Copies whole frames from an upstream to the client, both protocols start frames with their length"""
+        while True:
+            try:
+                len_bytes = await reader.readexactly(4)
+                msg_bytes = await reader.readexactly(int.from_bytes(len_bytes, 'big'))
+                await self.on_frame(len_bytes + msg_bytes)
+            except Exception:
+                return
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
@@ -0,0 +1,397 @@
+"""Reproducible benchmarks of log_manager and of the broker end to end.
+
+    python tests/benchmark.py                                  # every scenario
+    python tests/benchmark.py --scenario tail --msg-size 100 --producers 4
+    python tests/benchmark.py --out new.json --compare old.json
+
+Every scenario runs in a fresh temporary directory, with the broker started as a subprocess on a free port,
+so runs don't depend on earlier logs. Results are JSON: throughput and p50/p99/p999 latencies per scenario,
+tagged with the commit, so runs can be compared between commits. Not collected by pytest.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT, 'src', 'PyLogStreams')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, SRC_DIR)
+from client.client import Client
+from metrics import Histogram, QUANTILES
+
+TIMESTAMP_SIZE = 20 # Messages start with their send time, epoch ns on 20 digits
+
+BROKER_START_TIMEOUT = 10 # Seconds
+
+CONSUMER_TIMEOUT = 60 # Seconds without a message before a consumer gives up
+
+DEFAULTS = {
+    'mode': 'tail', # tail: consumers read while producers write, catchup: they start once everything is written, micro: log_manager alone
+    'messages': 20_000, # Per producer
+    'msg_size': 256, # Bytes, at least TIMESTAMP_SIZE
+    'producers': 1,
+    'consumers': 1, # Each one subscribes to every topic and receives every message
+    'topics': 1, # Producers are spread over the topics
+    'batch': 1, # Messages per produce request, 1 sends PUB, more send MPB
+    'acks': 1, # 0 produces without acks and without ack latency
+    'delivery': 'batch', # 'batch' frames or one frame per 'message'
+    'checksum': True, # MESSAGE_CHECKSUM_ENABLE of the broker and checksum_enabled of the clients
+    'workers': 1,
+    'segment_cache': 1000, # OLD_SEGMENT_CACHE_SIZE
+    'segment_cache_bytes': 2*1024*1024*1024, # OLD_SEGMENT_CACHE_BYTES
+    'segment_size': 10*1024*1024, # SEGMENT_SIZE
+}
+
+SCENARIOS = {
+    'micro': {'mode': 'micro', 'messages': 200_000},
+    'micro-batch': {'mode': 'micro', 'messages': 200_000, 'batch': 100},
+    'tail': {},
+    'tail-batch': {'batch': 100},
+    'tail-message-frames': {'batch': 100, 'delivery': 'message'},
+    'tail-no-checksum': {'batch': 100, 'checksum': False},
+    'tail-fanout': {'producers': 2, 'consumers': 4, 'topics': 2, 'batch': 100},
+    'catchup': {'mode': 'catchup', 'messages': 100_000, 'batch': 100},
+    'catchup-small-cache': {'mode': 'catchup', 'messages': 100_000, 'batch': 100, 'consumers': 4, 'segment_size': 1024*1024, 'segment_cache': 2},
+}
+
+# Run with python -c in the scenario directory, the broker module globals are the settings
+BROKER_LAUNCHER = """
+import sys
+sys.path.insert(0, {src!r})
+import broker, log_manager
+broker.MESSAGE_CHECKSUM_ENABLE = {checksum!r}
+log_manager.SEGMENT_SIZE = {segment_size!r}
+log_manager.segmentCache.capacity = {segment_cache!r}
+log_manager.segmentCache.max_bytes = {segment_cache_bytes!r}
+if {workers!r} > 1:
+    broker.run_workers({workers!r}, 'localhost', {port!r})
+else:
+    broker.run_worker(0, 1, 'localhost', {port!r})
+"""
+
+def latency_summary(parts) -> dict:
+    """Merges the (buckets, count, total) of several processes into p50/p99/p999 in microseconds"""
+    histogram = Histogram('latency', '', 'us')
+    for buckets, count, total in parts:
+        histogram.buckets = [a + b for a, b in zip(histogram.buckets, buckets)]
+        histogram.count += count
+        histogram.total += total
+    if not histogram.count:
+        return None
+    summary = {'p' + f'{q*100:g}'.replace('.', ''): histogram.quantile(q) for q in QUANTILES}
+    summary['mean'] = round(histogram.total / histogram.count, 1)
+    return summary
+
+def throughput(messages, size, seconds) -> dict:
+    seconds = max(seconds, 1e-9)
+    return {'messages': messages, 'seconds': round(seconds, 3),
+            'msgs_per_s': round(messages / seconds), 'mb_per_s': round(size / seconds / 1e6, 2)}
+
+def make_message(msg_size) -> str:
+    return f'{time.time_ns():0{TIMESTAMP_SIZE}d}' + 'x' * (msg_size - TIMESTAMP_SIZE)
+
+def run_producer(params, port, index, start, results):
+    client = Client('localhost', port)
+    client.checksum_enabled = params['checksum']
+    client.register()
+    topic = f'bench-{index % params["topics"]}'
+    messages, batch = params['messages'], params['batch']
+    latency = Histogram('ack_latency', '', 'us')
+    sent = [0] * (messages // batch + 1) # Send time of every request, indexed by its sequence number
+    def on_ack(seq, code, offset):
+        latency.record((time.perf_counter_ns() - sent[seq]) // 1000)
+    if params['acks']:
+        client.enable_acks(params['acks'], callback=on_ack)
+    start.wait()
+    begin = time.perf_counter()
+    for seq, i in enumerate(range(0, messages, batch)):
+        sent[seq] = time.perf_counter_ns()
+        if batch == 1:
+            client.produce(topic, make_message(params['msg_size']))
+        else:
+            message = make_message(params['msg_size'])
+            client.produce_batch(topic, [message] * min(batch, messages - i))
+    if params['acks']:
+        client.flush(CONSUMER_TIMEOUT)
+    else:
+        # Without acks, wait until the writer thread sent everything
+        while not client.send_queue.empty():
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - begin
+    results.put(('produce', messages, elapsed, (latency.buckets, latency.count, latency.total), len(client.failed)))
+
+def run_consumer(params, port, expected, ready, results):
+    client = Client('localhost', port)
+    client.checksum_enabled = params['checksum']
+    client.register()
+    if params['delivery'] == 'batch':
+        client.enable_batch()
+    for t in range(params['topics']):
+        topic = f'bench-{t}'
+        client.subscribe(topic)
+        if params['mode'] == 'tail':
+            client.reset_offset_latest(topic)
+        else:
+            client.reset_offset_oldest(topic)
+    client.conn.settimeout(CONSUMER_TIMEOUT)
+    ready.set()
+    tail = params['mode'] == 'tail'
+    latency = Histogram('latency', '', 'us')
+    received = 0
+    begin = time.perf_counter() if not tail else None
+    while received < expected:
+        try:
+            views = client.consume_views()
+        except socket.timeout:
+            break
+        if views is None:
+            break
+        if begin is None:
+            begin = time.perf_counter()
+        now = time.time_ns()
+        for _, payload in views:
+            if tail:
+                latency.record((now - int(bytes(payload[:TIMESTAMP_SIZE]))) // 1000)
+            received += 1
+    elapsed = time.perf_counter() - (begin or time.perf_counter())
+    results.put(('consume', received, elapsed, (latency.buckets, latency.count, latency.total), 0))
+
+def run_micro(params, directory, results):
+    """Appends and reads back with log_manager directly, no broker and no sockets"""
+    os.chdir(directory)
+    import log_manager
+    from compression import iter_messages
+    log_manager.SEGMENT_SIZE = params['segment_size']
+    log_manager.segmentCache.capacity = params['segment_cache']
+    log_manager.segmentCache.max_bytes = params['segment_cache_bytes']
+    messages, batch, checksum = params['messages'], params['batch'], params['checksum']
+    msg_bytes = make_message(params['msg_size']).encode()
+    hash = zlib.crc32(msg_bytes).to_bytes(4, 'big') if checksum else None
+    record = msg_bytes + (hash or b'')
+    record = len(record).to_bytes(4, 'big') + record
+    latency = Histogram('append_latency', '', 'us')
+    begin = time.perf_counter()
+    for i in range(0, messages, batch):
+        start = time.perf_counter_ns()
+        if batch == 1:
+            code = log_manager.append_message('bench', msg_bytes, hash)
+        else:
+            code = log_manager.append_batch('bench', record * min(batch, messages - i), checksum)
+        latency.record((time.perf_counter_ns() - start) // 1000)
+        if code != 0:
+            raise RuntimeError(f"append failed with code {code}")
+    append_seconds = time.perf_counter() - begin
+    # Sequential scan with checksum verification, like the delivery of message frames
+    begin = time.perf_counter()
+    offset, read = 0, 0
+    while read < messages:
+        view, offset = log_manager.read_messages('bench', offset)
+        if view is None:
+            break
+        read += sum(1 for _ in iter_messages(view, checksum))
+        view.release()
+    read_seconds = time.perf_counter() - begin
+    log_manager.close_all_segments()
+    results.put(('produce', messages, append_seconds, (latency.buckets, latency.count, latency.total), 0))
+    results.put(('consume', read, read_seconds, ([0] * len(latency.buckets), 0, 0), 0))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def start_broker(params, directory, port, verbose):
+    code = BROKER_LAUNCHER.format(src=SRC_DIR, port=port, **{key: params[key] for key in ('checksum', 'segment_size', 'segment_cache', 'segment_cache_bytes', 'workers')})
+    output = None if verbose else subprocess.DEVNULL
+    broker = subprocess.Popen([sys.executable, '-c', code], cwd=directory, stdout=output, stderr=output)
+    deadline = time.time() + BROKER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            # The probe closes before sending a frame, the broker drops it
+            return broker
+        except OSError:
+            if broker.poll() is not None:
+                break
+            time.sleep(0.1)
+    stop_broker(broker)
+    raise RuntimeError("broker didn't start")
+
+def stop_broker(broker):
+    if broker.poll() is None:
+        broker.send_signal(signal.SIGTERM)
+        try:
+            broker.wait(10)
+        except subprocess.TimeoutExpired:
+            broker.kill()
+            broker.wait()
+
+def broker_stats(port) -> dict:
+    """Server side view of the run: append and fsync latency, delivery batching, tail ring and segment cache, see metrics.py"""
+    client = Client('localhost', port)
+    client.conn.settimeout(5)
+    try:
+        stats = client.stats() or {}
+    except OSError:
+        return {}
+    finally:
+        client.alive = False
+        client.conn.close()
+    keep = ('append_latency', 'fsync_latency', 'delivery_bytes', 'tail_ring', 'segment_cache')
+    return {name.replace('pylogstreams_', ''): value for name, value in stats.items() if any(key in name for key in keep)}
+
+def start_processes(target, args_list):
+    processes = [multiprocessing.Process(target=target, args=args, daemon=True) for args in args_list]
+    for p in processes:
+        p.start()
+    return processes
+
+def collect(results, count, processes) -> list:
+    """Waits for count results of the processes, [(kind, count, seconds, latency parts, failed), ...]"""
+    entries = []
+    for _ in range(count):
+        try:
+            entries.append(results.get(timeout=CONSUMER_TIMEOUT * 2))
+        except Exception:
+            print("A benchmark process didn't report")
+            break
+    for p in processes:
+        p.join(5)
+    return entries
+
+def entries_of(entries, kind) -> list:
+    return [entry[1:] for entry in entries if entry[0] == kind]
+
+def summarize(entries, msg_size, per_process_messages=None) -> dict:
+    total = sum(count for count, _, _, _ in entries)
+    seconds = max((elapsed for _, elapsed, _, _ in entries), default=0)
+    summary = throughput(total, total * msg_size, seconds)
+    latency = latency_summary([parts for _, _, parts, _ in entries])
+    if latency is not None:
+        summary['latency_us'] = latency
+    failed = sum(failed for _, _, _, failed in entries)
+    if failed:
+        summary['failed_requests'] = failed
+    if per_process_messages is not None:
+        summary['complete'] = all(count == per_process_messages for count, _, _, _ in entries) and len(entries) > 0
+    return summary
+
+def run_scenario(params, verbose) -> dict:
+    directory = tempfile.mkdtemp(prefix='pylogstreams-bench-')
+    results = multiprocessing.Queue()
+    try:
+        if params['mode'] == 'micro':
+            processes = start_processes(run_micro, [(params, directory, results)])
+            entries = collect(results, 2, processes)
+            return {'append': summarize(entries_of(entries, 'produce'), params['msg_size']),
+                    'read': summarize(entries_of(entries, 'consume'), params['msg_size'])}
+        port = free_port()
+        broker = start_broker(params, directory, port, verbose)
+        try:
+            expected = params['messages'] * params['producers']
+            start = multiprocessing.Event()
+            consumer_args = []
+            readies = []
+            for _ in range(params['consumers']):
+                ready = multiprocessing.Event()
+                readies.append(ready)
+                consumer_args.append((params, port, expected, ready, results))
+            consumers = []
+            if params['mode'] == 'tail':
+                consumers = start_processes(run_consumer, consumer_args)
+                for ready in readies:
+                    ready.wait(BROKER_START_TIMEOUT)
+                # SUB and SET have no reply, give the broker time to apply them
+                time.sleep(0.5)
+            producers = start_processes(run_producer, [(params, port, i, start, results) for i in range(params['producers'])])
+            start.set()
+            if params['mode'] == 'tail':
+                entries = collect(results, len(producers) + len(consumers), producers + consumers)
+            else:
+                entries = collect(results, len(producers), producers)
+                consumers = start_processes(run_consumer, consumer_args)
+                entries += collect(results, len(consumers), consumers)
+            produced = entries_of(entries, 'produce')
+            consumed = entries_of(entries, 'consume')
+            return {'produce': summarize(produced, params['msg_size']),
+                    'consume': summarize(consumed, params['msg_size'], expected),
+                    'broker': broker_stats(port)}
+        finally:
+            stop_broker(broker)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(report, baseline):
+    """Prints the throughput and p99 change of every scenario present in both reports"""
+    print(f"Compared with {baseline.get('commit')}:")
+    for name, result in report['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None or old.get('params') != result['params']:
+            continue
+        for phase, summary in result.items():
+            if not isinstance(summary, dict) or 'msgs_per_s' not in summary or phase not in old:
+                continue
+            line = f"  {name} {phase}: {summary['msgs_per_s']} msg/s ({change(summary['msgs_per_s'], old[phase]['msgs_per_s'])})"
+            if 'latency_us' in summary and 'latency_us' in old[phase]:
+                line += f", p99 {summary['latency_us']['p99']}us ({change(summary['latency_us']['p99'], old[phase]['latency_us']['p99'])})"
+            print(line)
+
+def change(new, old) -> str:
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+def main():
+    parser = argparse.ArgumentParser(description="PyLogStreams benchmarks, results as JSON")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="run only these scenarios, repeatable")
+    for key, value in DEFAULTS.items():
+        kind = (lambda text: text.lower() in ('1', 'true', 'yes', 'on')) if isinstance(value, bool) else type(value)
+        parser.add_argument('--' + key.replace('_', '-'), type=kind, help=f"overrides every scenario (default {value})")
+    parser.add_argument('--out', help="writes the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--verbose', action='store_true', help="shows the broker output")
+    args = parser.parse_args()
+    overrides = {key: getattr(args, key) for key in DEFAULTS if getattr(args, key) is not None}
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        params = {**DEFAULTS, **SCENARIOS[name], **overrides}
+        if params['msg_size'] < TIMESTAMP_SIZE:
+            parser.error(f"--msg-size must be at least {TIMESTAMP_SIZE}")
+        print(f"Running {name}...", file=sys.stderr)
+        result = run_scenario(params, args.verbose)
+        report['scenarios'][name] = {'params': params, **result}
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
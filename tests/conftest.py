@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The broker modules import each other flat, from their own directory, the clients are imported as client.*
+sys.path.insert(0, os.path.join(ROOT, 'src', 'PyLogStreams'))
+sys.path.insert(1, ROOT)
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    """log_manager with its logs under a temporary working directory"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('logs', exist_ok=True)
+    import log_manager
+    # Logs of the previous tests live in their own directories
+    for state in (log_manager.topics_log_file, log_manager.segment_indexes, log_manager.time_indexes,
+                  log_manager.delete_file_heap, log_manager.expiry_heap, log_manager.expiry_deadlines):
+        state.clear()
+    return log_manager
@@ -35,23 +35,23 @@ class ConsumerUser(User):
     def consume_loop(self):
         while True:
             try:
-                resp = self.client_obj.consume()
-                if not resp:
+                views = self.client_obj.consume_views()
+                if not views:
                     continue
-                msg = resp.split(' ',1)[1]
-                if not msg:
-                    continue
-                data = json.loads(msg)
-                sent_ts = data.get("ts", None)
-                if sent_ts:
-                    latency = (time.time() - sent_ts) * 1000
-                    events.request.fire(
-                        request_type="consume",
-                        name="message_latency",
-                        response_time=latency,
-                        response_length=len(msg),
-                        exception=None,
-                    )
+                for _, msg in views:
+                    if not msg:
+                        continue
+                    data = json.loads(bytes(msg))
+                    sent_ts = data.get("ts", None)
+                    if sent_ts:
+                        latency = (time.time() - sent_ts) * 1000
+                        events.request.fire(
+                            request_type="consume",
+                            name="message_latency",
+                            response_time=latency,
+                            response_length=len(msg),
+                            exception=None,
+                        )
             except Exception as e:
                 events.request.fire(
                     request_type="consume",
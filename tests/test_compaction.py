@@ -0,0 +1,48 @@
+import pytest
+from compression import iter_messages
+
+def read_all(log_manager, topic, max_bytes):
+    """Reads every message of the topic with read_messages"""
+    messages, offset = [], 0
+    while offset < log_manager.get_latest_offset(topic):
+        records, next_offset = log_manager.read_messages(topic, offset, max_bytes)
+        assert next_offset > offset
+        if records is not None:
+            messages += [bytes(m) for m in iter_messages(records, False)]
+        offset = next_offset
+    return messages
+
+@pytest.mark.parametrize('max_bytes', [1, 64*1024])
+def test_read_across_skip_runs(log, max_bytes):
+    import compactor
+    topic = f'compacted{max_bytes}'
+    # A leading, a middle and a trailing run of replaced records in the first segment
+    for msg in (b'k1 a', b'plain 1', b'k2 b', b'k1 c', b'k2 d', b'k3 e'):
+        log.append_message(topic, msg, keyed=not msg.startswith(b'plain'))
+    log.rollover_file(topic)
+    log.append_message(topic, b'k3 f', keyed=True)
+    log.append_message(topic, b'k2 ', keyed=True) # Tombstone, kept until it's old enough
+    log.rollover_file(topic)
+    log.append_message(topic, b'plain 2')
+    compactor.compact_topic(topic, False)
+
+    messages = read_all(log, topic, max_bytes)
+    assert messages == [b'plain 1', b'k1 c', b'k3 f', b'k2 ', b'plain 2']
+
+def test_read_message_jumps_skip_runs(log):
+    import compactor
+    topic = 'compacted_single'
+    for msg in (b'k1 a', b'k1 b', b'k2 c'):
+        log.append_message(topic, msg, keyed=True)
+    log.rollover_file(topic)
+    log.append_message(topic, b'plain')
+    compactor.compact_topic(topic, False)
+
+    messages, offset = [], 0
+    while offset < log.get_latest_offset(topic):
+        msg, next_offset = log.read_message(topic, offset)
+        assert next_offset > offset
+        if msg is not None:
+            messages.append(bytes(msg))
+        offset = next_offset
+    assert messages == [b'k1 b', b'k2 c', b'plain']
@@ -0,0 +1,51 @@
+import zlib
+import pytest
+from compression import decompress_records, iter_messages, CODECS, RECORD_COMPRESSED, DECOMPRESSED_MAX_BYTES
+from client.client import decompress_batch
+
+def record(msg: bytes, flags=0) -> bytes:
+    msg += zlib.crc32(msg).to_bytes(4, 'big')
+    return (len(msg) | flags).to_bytes(4, 'big') + msg
+
+def compressed(records: bytes, codec=1, body=None) -> bytes:
+    """A compressed batch record, body replaces the compressed records if given"""
+    return record(bytes([codec]) + (CODECS[codec][0](records) if body is None else body), RECORD_COMPRESSED)
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_round_trip(codec):
+    records = record(b'one') + record(b'two')
+    assert decompress_records(bytes([codec]) + CODECS[codec][0](records)) == records
+
+def test_rejected_batches():
+    records = zlib.compress(record(b'one'))
+    assert decompress_records(b'') is None
+    assert decompress_records(b'\xff' + records) is None # Unknown codec
+    assert decompress_records(b'\x01garbage') is None
+    assert decompress_records(b'\x01' + records[:-3]) is None # Truncated stream
+
+def test_bomb_bounded():
+    bomb = b'\x01' + zlib.compress(bytes(2000))
+    assert decompress_records(bomb, max_bytes=2000) == bytes(2000)
+    assert decompress_records(bomb, max_bytes=1999) is None
+
+def test_iter_messages_skips_undecodable():
+    records = (record(b'before') + compressed(b'', body=b'garbage') + compressed(record(b'inside'))
+               + record(b'after'))
+    assert [bytes(m) for m in iter_messages(memoryview(records), True)] == [b'before', b'inside', b'after']
+
+def test_append_batch_compressed(log):
+    topic = 'compressed'
+    assert log.append_batch(topic, compressed(record(b'one') + record(b'two'))) == 0
+    assert log.append_batch(topic, compressed(b'', body=b'garbage')) == 1
+    assert log.append_batch(topic, compressed(b'', codec=2, body=zlib.compress(b'zlib, not bz2'))) == 1
+    # Expands past the limit, rejected without decoding the whole batch
+    assert log.append_batch(topic, compressed(bytes(DECOMPRESSED_MAX_BYTES + 1))) == 1
+    records, _ = log.read_messages(topic, 0)
+    assert [bytes(m) for m in iter_messages(records, True)] == [b'one', b'two']
+
+def test_client_decompress_batch():
+    assert decompress_batch(b'\x01' + zlib.compress(b'records')) == b'records'
+    with pytest.raises(ValueError, match='Unknown compression codec 255'):
+        decompress_batch(b'\xffdata')
+    with pytest.raises(ValueError, match="can't be decoded"):
+        decompress_batch(b'\x01garbage')
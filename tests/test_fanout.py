@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+import fanout
+from fanout import TailRing
+
+def record(payload: bytes) -> bytes:
+    return len(payload).to_bytes(4, 'big') + payload
+
+@pytest.fixture
+def small_ring(monkeypatch):
+    monkeypatch.setattr(fanout, 'TAIL_RING_BYTES', 36)
+    return TailRing()
+
+def test_read_bounds():
+    ring = TailRing()
+    a, b, c = record(b'aaaa'), record(b'bbbb'), record(b'cccc')
+    ring.append(100, a)
+    ring.append(108, b + c)
+    assert ring.read(99, 1000) is None
+    assert ring.read(124, 1000) is None # At the end, nothing to read yet
+    assert ring.read(100, 1000) == a + b + c
+    # At least the first append, then whole appends that fit
+    assert bytes(ring.read(100, 1)) == a
+    assert bytes(ring.read(108, 1000)) == b + c
+    # From a record inside an append, up to its end
+    assert bytes(ring.read(116, 1000)) == c
+
+def test_gap_starts_over():
+    ring = TailRing()
+    ring.append(0, record(b'aaaa'))
+    ring.append(50, record(b'bbbb'))
+    assert ring.read(0, 1000) is None
+    assert ring.read(50, 1000) == record(b'bbbb')
+
+def test_eviction(small_ring):
+    records = [record(bytes([65+i])*8) for i in range(5)] # 12 bytes each
+    for i, r in enumerate(records):
+        small_ring.append(i*12, r)
+    assert small_ring.size <= fanout.TAIL_RING_BYTES
+    assert small_ring.read(0, 1000) is None
+    assert small_ring.read(24, 1000) == b''.join(records[2:])
+    # Dropped appends are compacted out of the lists
+    assert len(small_ring.offsets) - small_ring.first == 3
+    assert small_ring.first*2 <= len(small_ring.offsets)
+
+def test_newest_append_kept(small_ring):
+    big = record(b'x'*100)
+    small_ring.append(0, record(b'a'))
+    small_ring.append(5, big)
+    assert small_ring.read(0, 1000) is None
+    assert small_ring.read(5, 1) == big
+
+def test_shared_batch_frames():
+    batch = fanout.SharedBatch('t', record(b'one') + record(b'two'), 14, False)
+    assert batch.message_frames() == (5).to_bytes(4, 'big') + b't one' + (5).to_bytes(4, 'big') + b't two'
+    assert batch.count == 2
+    assert batch.batch_frame() == (6+14).to_bytes(4, 'big') + b'BAT t ' + record(b'one') + record(b'two')
+
+def test_shared_batch_decoded_once(monkeypatch):
+    calls = []
+    def failing(*args, **kwargs):
+        calls.append(args)
+        raise ValueError('bad record')
+    monkeypatch.setattr(fanout, 'frame_messages', failing)
+    batch = fanout.SharedBatch('t', record(b'one'), 7, False)
+    # Every subscriber gets the same empty frames and moves past the batch
+    assert batch.message_frames() == b'' and batch.count == 0
+    assert batch.message_frames() == b''
+    assert len(calls) == 1
+
+@pytest.fixture
+def broker(log):
+    import broker
+    broker.topic_waiters.clear()
+    fanout.dispatchers.clear()
+    return broker
+
+def test_ring_only_for_watched_topics(broker):
+    broker.records_appended('idle', [(0, record(b'one'))])
+    assert 'idle' not in fanout.dispatchers
+    assert fanout.get_shared_batch('idle', 0, False) is None
+    waiter = asyncio.Event()
+    broker.watch_topics(waiter, set(), {'read'})
+    broker.records_appended('read', [(0, record(b'one'))])
+    assert fanout.get_shared_batch('read', 0, False).records == record(b'one')
+
+def test_dispatcher_dropped_with_last_waiter(broker):
+    first, second = asyncio.Event(), asyncio.Event()
+    broker.watch_topics(first, set(), {'t'})
+    broker.watch_topics(second, set(), {'t'})
+    broker.records_appended('t', [(0, record(b'one'))])
+    broker.watch_topics(first, {'t'}, set())
+    assert 't' in fanout.dispatchers
+    broker.watch_topics(second, {'t'}, set())
+    assert 't' not in fanout.dispatchers
@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+
+class FakeWriter:
+    """Collects the frames written to a client or an upstream worker"""
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame):
+        self.frames.append(bytes(frame))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+def v1_frame(msg: bytes) -> bytes:
+    return len(msg).to_bytes(4, 'big') + msg
+
+@pytest.fixture
+def broker(log, monkeypatch):
+    import broker
+    import workers
+    monkeypatch.setattr(workers, 'worker_count', 2)
+    broker.client_credits.clear()
+    broker.credit_events.clear()
+    return broker
+
+async def serve(broker, serve_client, data: bytes):
+    """Serves a connection sending data, with an upstream already open to the other worker"""
+    import workers
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    upstream = FakeWriter()
+    upstreams = workers.Upstreams(None)
+    upstreams.writers[1] = upstream
+    await serve_client(reader, FakeWriter(), upstreams)
+    return upstreams, upstream
+
+def test_credit_kept_by_connection_worker(broker):
+    data = v1_frame(b'CID c1') + v1_frame(b'CRD 1000') + v1_frame(b'CRD 500')
+    upstreams, upstream = asyncio.run(serve(broker, lambda r, w, u: broker.serve_client(r, w, u, None), data))
+    # The other worker only learns the session, a grant to every worker would multiply the window
+    assert upstream.frames == [v1_frame(b'CID c1')]
+    assert broker.client_credits['c1'] == 1500
+    assert upstreams.client_id == 'c1'
+
+def test_credit_kept_by_connection_worker_v2(broker):
+    import protocol_v2
+    data = (protocol_v2.encode_frame(protocol_v2.OP_LOGIN, payload=b'c2')
+            + protocol_v2.encode_frame(protocol_v2.OP_CREDIT, payload=protocol_v2.OFFSET.pack(1000)))
+    upstreams, upstream = asyncio.run(serve(broker, broker.serve_client_v2, data))
+    assert len(upstream.frames) == 1 # The login
+    assert broker.client_credits['c2'] == 1000
+
+def test_piped_frames_charged(broker):
+    import workers
+    async def scenario():
+        client = FakeWriter()
+        upstreams = workers.Upstreams(None)
+        upstreams.client_id = 'c3'
+        broker.grant_credit('c3', 100)
+        await broker.write_piped_frame(client, upstreams, b'a'*80)
+        assert broker.client_credits['c3'] == 20
+        # Sent while some credit is left, overdrawing it once
+        await broker.write_piped_frame(client, upstreams, b'b'*80)
+        assert broker.client_credits['c3'] == -60
+        blocked = asyncio.create_task(broker.write_piped_frame(client, upstreams, b'c'*10))
+        await asyncio.sleep(0.05)
+        assert not blocked.done() and len(client.frames) == 2
+        broker.grant_credit('c3', 100)
+        await asyncio.wait_for(blocked, 1)
+        assert client.frames[-1] == b'c'*10
+        assert broker.client_credits['c3'] == 30
+        # The event of the wait isn't left behind for a client without a local writer
+        assert 'c3' not in broker.credit_events
+    asyncio.run(scenario())
+
+def test_piped_frames_without_flow_control(broker):
+    import workers
+    async def scenario():
+        client = FakeWriter()
+        upstreams = workers.Upstreams(None)
+        upstreams.client_id = 'c4'
+        await broker.write_piped_frame(client, upstreams, b'a'*80)
+        assert client.frames == [b'a'*80] and 'c4' not in broker.client_credits
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import pytest
+
+@pytest.fixture
+def groups(log):
+    import topic_config
+    import group_coordinator
+    topic_config.topic_configs.clear()
+    group_coordinator.groups.clear()
+    group_coordinator.client_groups.clear()
+    topic_config.set_topic_config('orders', 'partitions', '4')
+    return group_coordinator
+
+def assigned(groups, client_id):
+    return sorted(log for log, _ in groups.assigned_logs(client_id))
+
+def test_single_member_gets_every_partition(groups):
+    group = groups.join_group('billing', 'c1', 'orders', object())
+    assert group.generation == 1
+    assert assigned(groups, 'c1') == [f'orders/partition-{i}' for i in range(4)]
+    assert groups.assigned_logs('c1')[0][1] == 'group:billing'
+
+def test_rebalance_on_join_and_leave(groups):
+    c1, c2, c3 = object(), object(), object()
+    groups.join_group('billing', 'c1', 'orders', c1)
+    groups.join_group('billing', 'c2', 'orders', c2)
+    groups.join_group('billing', 'c3', 'orders', c3)
+    logs = [assigned(groups, c) for c in ('c1', 'c2', 'c3')]
+    # Every partition to exactly one member, spread evenly
+    assert sorted(sum(logs, [])) == [f'orders/partition-{i}' for i in range(4)]
+    assert sorted(len(l) for l in logs) == [1, 1, 2]
+    groups.leave_groups('c2', c2)
+    assert groups.groups['billing'].generation == 4
+    assert sorted(assigned(groups, 'c1') + assigned(groups, 'c3')) == [f'orders/partition-{i}' for i in range(4)]
+    assert groups.assigned_logs('c2') == []
+    assert not groups.is_assigned('c2', 'group:billing', 'orders/partition-0')
+
+def test_join_again_doesnt_rebalance(groups):
+    connection = object()
+    groups.join_group('billing', 'c1', 'orders', connection)
+    group = groups.join_group('billing', 'c1', 'orders', connection)
+    assert group.generation == 1
+
+def test_stale_leave_ignored(groups):
+    old, new = object(), object()
+    groups.join_group('billing', 'c1', 'orders', old)
+    groups.join_group('billing', 'c1', 'orders', new) # Reconnected
+    groups.leave_groups('c1', old)
+    assert assigned(groups, 'c1') == [f'orders/partition-{i}' for i in range(4)]
+    groups.leave_groups('c1', new)
+    assert 'billing' not in groups.groups and 'c1' not in groups.client_groups
+
+def test_members_only_get_their_topics(groups):
+    groups.join_group('billing', 'c1', 'orders', object())
+    groups.join_group('billing', 'c2', 'payments', object())
+    assert assigned(groups, 'c1') == [f'orders/partition-{i}' for i in range(4)]
+    assert assigned(groups, 'c2') == ['payments']
+    assert groups.is_assigned('c2', 'group:billing', 'payments')
+    assert not groups.is_assigned('c2', 'group:billing', 'orders/partition-0')
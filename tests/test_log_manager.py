@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+import zlib
+from compression import RECORD_SKIP, RECORD_KEYED
+
+def frame(msg: bytes, flags=0, hashed=True) -> bytes:
+    """A record framed as a producer sends it in a batch, [4B length][msg][4B crc32]"""
+    if hashed:
+        msg += zlib.crc32(msg).to_bytes(4, 'big')
+    return (len(msg) | flags).to_bytes(4, 'big') + msg
+
+def marked_files(log):
+    return {path for _, path in log.delete_file_heap}
+
+def test_rollover_keeps_expiry_swap(log, monkeypatch):
+    topic = 'rollover_expiry'
+    log.append_message(topic, b'first')
+    log.rollover_file(topic)
+    log.append_message(topic, b'second')
+    log.topic_retention_bytes[topic] = 1
+    flush_segment = log.flush_segment
+    cleaners = []
+    def slow_flush(f, mm):
+        # The cleaner expires the topic while the outgoing segment is fsynced
+        cleaner = threading.Thread(target=log.expire_segments, args=(topic,))
+        cleaner.start()
+        cleaners.append(cleaner)
+        time.sleep(0.1)
+        flush_segment(f, mm)
+    monkeypatch.setattr(log, 'flush_segment', slow_flush)
+    log.rollover_file(topic)
+    cleaners[0].join()
+    segments = log.topics_log_file[topic]
+    assert not {fp[0].name for fp in segments} & marked_files(log)
+    assert log.get_latest_offset(topic) == segments[-1][4]
+
+def test_append_batch(log):
+    topic = 'batch_valid'
+    batch = frame(b'one') + frame(b'two')
+    assert log.append_batch(topic, batch) == 0
+    records, next_offset = log.read_messages(topic, 0)
+    assert bytes(records) == batch and next_offset == len(batch)
+
+def test_append_batch_rejects(log):
+    topic = 'batch_rejected'
+    good = frame(b'good')
+    corrupted = bytearray(frame(b'bad'))
+    corrupted[-1] ^= 1
+    assert log.append_batch(topic, b'') == 1
+    assert log.append_batch(topic, good[:-1]) == 1 # Truncated
+    assert log.append_batch(topic, good + b'\x00\x00') == 1 # Truncated header
+    assert log.append_batch(topic, (0).to_bytes(4, 'big')) == 1 # Empty record
+    assert log.append_batch(topic, frame(b'ab', hashed=False)) == 3 # Too short for a hash
+    assert log.append_batch(topic, good + bytes(corrupted)) == 2
+    # Skip runs and the keyed flag are only written by the broker itself
+    assert log.append_batch(topic, good + frame(b'run', RECORD_SKIP)) == 1
+    assert log.append_batch(topic, frame(b'k v', RECORD_KEYED)) == 1
+    # A rejected batch writes nothing, not even its valid records
+    assert log.get_latest_offset(topic) == 0
+    assert log.append_batch(topic, good) == 0
+    assert log.get_latest_offset(topic) == len(good)
+
+def test_append_batch_unhashed(log):
+    topic = 'batch_unhashed'
+    batch = frame(b'one', hashed=False) + frame(b'two', hashed=False)
+    assert log.append_batch(topic, batch, hashed=False) == 0
+    assert log.get_latest_offset(topic) == len(batch)
+
+def test_time_seek(log, monkeypatch):
+    topic = 'time_seek'
+    now = [1_000_000.0]
+    monkeypatch.setattr(log.time, 'time', lambda: now[0])
+    offsets = []
+    for i in range(6):
+        if i == 3:
+            log.rollover_file(topic)
+        offsets.append(log.get_latest_offset(topic))
+        log.append_message(topic, f'message {i}'.encode())
+        now[0] += 10
+    sealed = log.topics_log_file[topic][0][0].name
+    assert sealed not in log.time_indexes
+    # Appended at 1_000_000 + 10*i seconds
+    assert log.find_time_offset(topic, 1_000_010_000) == offsets[1] # Sealed segment
+    assert log.find_time_offset(topic, 1_000_040_000) == offsets[4] # Active segment
+    assert log.find_time_offset(topic, 1_000_025_000) == offsets[3] # After the sealed records
+    assert log.find_time_offset(topic, 2_000_000_000) == log.get_latest_offset(topic)
+    assert sealed not in log.time_indexes
+
+def test_time_seek_doesnt_create_index(log, monkeypatch):
+    topic = 'time_seek_no_index'
+    monkeypatch.setattr(log.time, 'time', lambda: 1_000_000.0)
+    log.append_message(topic, b'message')
+    monkeypatch.setattr(log.time, 'time', lambda: 1_000_010.0)
+    log.rollover_file(topic)
+    path = log.time_index_path(log.topics_log_file[topic][0][0].name)
+    os.remove(path)
+    # Without an index every record of the sealed segment may be newer
+    assert log.find_time_offset(topic, 1_000_005_000) == 0
+    assert not os.path.exists(path)
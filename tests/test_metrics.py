@@ -0,0 +1,33 @@
+from metrics import Histogram, bucket_upper_bound, HISTOGRAM_SUB_BUCKETS
+
+def test_empty():
+    assert Histogram('h', 'help', 'us').quantile(0.5) == 0
+
+def test_small_values_exact():
+    h = Histogram('h', 'help', 'us')
+    for value in range(1, 11):
+        h.record(value)
+    assert h.count == 10 and h.total == 55
+    assert h.quantile(0.5) == 5
+    assert h.quantile(1.0) == 10
+
+def test_quantiles_within_error():
+    h = Histogram('h', 'help', 'us')
+    for value in range(1, 10_001):
+        h.record(value)
+    for q in (0.5, 0.99, 0.999):
+        exact = q * 10_000
+        # The upper bound of a bucket, at most one sub bucket (12.5%) above
+        assert exact <= h.quantile(q) <= exact * (1 + 1/HISTOGRAM_SUB_BUCKETS)
+
+def test_outlier_only_in_tail():
+    h = Histogram('h', 'help', 'us')
+    for _ in range(999):
+        h.record(100)
+    h.record(1_000_000)
+    assert h.quantile(0.5) == h.quantile(0.99) < 120
+    assert h.quantile(1.0) >= 1_000_000
+
+def test_bucket_bounds_increase():
+    bounds = [bucket_upper_bound(i) for i in range(200)]
+    assert bounds == sorted(set(bounds))
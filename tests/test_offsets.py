@@ -0,0 +1,40 @@
+import pytest
+
+@pytest.fixture
+def offsets(log):
+    import offsets_manager
+    offsets_manager.client_offsets.clear()
+    offsets_manager.dirty_offsets.clear()
+    return offsets_manager
+
+def test_load_from_log(offsets):
+    offsets.update_client_offset('c1', 'orders', 10)
+    offsets.update_client_offset('c1', 'orders', 20) # Coalesced, only the last commit is appended
+    offsets.update_client_offset('c2', 'orders', 5)
+    offsets.flush_client_offsets()
+    offsets.update_client_offset('c2', 'orders', 7)
+    offsets.flush_client_offsets()
+    offsets.client_offsets.clear()
+    offsets.load_client_offsets()
+    assert offsets.client_offsets == {'c1': {'orders': 20}, 'c2': {'orders': 7}}
+
+def test_load_snapshot_then_newer_commits(offsets, log):
+    offsets.update_client_offset('c1', 'orders', 10)
+    offsets.update_client_offset('c1', 'payments', 3)
+    offsets.flush_client_offsets()
+    offsets.write_snapshot(log.get_latest_offset(offsets.INTERNAL_CONSUMER_LOG))
+    offsets.update_client_offset('c1', 'orders', 11)
+    offsets.flush_client_offsets()
+    offsets.client_offsets.clear()
+    offsets.load_client_offsets()
+    assert offsets.client_offsets == {'c1': {'orders': 11, 'payments': 3}}
+
+def test_log_before_snapshot_not_replayed(offsets, log):
+    offsets.update_client_offset('c1', 'orders', 10)
+    offsets.flush_client_offsets()
+    # The snapshot covers the whole log, its values win over the records before its offset
+    offsets.client_offsets['c1']['orders'] = 42
+    offsets.write_snapshot(log.get_latest_offset(offsets.INTERNAL_CONSUMER_LOG))
+    offsets.client_offsets.clear()
+    offsets.load_client_offsets()
+    assert offsets.client_offsets == {'c1': {'orders': 42}}
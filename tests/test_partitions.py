@@ -0,0 +1,55 @@
+import zlib
+import pytest
+
+@pytest.fixture
+def config(log):
+    import topic_config
+    topic_config.topic_configs.clear()
+    return topic_config
+
+def test_unpartitioned_topic(config):
+    import broker
+    assert config.topic_logs('plain') == ['plain']
+    assert broker.route_record('plain', b'key') == 'plain'
+    assert broker.route_record('plain') == 'plain'
+
+def test_keyed_routing(config):
+    import broker
+    assert config.set_topic_config('orders', 'partitions', '4') == 0
+    assert config.topic_logs('orders') == [f'orders/partition-{i}' for i in range(4)]
+    # A key always lands in the same partition, chosen by a hash stable across processes
+    for key in (b'alice', b'bob', b'carol'):
+        log = broker.route_record('orders', key)
+        assert log == f'orders/partition-{zlib.crc32(key) % 4}'
+        assert all(broker.route_record('orders', key) == log for _ in range(5))
+
+def test_unkeyed_round_robin(config):
+    import broker
+    config.set_topic_config('events', 'partitions', '3')
+    logs = [broker.route_record('events') for _ in range(6)]
+    assert logs[:3] == logs[3:] and sorted(logs[:3]) == config.topic_logs('events')
+
+def test_offsets_per_partition(config, log):
+    import broker
+    config.set_topic_config('orders', 'partitions', '2')
+    keys = [b'a', b'b', b'c', b'd', b'e']
+    expected = {}
+    for key in keys:
+        partition = broker.route_record('orders', key)
+        msg = key + b' value'
+        # Every partition is a log of its own, its offsets start at 0
+        offset = log.get_latest_offset(partition)
+        assert offset == expected.get(partition, 0)
+        assert log.append_message(partition, msg, keyed=True) == 0
+        assert bytes(log.read_message(partition, offset)[0]) == msg
+        expected[partition] = offset + 4 + len(msg)
+    for partition, end in expected.items():
+        assert log.get_latest_offset(partition) == end
+
+def test_partitions_only_added_before_records(config, log):
+    assert config.set_topic_config('grow', 'partitions', '2') == 0
+    assert config.set_topic_config('grow', 'partitions', '1') == 1 # Can't be removed
+    assert config.set_topic_config('grow', 'partitions', 'x') == 1
+    log.append_message('flat', b'record')
+    # Records already in the unpartitioned log would lose their order
+    assert config.set_topic_config('flat', 'partitions', '2') == 1
@@ -0,0 +1,67 @@
+import time
+
+def make_segments(log, topic, count, msg=b'x'*100):
+    """Appends one message per segment, the last one stays active"""
+    for i in range(count):
+        if i:
+            log.rollover_file(topic)
+        log.append_message(topic, msg)
+    return log.topics_log_file[topic]
+
+def age_segment(log, topic, i, seconds):
+    fp = log.topics_log_file[topic][i]
+    log.topics_log_file[topic][i] = fp[:2] + (fp[2] - seconds,) + fp[3:]
+
+def marked(log):
+    return {path for _, path in log.delete_file_heap}
+
+def test_bytes_counts_written_records(log):
+    topic = 'retention_bytes'
+    segments = make_segments(log, topic, 3)
+    # Each segment is mapped with SEG_SIZE_INC but holds a single 104 byte record
+    log.topic_retention_bytes[topic] = 3*104
+    log.expire_segments(topic)
+    assert log.topics_log_file[topic] == segments
+    log.topic_retention_bytes[topic] = 2*104
+    log.expire_segments(topic)
+    assert log.topics_log_file[topic] == segments[1:]
+    assert marked(log) == {segments[0][0].name}
+
+def test_bytes_keeps_active_segment(log):
+    topic = 'retention_bytes_active'
+    segments = make_segments(log, topic, 3)
+    log.topic_retention_bytes[topic] = 0
+    log.expire_segments(topic)
+    assert log.topics_log_file[topic] == segments[2:]
+
+def test_time(log):
+    topic = 'retention_time'
+    make_segments(log, topic, 3)
+    log.topic_retention[topic] = 60
+    age_segment(log, topic, 0, 120)
+    segments = log.topics_log_file[topic]
+    # The next check is due when the oldest remaining segment expires
+    assert log.expire_segments(topic) == segments[1][2] + 60
+    assert log.topics_log_file[topic] == segments[1:]
+    log.topic_retention[topic] = None # Compacted, kept until replaced
+    age_segment(log, topic, 0, 120)
+    assert log.expire_segments(topic) is None
+    assert len(log.topics_log_file[topic]) == 2
+
+def test_failed_check_rescheduled(log, monkeypatch):
+    def failing(topic):
+        raise OSError('disk error')
+    monkeypatch.setattr(log, 'expire_segments', failing)
+    before = time.time()
+    log.check_expiry('retention_retry')
+    deadline = log.expiry_deadlines['retention_retry']
+    assert before + log.EXPIRY_RETRY_TIME <= deadline <= time.time() + log.EXPIRY_RETRY_TIME
+    assert (deadline, 'retention_retry') in log.expiry_heap
+
+def test_check_schedules_next_deadline(log, monkeypatch):
+    monkeypatch.setattr(log, 'expire_segments', lambda topic: 1234.0)
+    log.check_expiry('retention_next')
+    assert log.expiry_deadlines['retention_next'] == 1234.0
+    monkeypatch.setattr(log, 'expire_segments', lambda topic: None)
+    log.check_expiry('retention_none')
+    assert 'retention_none' not in log.expiry_deadlines
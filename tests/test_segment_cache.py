@@ -0,0 +1,58 @@
+from segment_cache import SegmentCache
+
+def make_cache(capacity, max_bytes):
+    evicted = []
+    cache = SegmentCache(capacity, max_bytes, lambda key, value: evicted.append(key))
+    return cache, evicted
+
+def test_hit_and_miss():
+    cache, evicted = make_cache(4, 1000)
+    assert cache.get('a') is None
+    cache.put('a', 'A', 10)
+    assert cache.get('a') == 'A'
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_ratio() == 0.5
+    assert not evicted
+
+def test_entry_bound():
+    cache, evicted = make_cache(4, 1000)
+    for key in 'abcdef':
+        cache.put(key, key.upper(), 10)
+    assert len(cache.entries) == 4
+    assert evicted == ['a', 'b'] # First in, first out of probation
+    assert cache.evictions == 2
+
+def test_byte_bound():
+    cache, evicted = make_cache(100, 100)
+    for key in 'abc':
+        cache.put(key, key, 40)
+    assert cache.size == 80 and evicted == ['a']
+    cache.put('big', 'big', 500) # Bigger than the bound, kept so the reader can use it
+    assert cache.get('big') == 'big'
+    assert set(cache.entries) == {'big'}
+
+def test_scan_resistance():
+    cache, evicted = make_cache(8, 10_000)
+    hot = ['h1', 'h2']
+    for key in hot:
+        cache.put(key, key, 10)
+    for key in 'abcdefgh':
+        cache.put(key, key, 10)
+    # The hot segments were scanned out of probation, mapped again they are wanted repeatedly
+    for key in hot:
+        assert cache.get(key) is None
+        cache.put(key, key, 10)
+    assert cache.promotions == 2
+    # A replay reading many old segments once only cycles through probation
+    for i in range(100):
+        cache.put(f'scan{i}', i, 10)
+    for key in hot:
+        assert cache.get(key) == key
+    assert len(cache.entries) <= 8
+
+def test_remove_skips_callback():
+    cache, evicted = make_cache(4, 1000)
+    cache.put('a', 'A', 10)
+    cache.remove('a')
+    assert cache.get('a') is None and cache.size == 0
+    assert not evicted and cache.evictions == 0
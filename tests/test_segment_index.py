@@ -0,0 +1,95 @@
+import pytest
+from segment_index import OffsetIndex, TimeIndex
+
+def test_offset_index_lookup(tmp_path):
+    index = OffsetIndex(str(tmp_path / '0_log.index'), 8)
+    for position in (100, 200, 300):
+        index.append(position)
+    index.append(250) # Not increasing, ignored
+    assert index.entries == 3
+    assert index.lookup(0) == 0 # Position 0 is implicit
+    assert index.lookup(99) == 0
+    assert index.lookup(100) == 100
+    assert index.lookup(299) == 200
+    assert index.lookup(10_000) == 300
+    index.close()
+
+def test_offset_index_full_and_reopen(tmp_path):
+    path = str(tmp_path / '0_log.index')
+    index = OffsetIndex(path, 2)
+    for position in (10, 20, 30):
+        index.append(position)
+    assert index.entries == 2 and index.last_position() == 20
+    index.close()
+    index = OffsetIndex(path, 2)
+    assert not index.created
+    assert index.entries == 2 and index.lookup(25) == 20
+    index.close()
+
+def test_offset_index_truncate(tmp_path):
+    path = str(tmp_path / '0_log.index')
+    index = OffsetIndex(path, 8)
+    for position in (100, 200, 300):
+        index.append(position)
+    index.truncate(1)
+    assert index.entries == 1 and index.last_position() == 100
+    assert index.lookup(300) == 100
+    index.append(150) # Appends continue after the kept entries
+    assert index.lookup(300) == 150
+    index.truncate(0)
+    assert index.entries == 0 and index.lookup(300) == 0
+    index.close()
+    index = OffsetIndex(path, 8)
+    assert index.entries == 0
+    index.close()
+
+def test_time_index_lookup(tmp_path):
+    index = TimeIndex(str(tmp_path / '0_log.timeindex'), 8)
+    index.append(10_000, 0)
+    index.append(11_000, 400)
+    index.append(13_000, 900)
+    index.append(12_000, 1000) # Not increasing, ignored
+    assert index.entries == 3
+    assert index.lookup(5_000, 1000) == 0 # Before the segment
+    assert index.lookup(10_500, 1000) == 0 # Within the interval of the first entry
+    assert index.lookup(11_000, 1000) == 400
+    assert index.lookup(12_000, 1000) == 900 # Past the interval of an entry, the next one
+    assert index.lookup(13_999, 1000) == 900
+    assert index.lookup(14_000, 1000) == -1 # Every record is older
+    index.close()
+
+def test_time_index_full(tmp_path):
+    index = TimeIndex(str(tmp_path / '0_log.timeindex'), 2)
+    index.append(10_000, 0)
+    index.append(11_000, 400)
+    index.append(12_000, 900) # Dropped, the records after the last entry may be newer
+    assert index.lookup(20_000, 1000) == 400
+    index.close()
+
+def test_time_index_truncate(tmp_path):
+    path = str(tmp_path / '0_log.timeindex')
+    index = TimeIndex(path, 8)
+    index.append(10_000, 0)
+    index.append(11_000, 400)
+    index.truncate(1)
+    assert index.entries == 1 and index.last_time() == 10_000 and index.last_position() == 0
+    assert index.lookup(11_500, 1000) == -1
+    index.close()
+    index = TimeIndex(path, 8)
+    assert index.entries == 1
+    index.close()
+
+def test_time_index_read_only(tmp_path):
+    path = str(tmp_path / '0_log.timeindex')
+    with pytest.raises(FileNotFoundError):
+        TimeIndex(path, 8, read_only=True)
+    assert not (tmp_path / '0_log.timeindex').exists() # Never created by a read
+    index = TimeIndex(path, 8)
+    index.append(10_000, 0)
+    index.append(11_000, 400)
+    reader = TimeIndex(path, 8, read_only=True)
+    assert reader.entries == 2 and reader.lookup(11_500, 1000) == 400
+    with pytest.raises(TypeError):
+        reader.append(12_000, 900)
+    reader.close()
+    index.close()
@@ -0,0 +1,60 @@
+import os
+
+def restart(log):
+    """Drops the loaded logs and loads them again from the logs directory"""
+    log.topics_log_file.clear()
+    log.segment_indexes.clear()
+    log.time_indexes.clear()
+    log.load_topics_log()
+
+def marker(log, topic):
+    return os.path.join(log.LOG_FILE_DIR, topic, log.CLEAN_SHUTDOWN_FILE)
+
+def test_clean_shutdown_load(log):
+    topic = 'restart_clean'
+    for i in range(3):
+        log.append_message(topic, f'sealed {i}'.encode())
+    log.rollover_file(topic)
+    for i in range(2):
+        log.append_message(topic, f'active {i}'.encode())
+    starts = [log.get_offset_from_filename(fp[0].name) for fp in log.topics_log_file[topic]]
+    latest = log.get_latest_offset(topic)
+    records = bytes(log.read_messages(topic, 0)[0]) + bytes(log.read_messages(topic, starts[1])[0])
+    log.close_all_segments()
+    assert os.path.exists(marker(log, topic))
+
+    restart(log)
+    assert not os.path.exists(marker(log, topic)) # Consumed, a crash from now on scans again
+    assert [log.get_offset_from_filename(fp[0].name) for fp in log.topics_log_file[topic]] == starts
+    assert log.get_latest_offset(topic) == latest
+    assert bytes(log.read_messages(topic, 0)[0]) + bytes(log.read_messages(topic, starts[1])[0]) == records
+    log.append_message(topic, b'after restart')
+    assert bytes(log.read_message(topic, latest)[0]) == b'after restart'
+
+def test_unclean_shutdown_scans(log):
+    topic = 'restart_unclean'
+    log.append_message(topic, b'first')
+    f, _, _, _, write_offset = log.topics_log_file[topic][-1]
+    path = f.name
+    log.close_all_segments(clean=False)
+    assert not os.path.exists(marker(log, topic))
+    # A writer that didn't stop in time appended after the manifest
+    record = log.frame_record(b'late')
+    with open(path, 'r+b') as f:
+        f.seek(write_offset)
+        f.write(record)
+
+    restart(log)
+    assert log.get_latest_offset(topic) == write_offset + len(record)
+    assert bytes(log.read_message(topic, write_offset)[0]) == b'late'
+
+def test_manifest_without_marker_scans(log):
+    topic = 'restart_crash'
+    log.append_message(topic, b'first')
+    log.write_manifest(topic) # As on rollover, then a crash
+    log.append_message(topic, b'second')
+    latest = log.get_latest_offset(topic)
+    log.sync_topic(topic)
+
+    restart(log)
+    assert log.get_latest_offset(topic) == latest